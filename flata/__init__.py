@@ -28,10 +28,12 @@ Usage example:
 """
 
 from .queries import Query, where
-from .storages import Storage, JSONStorage, MemoryStorage
-from .middlewares import Middleware, CachingMiddleware
+from .storages import (Storage, JSONStorage, LogStorage, DirectoryStorage,
+                       MemoryStorage)
+from .middlewares import (Middleware, CachingMiddleware,
+                          BoundedCachingMiddleware)
 from .database import Flata
 
-__all__ = ('Flata', 'Storage', 'JSONStorage', 'MemoryStorage', 'Middleware', 'CachingMiddleware', 'Query', 'where')
+__all__ = ('Flata', 'Storage', 'JSONStorage', 'LogStorage', 'DirectoryStorage', 'MemoryStorage', 'Middleware', 'CachingMiddleware', 'BoundedCachingMiddleware', 'Query', 'where')
 
 
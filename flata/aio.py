@@ -0,0 +1,351 @@
+"""
+Contains an :mod:`asyncio` interface to Flata (Python 3 only).
+
+:class:`AsyncFlata` and :class:`AsyncTable` offer the methods of
+:class:`~flata.database.Flata` and :class:`~flata.database.Table` as
+coroutines. The storage is only used from the threads of an executor, so
+reading or rewriting a file never blocks the event loop:
+
+>>> async with AsyncFlata('db.json') as db:
+...     table = db.table('users')
+...     await table.insert({'name': 'John'})
+...     await table.search(where('name') == 'John')
+
+Writes made during the same iteration of the loop are collected and run
+together in one job of the executor; inserts that follow each other are
+written to the storage at once. Updates, removals and purges are not
+merged: each of them is still written to the storage on its own, in the
+order they were made.
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from .database import Flata
+
+__all__ = ('AsyncFlata', 'AsyncTable')
+
+# Only called from coroutines and callbacks of the loop (Python < 3.7 has
+# no get_running_loop)
+_running_loop = getattr(asyncio, 'get_running_loop', asyncio.get_event_loop)
+
+
+class AsyncTable(object):
+    """
+    Gives awaitable access to a :class:`~flata.database.Table`.
+
+    Operations on a table run in the order they were made. Writes are
+    queued and run as a batch, one batch at a time; reads made while a
+    batch is queued or running join the next batch, so they see the writes
+    made before them.
+    """
+
+    def __init__(self, table, executor):
+        """
+        :param table: The table to give access to.
+        :type table: flata.database.Table
+        :param executor: The executor to run the table's methods in.
+        """
+
+        self._table = table
+        self._executor = executor
+
+        self._batch = None  # [(method, args, future)]
+        self._running = False
+
+    @property
+    def table(self):
+        """
+        The underlying synchronous table.
+        """
+
+        return self._table
+
+    # --- Scheduling ----------------------------------------------------------
+
+    def _submit(self, method, *args):
+        loop = _running_loop()
+
+        if self._batch is None:
+            self._batch = []
+            if not self._running:
+                loop.call_soon(self._flush, loop)
+
+        future = loop.create_future()
+        self._batch.append((method, args, future))
+        return future
+
+    def _read(self, method, *args):
+        if self._batch is not None or self._running:
+            return self._submit(method, *args)
+
+        return _running_loop().run_in_executor(
+            self._executor, lambda: getattr(self._table, method)(*args))
+
+    def _flush(self, loop):
+        if self._running or not self._batch:
+            return
+
+        batch, self._batch = self._batch, None
+        self._running = True
+
+        job = loop.run_in_executor(self._executor, self._run, batch)
+        job.add_done_callback(lambda job: self._done(loop, batch, job))
+
+    def _done(self, loop, batch, job):
+        self._running = False
+
+        if job.exception() is not None:
+            outcomes = [(future, None, job.exception())
+                        for _, _, future in batch]
+        else:
+            outcomes = job.result()
+
+        for future, result, error in outcomes:
+            if future.done():
+                continue  # Cancelled
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+        self._flush(loop)
+
+    def _run(self, batch):
+        """
+        Run a batch of operations in the executor.
+
+        Only runs of consecutive inserts are merged into one write (with
+        :meth:`~flata.database.Table.insert_multiple`); every other
+        operation runs on its own, so a batch of updates or removals costs
+        one storage write each.
+
+        :returns: the future, result and exception of every operation
+        """
+
+        outcomes = []
+        i = 0
+
+        while i < len(batch):
+            method, args, future = batch[i]
+
+            if method != 'insert':
+                try:
+                    result = getattr(self._table, method)(*args)
+                except Exception as e:
+                    outcomes.append((future, None, e))
+                else:
+                    outcomes.append((future, result, None))
+                i += 1
+                continue
+
+            # Inserts following each other are written at once
+            group = []
+            while i < len(batch) and batch[i][0] == 'insert':
+                group.append(batch[i])
+                i += 1
+
+            try:
+                inserted = self._table.insert_multiple(
+                    element for _, (elements, _), _ in group
+                    for element in elements)
+            except Exception as e:
+                outcomes.extend((future, None, e) for _, _, future in group)
+                continue
+
+            start = 0
+            for _, (elements, single), future in group:
+                result = inserted[start:start + len(elements)]
+                start += len(elements)
+                outcomes.append((future, result[0] if single else result,
+                                 None))
+
+        return outcomes
+
+    # --- Writes --------------------------------------------------------------
+
+    async def insert(self, element):
+        """
+        Insert a new element into the table.
+
+        :param element: the element to insert
+        :returns: the inserted element with ID
+        """
+
+        if not isinstance(element, dict):
+            raise ValueError('Element is not a dictionary')
+
+        return await self._submit('insert', [element], True)
+
+    async def insert_multiple(self, elements):
+        """
+        Insert multiple elements into the table.
+
+        :param elements: an iterable of elements to insert
+        :returns: a list containing the inserted elements with IDs
+        """
+
+        elements = list(elements)
+        for element in elements:
+            if not isinstance(element, dict):
+                raise ValueError('Element is not a dictionary')
+
+        return await self._submit('insert', elements, False)
+
+    async def update(self, fields, cond=None, ids=None):
+        """
+        Update all matching elements, see
+        :meth:`flata.database.Table.update`.
+        """
+
+        return await self._submit('update', fields, cond, ids)
+
+    async def remove(self, cond=None, ids=None):
+        """
+        Remove all matching elements, see
+        :meth:`flata.database.Table.remove`.
+        """
+
+        return await self._submit('remove', cond, ids)
+
+    async def purge(self):
+        """
+        Remove all elements from the table.
+        """
+
+        return await self._submit('purge')
+
+    # --- Reads ---------------------------------------------------------------
+
+    async def all(self):
+        """
+        Get all elements stored in the table.
+        """
+
+        return await self._read('all')
+
+    async def search(self, cond):
+        """
+        Search for all elements matching a condition.
+        """
+
+        return await self._read('search', cond)
+
+    async def get(self, cond=None, id=None):
+        """
+        Get exactly one element specified by a query or an ID.
+        """
+
+        return await self._read('get', cond, id)
+
+    async def count(self, cond=None):
+        """
+        Count the elements matching a condition, all elements if ``None``.
+        """
+
+        if cond is None:
+            return await self._read('__len__')
+        return await self._read('count', cond)
+
+    async def contains(self, cond=None, ids=None):
+        """
+        Check whether the table contains an element matching a condition
+        or an ID.
+        """
+
+        return await self._read('contains', cond, ids)
+
+
+class AsyncFlata(object):
+    """
+    Gives awaitable access to a :class:`~flata.database.Flata` database.
+
+    The database is opened in thread safe mode, so the tables can be used
+    from several threads of the executor at once.
+    """
+
+    #: The number of threads of the executor created by default
+    MAX_WORKERS = 4
+
+    def __init__(self, *args, **kwargs):
+        """
+        All arguments and keyword arguments are passed to
+        :class:`~flata.database.Flata`.
+
+        :param executor: The executor to run storage operations in. By
+                         default one is created and shut down on
+                         :meth:`close`.
+        :type executor: concurrent.futures.Executor
+        """
+
+        executor = kwargs.pop('executor', None)
+        kwargs['thread_safe'] = True
+
+        self._db = Flata(*args, **kwargs)
+        self._own_executor = executor is None
+        self._executor = executor or ThreadPoolExecutor(self.MAX_WORKERS)
+        self._tables = {}
+
+    @property
+    def db(self):
+        """
+        The underlying synchronous database.
+        """
+
+        return self._db
+
+    def table(self, name, **options):
+        """
+        Get access to a specific table, see :meth:`flata.database.Flata.table`.
+
+        :rtype: AsyncTable
+        """
+
+        if name not in self._tables:
+            self._tables[name] = AsyncTable(self._db.table(name, **options),
+                                            self._executor)
+
+        return self._tables[name]
+
+    def _run(self, func, *args):
+        return _running_loop().run_in_executor(self._executor, func, *args)
+
+    async def tables(self):
+        """
+        Get the names of all tables in the database.
+        """
+
+        return await self._run(self._db.tables)
+
+    async def purge_table(self, name):
+        """
+        Purge a specific table from the database. **CANNOT BE REVERSED!**
+        """
+
+        self._tables.pop(name, None)
+        await self._run(self._db.purge_table, name)
+
+    async def purge_tables(self):
+        """
+        Purge all tables from the database. **CANNOT BE REVERSED!**
+        """
+
+        self._tables.clear()
+        await self._run(self._db.purge_tables)
+
+    async def close(self):
+        """
+        Close the database.
+        """
+
+        await self._run(self._db.close)
+        if self._own_executor:
+            # The database is closed, so there's nothing left to wait for
+            # that would be worth blocking the loop
+            self._executor.shutdown(wait=False)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
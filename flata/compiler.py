@@ -0,0 +1,312 @@
+"""
+Contains the query compiler.
+
+Calling a :class:`~flata.queries.QueryImpl` runs a closure per query part
+and resolves the field path again for every one. The compiler turns a query
+into a single generated function instead, with the path lookups inlined,
+regular expressions compiled once and constant values bound as globals:
+
+>>> test = compile_query((where('a') == 1) & where('b').matches('^x'))
+>>> test({'a': 1, 'b': 'xyz'})
+True
+
+The parts of an AND are checked cheapest first (see :func:`cost`). Compiled
+functions are cached by the query's hash.
+"""
+
+import re
+import sys
+import threading
+
+from .queries import is_sequence
+from .utils import LRUCache
+
+__all__ = ('compile_query', 'cost')
+
+#: How many compiled queries to keep
+CACHE_SIZE = 256
+
+_cache = LRUCache(capacity=CACHE_SIZE)
+# Tables of several threads compile queries at the same time
+_cache_lock = threading.Lock()
+
+#: Relative cost of checking one element against a query operation
+COSTS = {
+    '==': 1, '!=': 1, '<': 1, '<=': 1, '>': 1, '>=': 1, 'exists': 1,
+    'matches': 4, 'search': 4, 'any': 4, 'all': 4,
+    'matches_ignore_case': 5, 'search_ignore_case': 5,
+    'test': 8,
+}
+
+#: The cost of operations the compiler doesn't know
+DEFAULT_COST = 8
+
+_COMPARISONS = {'==': '==', '!=': '!=', '<': '<', '<=': '<=', '>': '>',
+                '>=': '>='}
+
+_REGEXES = {
+    'matches': ('match', False),
+    'matches_ignore_case': ('match', True),
+    'search': ('search', False),
+    'search_ignore_case': ('search', True),
+}
+
+
+def compile_query(cond):
+    """
+    Compile a query into a single function.
+
+    Falls back to the query itself if it can't be compiled.
+
+    :param cond: the query to compile
+    :type cond: flata.queries.QueryImpl
+    :returns: a function taking an element and returning whether it matches
+    """
+
+    hashval = getattr(cond, 'hashval', None)
+    if hashval is None:
+        return cond
+
+    try:
+        with _cache_lock:
+            return _cache[hashval]
+    except KeyError:
+        pass
+    except TypeError:
+        # Unhashable query values (e.g. a list passed to test())
+        return _compile(cond)
+
+    # Compiled without holding the lock, a query compiled by two threads
+    # at once is just compiled twice
+    compiled = _compile(cond)
+    with _cache_lock:
+        _cache[hashval] = compiled
+    return compiled
+
+
+def cost(cond):
+    """
+    Estimate the relative cost of checking one element against a query.
+    """
+
+    operands = getattr(cond, 'operands', ())
+    if operands:
+        return sum(cost(operand) for operand in operands)
+
+    hashval = getattr(cond, 'hashval', None)
+    if isinstance(hashval, tuple) and hashval:
+        return COSTS.get(hashval[0], DEFAULT_COST)
+
+    return DEFAULT_COST
+
+
+def _compile(cond):
+    compiler = _Compiler()
+
+    try:
+        return compiler.compile(cond)
+    except (SyntaxError, RuntimeError):  # RuntimeError: nested too deeply
+        return cond
+
+
+def _simplify(cond):
+    """
+    Fold away double negations and duplicate operands.
+    """
+
+    op = _op(cond)
+
+    if op == 'not':
+        operand = cond.operands[0]
+        if _op(operand) == 'not':
+            return _simplify(operand.operands[0])
+
+    if op in ('and', 'or'):
+        left, right = cond.operands
+        if left.hashval == right.hashval:
+            return _simplify(left)
+
+    return cond
+
+
+def _op(cond):
+    hashval = getattr(cond, 'hashval', None)
+    if getattr(cond, 'operands', ()) and isinstance(hashval, tuple):
+        return hashval[0]
+    return None
+
+
+class _Compiler(object):
+    """
+    Generates the source of a compiled query.
+
+    Every part of the query stores its result in ``r``. The parts of an AND
+    (OR) run one after another, each one only if ``r`` is still true
+    (false), so long chains don't nest.
+
+    Checking the parts of an AND in a different order may raise where the
+    original order would have stopped early (e.g. comparing a string with a
+    number), so reordered queries fall back to the original one on errors.
+    """
+
+    def __init__(self):
+        self.lines = []
+        self.namespace = {'_is_sequence': is_sequence, '_any_in': _any_in}
+        self.reordered = False
+
+    def compile(self, cond):
+        self.emit(cond, 1)
+        lines = self.lines
+
+        if self.reordered:
+            lines = (['    try:'] + ['    ' + line for line in lines] +
+                     ['    except Exception:',
+                      '        return {0}(value)'.format(self.const(cond))])
+
+        source = 'def query(value):\n{0}\n    return r\n'.format(
+            '\n'.join(lines))
+
+        exec(compile(source, '<query>', 'exec'), self.namespace)
+        return self.namespace['query']
+
+    def const(self, value):
+        name = '_c{0}'.format(len(self.namespace))
+        self.namespace[name] = value
+        return name
+
+    def line(self, depth, code):
+        self.lines.append('    ' * depth + code)
+
+    def emit(self, cond, depth):
+        cond = _simplify(cond)
+        op = _op(cond)
+
+        if op in ('and', 'or'):
+            parts = self.flatten(cond, op)
+
+            if op == 'and':
+                ordered = sorted(parts, key=cost)
+                if any(a is not b for a, b in zip(ordered, parts)):
+                    self.reordered = True
+                parts = ordered
+
+            self.emit(parts[0], depth)
+            for part in parts[1:]:
+                self.line(depth, 'if r:' if op == 'and' else 'if not r:')
+                self.emit(part, depth + 1)
+
+        elif op == 'not':
+            self.emit(cond.operands[0], depth)
+            self.line(depth, 'r = not r')
+
+        else:
+            self.emit_test(cond, depth)
+
+    def flatten(self, cond, op):
+        parts = []
+        stack = [cond]
+
+        # Without recursion, queries built in a loop nest deeply
+        while stack:
+            part = _simplify(stack.pop())
+            if _op(part) == op:
+                stack.extend(reversed(part.operands))
+            else:
+                parts.append(part)
+
+        return parts
+
+    def emit_test(self, cond, depth):
+        expression = self.expression(cond)
+
+        if expression is None:
+            # Not a query on a field we know, run it as it is
+            self.line(depth, 'r = {0}(value)'.format(self.const(cond)))
+            return
+
+        lookup = ''.join('[{0}]'.format(self.literal(part))
+                         for part in cond.path)
+
+        self.line(depth, 'try:')
+        self.line(depth + 1, 'v = value{0}'.format(lookup))
+        self.line(depth, 'except (KeyError, TypeError):')
+        self.line(depth + 1, 'r = False')
+        self.line(depth, 'else:')
+        self.line(depth + 1, 'r = {0}'.format(expression))
+
+    def literal(self, value):
+        if type(value) in (int, str):
+            return repr(value)
+        return self.const(value)
+
+    def expression(self, cond):
+        """
+        Get the expression testing the field value ``v``, or ``None`` if
+        the query can't be compiled.
+        """
+
+        hashval = getattr(cond, 'hashval', None)
+        if getattr(cond, 'path', None) is None or not isinstance(hashval,
+                                                                 tuple):
+            return None
+
+        op = hashval[0]
+        args = cond.args
+
+        if op == '==' and sys.version_info < (3, 0):
+            # Keep the special unicode handling of Query.__eq__
+            return None
+
+        if op in _COMPARISONS:
+            return 'v {0} {1}'.format(_COMPARISONS[op], self.const(args[0]))
+
+        if op == 'exists':
+            return 'True'
+
+        if op in _REGEXES:
+            method, ignore_case = _REGEXES[op]
+            pattern = self.const(re.compile(args[0]))
+            return '{0}.{1}({2}) is not None'.format(
+                pattern, method, 'v.lower()' if ignore_case else 'v')
+
+        if op == 'test':
+            func, func_args = args
+            return '{0}(v, *{1})'.format(self.const(func),
+                                         self.const(func_args))
+
+        if op in ('any', 'all'):
+            return self.sequence_expression(op, args[0])
+
+        return None
+
+    def sequence_expression(self, op, cond):
+        if callable(cond):
+            test = self.const(compile_query(cond))
+            return '_is_sequence(v) and {0}({1}(e) for e in v)'.format(op,
+                                                                      test)
+
+        if op == 'all':
+            return '_is_sequence(v) and all(e in v for e in {0})'.format(
+                self.const(cond))
+
+        members = self.const(cond)
+        if isinstance(cond, (list, tuple)):
+            try:
+                # Hash lookups instead of scanning the list for each member
+                members = self.const(frozenset(cond))
+                fallback = self.const(cond)
+            except TypeError:
+                pass
+            else:
+                return ('_is_sequence(v) and _any_in({0}, {1}, v)'
+                        .format(members, fallback))
+
+        return '_is_sequence(v) and any(e in {0} for e in v)'.format(members)
+
+
+def _any_in(members, fallback, value):
+    try:
+        return not members.isdisjoint(value)
+    except TypeError:
+        # The value contains unhashable elements
+        return any(e in fallback for e in value)
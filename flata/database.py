@@ -2,8 +2,18 @@
 Contains the :class:`database <flata.database.Flata>` and
 :class:`tables <flata.database.Table>` implementation.
 """
+from contextlib import contextmanager
+from functools import wraps
+from itertools import islice
+import threading
+
 from . import JSONStorage, MemoryStorage
-from .utils import LRUCache, iteritems, itervalues
+from .indexes import INDEX_KINDS
+from .compiler import compile_query
+from .planner import plan
+from .storages import META_KEY, apply_operation, get_meta, set_meta
+from .utils import (LRUCache, NullLock, ReadWriteLock, copy_nested,
+                    iteritems, itervalues)
 
 
 class Element(dict):
@@ -21,7 +31,95 @@ class Element(dict):
             self.id = id
 
 
+class _QueryResult(list):
+    """
+    The cached result of a query, which knows the ids of its elements.
+    """
+
+    def __init__(self, elements):
+        super(_QueryResult, self).__init__(elements)
+        self.ids = set(element.id for element in self)
+
+
+def _reading(method):
+    """
+    Run a table method holding the table's lock for reading.
+    """
+
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._lock.reading():
+            return method(self, *args, **kwargs)
+
+    return wrapper
+
+
+def _writing(method):
+    """
+    Run a table method holding the table's lock for writing, inside a
+    transaction of the storage.
+    """
+
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._lock.writing(), self._storage.transaction():
+            return method(self, *args, **kwargs)
+
+    return wrapper
+
+
+class _LockedStorage(object):
+    """
+    Serializes all calls to a storage, which are shared by the tables and
+    may not be made from several threads at once.
+    """
+
+    def __init__(self, storage):
+        self._storage = storage
+        self._lock = threading.RLock()
+
+    def __getattr__(self, name):
+        attr = getattr(self._storage, name)
+        if not callable(attr):
+            return attr
+
+        if name == 'transaction' and getattr(self._storage, 'locking', False):
+            # Held for the whole transaction, so the storage is always
+            # locked before the file
+            return lambda: self._transaction(attr)
+
+        lock = self._lock
+
+        def locked(*args, **kwargs):
+            with lock:
+                return attr(*args, **kwargs)
+
+        return locked
+
+    @contextmanager
+    def _transaction(self, transaction):
+        with self._lock, transaction():
+            yield
+
+
 class StorageProxy(object):
+    """
+    Gives a table access to its part of the storage.
+
+    The decoded records of the table are kept between reads and updated
+    by the proxy's own writes. They are only read again if the storage
+    reports a change (see :meth:`flata.storages.Storage.stamp`).
+
+    The records aren't copied, they may be shared with the storage. They
+    must never be changed in place; a changed record replaces the old one
+    (see :meth:`Table.process_elements`).
+
+    The proxy also maintains the table's secondary indexes
+    (see :mod:`flata.indexes`) and its metadata: the last id used, the
+    number of elements, the fields seen and the index definitions. The
+    metadata is handed to the storage with every write, so it is persisted
+    together with the change it describes.
+    """
 
     DEFAULT_ID_FIELD = 'id'
 
@@ -30,36 +128,378 @@ class StorageProxy(object):
         self._table_name = table_name
         self._id_field = kwargs.pop('id_field', StorageProxy.DEFAULT_ID_FIELD)
 
+        # Readers holding the table's read lock may refresh the kept
+        # elements at the same time
+        self._refresh_lock = (threading.RLock()
+                              if kwargs.pop('thread_safe', False)
+                              else NullLock())
+
+        self._data = None
+        self._stamp = None
+
+        self._meta = None
+        self._meta_stamp = None
+
+        self._indexes = {}
+        # Index definitions are restored from the metadata on first read
+        self._restored = False
+
+        # The position of each element in the table, only kept while there
+        # are indexes so their results can be returned in table order
+        self._order = None
+        self._next_order = 0
+
+    def transaction(self):
+        """
+        Get a context manager keeping other processes from using the storage
+        until it is left, if the storage supports it.
+        """
+
+        transaction = getattr(self._storage, 'transaction', None)
+        return transaction() if transaction is not None else NullLock()
+
+    def _current_stamp(self):
+        table_stamp = getattr(self._storage, 'table_stamp', None)
+        if table_stamp is not None:
+            return table_stamp(self._table_name)
+
+        stamp = getattr(self._storage, 'stamp', None)
+        return stamp() if stamp is not None else None
+
+    def _read_table(self):
+        read_table = getattr(self._storage, 'read_table', None)
+        if read_table is not None:
+            return read_table(self._table_name)
+
+        return (self._storage.read() or {}).get(self._table_name)
+
+    def _is_fresh(self):
+        """
+        Check whether the kept elements still match the storage.
+        """
+
+        if self._data is None or self._stamp is None:
+            return False
+
+        return self._stamp == self._current_stamp()
+
     def read(self):
+        if self._is_fresh():
+            return self._data
+
+        with self._refresh_lock:
+            if self._is_fresh():
+                return self._data  # Refreshed by another thread meanwhile
+
+            # Taken before reading, so a change made in between is noticed
+            # by the next read
+            stamp = self._current_stamp()
+            raw_data = self._read_table()
+            if raw_data is None:
+                self.write({})
+                return self._data if self._data is not None else {}
+
+            # The records are kept as they come from the storage, they are
+            # only wrapped in elements when returned by the table
+            id_field = self._id_field
+            data = dict((item[id_field], item) for item in raw_data)
+
+            self._data = data
+            self._stamp = stamp
+            self._restore_indexes()
+            self._build_indexes()
+
+            return data
+
+    def meta(self):
+        """
+        Get the metadata of the table, kept between reads like the elements.
+
+        :returns: the metadata, empty if none was stored
+        :rtype: dict
+        """
+
+        stamp = self._current_stamp()
+        if self._meta is None or stamp is None or stamp != self._meta_stamp:
+            read_meta = getattr(self._storage, 'read_meta', None)
+            if read_meta is not None:
+                meta = read_meta(self._table_name)
+            else:
+                meta = get_meta(self._storage.read(), self._table_name)
+
+            self._meta = meta or {}
+            self._meta_stamp = stamp
+
+        return self._meta
+
+    def count(self):
+        """
+        Get the number of elements, from the metadata if the elements
+        aren't kept.
+        """
+
+        if not self._is_fresh():
+            count = self.meta().get('count')
+            if count is not None:
+                return count
+
+        return len(self.read())
+
+    def _next_meta(self, op, payload, last_id):
+        """
+        Get the metadata of the table after an operation.
+        """
+
+        meta = dict(self.meta())
+
+        count = meta.get('count')
+        if op == 'write':
+            meta['count'] = len(payload)
+        elif op != 'update':
+            if count is None:
+                # Stored before the metadata had a count
+                count = len(self.read())
+            meta['count'] = count + (len(payload) if op == 'insert'
+                                     else -len(payload))
+
+        if op != 'remove':
+            fields = set() if op == 'write' else set(meta.get('fields', ()))
+            for item in payload:
+                fields.update(item)
+            # Keys may be of mixed types
+            meta['fields'] = sorted(fields, key=str)
+
+        if last_id is not None:
+            meta['last_id'] = max(last_id, meta.get('last_id', 0))
+
+        meta.pop('indexes', None)
+        if self._indexes:
+            meta['indexes'] = [
+                {'field': list(index.path) if len(index.path) > 1
+                 else index.path[0], 'kind': index.kind}
+                for index in self._indexes.values()]
+
+        return meta
+
+    def _restore_indexes(self):
+        if self._restored:
+            return
+        self._restored = True
+
+        for definition in self.meta().get('indexes', ()):
+            kind = INDEX_KINDS.get(definition.get('kind'))
+            if kind is not None:
+                index = kind(definition['field'])
+                self._indexes.setdefault(index.path, index)
+
+    def iter(self):
+        """
+        Iterate over the records of the table.
+
+        If the elements aren't kept (or are outdated), they are streamed
+        from the storage instead of reading the whole table. Kept elements
+        are iterated over as a snapshot, so the table can be written to
+        during the iteration.
+        """
+
+        if self._is_fresh():
+            return iter(list(itervalues(self._data)))
+
+        iter_table = getattr(self._storage, 'iter_table', None)
+        if iter_table is None:
+            return iter(list(itervalues(self.read())))
+
+        return iter_table(self._table_name)
+
+    def _build_indexes(self):
+        if not self._indexes:
+            self._order = None
+            return
+
+        self._order = dict((id, i) for i, id in enumerate(self._data))
+        self._next_order = len(self._order)
+
+        for index in self._indexes.values():
+            index.build(self._data)
+
+    def create_index(self, field, kind='hash'):
+        """
+        Create (or replace) the index on a field.
+
+        :param field: the field name or path to index
+        :param kind: ``hash`` or ``sorted``
+        """
+
         try:
-            raw_data = (self._storage.read() or {})[self._table_name]
+            index = INDEX_KINDS[kind](field)
         except KeyError:
-            self.write({})
-            return {}
+            raise ValueError('Unknown index kind: {0}'.format(kind))
 
-        data = {}
-        # for key, val in iteritems(raw_data):
-        #     id = int(key)
-        #     data[id] = Element(val, id)
+        data = self.read()
+        existing = self._indexes.get(index.path)
+        if existing is not None and existing.kind == index.kind:
+            return existing  # E.g. restored from the metadata
 
-        for item in raw_data:
-             id = item[self._id_field]
-             data[id] = Element(item, id)
+        if self._order is None:
+            self._order = dict((id, i) for i, id in enumerate(data))
+            self._next_order = len(self._order)
 
-        return data
+        index.build(data)
+        self._indexes[index.path] = index
+        self._save_meta()
+
+        return index
+
+    def drop_index(self, field):
+        """
+        Remove the index on a field.
+
+        :param field: the field name or path of the index
+        """
+
+        path = tuple(field) if isinstance(field, (list, tuple)) else (field,)
+        del self._indexes[path]
+
+        if not self._indexes:
+            self._order = None
+
+        self._save_meta()
+
+    def _save_meta(self):
+        """
+        Persist the metadata without changing any element.
+        """
+
+        self.read()
+        self.apply('update', [])
+
+    @property
+    def indexes(self):
+        return self._indexes
+
+    def lookup(self, op, path, value):
+        """
+        Get the ids of all elements that may match a query operation,
+        using the index on ``path``.
+
+        :returns: a set of ids or ``None`` if no index can answer the query
+        """
+
+        index = self._indexes.get(path)
+        if index is None:
+            return None
+
+        return index.lookup(op, value)
+
+    def sort(self, ids):
+        """
+        Sort element ids into the order of the table.
+        """
+
+        return sorted(ids, key=self._order.__getitem__)
 
     def write(self, values):
+        self.apply('write', values)
+
+    def apply(self, op, payload, last_id=None):
+        """
+        Persist a single operation on the table.
+
+        :param op: ``insert``, ``update``, ``remove`` or ``write``
+        :param payload: the records or ids affected by the operation
+        :param last_id: the last id used in the table, stored in its
+                        metadata
+        :returns: whether the operation was the only change to the table
+                  since it was last read
+        """
+
+        meta = self._next_meta(op, payload, last_id)
+        fresh = self._is_fresh()
+
+        try:
+            self._persist(op, payload, meta)
+        except Exception:
+            # The kept elements may already contain the failed change
+            self._data = None
+            self._meta = None
+            raise
+
+        self._meta = meta
+        self._meta_stamp = self._current_stamp()
+
+        if fresh or op == 'write':
+            self._apply(op, payload)
+            self._stamp = self._current_stamp()
+        else:
+            self._data = None
+
+        return fresh
+
+    def _persist(self, op, payload, meta):
+        append = getattr(self._storage, 'append', None)
+        if append is not None:
+            append(self._table_name, op, payload, self._id_field, meta)
+            return
+
+        # Plain storages only know how to read and write everything
         data = self._storage.read() or {}
-        data[self._table_name] = values
+        data[self._table_name] = apply_operation(
+            data.get(self._table_name), op, payload, self._id_field)
+        set_meta(data, self._table_name, meta)
         self._storage.write(data)
 
+    def _apply(self, op, payload):
+        """
+        Apply a persisted operation to the kept elements.
+        """
+
+        if op == 'write':
+            self._data = {}
+            op = 'insert'
+
+            for index in self._indexes.values():
+                index.clear()
+            if self._order is not None:
+                self._order = {}
+
+        data = self._data
+        id_field = self._id_field
+        indexes = self._indexes.values()
+        order = self._order
+
+        if op == 'remove':
+            for id in payload:
+                data.pop(id, None)
+                for index in indexes:
+                    index.discard(id)
+                if order is not None:
+                    order.pop(id, None)
+            return
+
+        for item in payload:
+            # Copied by the table before it was written, so the caller
+            # holds no part of it
+            id = item[id_field]
+            data[id] = item
+
+            for index in indexes:
+                index.discard(id)
+                index.add(id, data[id])
+
+            if order is not None and id not in order:
+                order[id] = self._next_order
+                self._next_order += 1
+
     def purge_table(self):
-        try:
-            data = self._storage.read() or {}
+        drop_table = getattr(self._storage, 'drop_table', None)
+        if drop_table is not None:
+            drop_table(self._table_name)
+            return
+
+        data = self._storage.read() or {}
+        if self._table_name in data:
             del data[self._table_name]
             self._storage.write(data)
-        except KeyError:
-            pass
 
     @property
     def table_name(self):
@@ -97,10 +537,13 @@ class Flata(object):
                         with ``args`` and ``kwargs``.
         :param cache: The class of the CachingMiddleware to use. If it is not
                         not null, it will be used as storage.    
+        :param thread_safe: Allow the database to be used from several
+                            threads at once, see :class:`Table`.
         """
 
         storage = kwargs.pop('storage', Flata.DEFAULT_STORAGE)
         cache = kwargs.pop('cache', None)
+        self._thread_safe = kwargs.pop('thread_safe', False)
         # table = kwargs.pop('default_table', Flata.DEFAULT_TABLE)
 
         # Prepare the storage
@@ -109,6 +552,9 @@ class Flata(object):
         #: :type: Storage
         self._storage =  cache if cache else storage(*args, **kwargs)
         # if storage == MemoryStorage else 
+        if self._thread_safe and not getattr(self._storage, 'thread_safe',
+                                             False):
+            self._storage = _LockedStorage(self._storage)
 
         self._opened = True
 
@@ -128,6 +574,8 @@ class Flata(object):
         :type name: str
         :param id: Customize the object id field.
         :param cache_size: How many query results to cache.
+        :param cache_rows: How many elements to keep in all cached query
+                           results together.
 
         """
 
@@ -137,14 +585,15 @@ class Flata(object):
         if name in self._tables:
             return self._tables[name]
 
+        options.setdefault('thread_safe', self._thread_safe)
+
+        # Nothing is read until the table is used, the first read creates
+        # the table in the storage if necessary
         table = self.table_class(StorageProxy(self._storage, name, **options), **options)
 
         self._tables[name] = table
         self._table = table
 
-        # table._read will create an empty table in the storage, if necessary
-        table._read()
-
         return table
 
     def get(self, name):
@@ -162,7 +611,14 @@ class Flata(object):
         :rtype: set[str]
         """
 
-        return set(self._storage.read())
+        table_names = getattr(self._storage, 'table_names', None)
+        if table_names is not None:
+            names = table_names()
+        else:
+            names = set(self._storage.read() or {}) - set([META_KEY])
+
+        # Including the tables which weren't used yet
+        return names | set(self._tables)
 
     def all(self):
         """
@@ -172,7 +628,9 @@ class Flata(object):
         :rtype: list[Element]
         """
 
-        return  self._storage.read()
+        data = dict(self._storage.read() or {})
+        data.pop(META_KEY, None)
+        return data
 
     def purge_tables(self):
         """
@@ -240,28 +698,64 @@ class Flata(object):
 class Table(object):
     """
     Represents a single Flata Table.
+
+    A thread safe table has a readers-writer lock: any number of threads
+    may search it at once, while inserts, updates and removals have it to
+    themselves. IDs are reserved while holding the lock, so no two threads
+    get the same one.
     """
 
-    def __init__(self, storage, cache_size=10, **kwargs):
+    def __init__(self, storage, cache_size=10, cache_rows=None,
+                 thread_safe=False, **kwargs):
         """
         Get access to a table.
 
         :param storage: Access to the storage
         :type storage: StorageProxyus
         :param cache_size: Maximum size of query cache.
+        :param cache_rows: Maximum number of elements in all cached query
+                           results together or ``None`` for no limit.
+        :param thread_safe: Allow the table to be used from several threads
+                            at once.
         """
 
         self._storage = storage
         self._table_name = storage.table_name
         self._id_field = storage.id_field
-        self._query_cache = LRUCache(capacity=cache_size)
+        self._query_cache = LRUCache(capacity=cache_size,
+                                     max_weight=cache_rows)
 
-        data = self._read()
-        if data:
-            self._last_id = max(i for i in data)
+        if thread_safe:
+            self._lock = ReadWriteLock()
+            # Readers share the query cache
+            self._cache_lock = threading.Lock()
         else:
-            self._last_id = 0
+            self._lock = self._cache_lock = NullLock()
+
+        # Only known once the table is read, see _last_id
+        self._known_last_id = None
+
+    @property
+    def _last_id(self):
+        """
+        The last ID used in the table, taken from the table's metadata on
+        first access. Tables stored without it are scanned instead.
+        """
+
+        if self._known_last_id is None:
+            last_id = self._storage.meta().get('last_id')
+            if last_id is None:
+                data = self._read()
+                last_id = max(data) if data else 0
+            self._known_last_id = last_id
+
+        return self._known_last_id
 
+    @_last_id.setter
+    def _last_id(self, value):
+        self._known_last_id = value
+
+    @_writing
     def process_elements(self, func, cond=None, ids=None):
         """
         Helper function for processing all elements specified by condition
@@ -271,13 +765,17 @@ class Table(object):
         that match a condition or are specified by their ID. This is
         implemented in this function.
         The function passed as ``func`` has to be a callable. It's first
-        argument will be the data currently in the database. It's second
+        argument will be a dict mapping the IDs of the processed elements
+        to copies of them, which ``func`` may change or remove. It's second
         argument is the element ID of the currently processed element.
 
+        The copies only replace the elements once they are written, so if
+        anything fails, the table is left unchanged.
+
         See: :meth:`~.update`, :meth:`.remove`
 
         :param func: the function to execute on every included element.
-                     first argument: all data
+                     first argument: the processed elements
                      second argument: the current id
         :param cond: elements to use, or
         :param ids: elements to use
@@ -285,33 +783,130 @@ class Table(object):
         """
 
         data = self._read()
-        updated_data = []
+        changed = {}
+        removed = set()
+        processed = []
+
+        def process(id):
+            # The kept record may be shared with the storage, so ``func``
+            # changes a copy
+            if id not in changed and id not in removed:
+                processed.append(id)
+                if id in data:
+                    changed[id] = copy_nested(data[id])
+            func(changed, id)
+
+            if id not in changed:
+                removed.add(id)
 
         if ids is not None:
             # Processed element specified by id
             for id in ids:
-                func(data, id)
-                if id in data:
-                    updated_data.append(data[id])
+                process(id)
 
         else:
             # Collect affected ids
             ids = []
+            id_field = self._id_field
 
             # Processed elements specified by condition
-            for id in list(data):
-                if cond(data[id]):
-                    func(data, id)
+            candidates, test = self._candidates(cond)
+            for id in [record[id_field] for record in candidates]:
+                if test(data[id]):
+                    process(id)
                     ids.append(id)
-                    if id in data:
-                        updated_data.append(data[id])
 
-        
-        new_data = list(data.values())
+        updated_data = []
+        removed_ids = []
+        for id in processed:
+            if id in changed:
+                updated_data.append(changed[id])
+            else:
+                removed_ids.append(id)
+
+        # Only the affected elements are handed to the storage
+        if removed_ids:
+            self._write(removed_ids, op='remove')
+        if updated_data:
+            self._write(updated_data, op='update')
+
+        return ids, [self._element(record) for record in updated_data]
+
+    def _element(self, record):
+        """
+        Copy a kept record into an element, which the caller may change
+        (including the dicts and lists nested in it).
+        """
 
-        self._write(new_data)
+        element = Element(record, record[self._id_field])
+        for key, value in iteritems(record):
+            if isinstance(value, (dict, list)):
+                element[key] = copy_nested(value)
 
-        return ids, updated_data
+        return element
+
+    @_writing
+    def create_index(self, field, kind='hash'):
+        """
+        Create an index on a field, which queries on that field will use.
+
+        Hash indexes answer ``==`` and ``any([...])`` queries, sorted indexes
+        answer ``==``, ``<``, ``<=``, ``>`` and ``>=`` queries. Indexes are
+        kept up to date by all writes to the table and never change the
+        result of a query, including the errors raised by comparing values
+        of different types.
+
+        >>> table.create_index('name')
+        >>> table.create_index('age', kind='sorted')
+        >>> table.search(where('age') >= 18)  # Uses the sorted index
+
+        :param field: the field to index, a list of names for nested fields
+        :param kind: ``hash`` or ``sorted``
+        """
+
+        self._storage.create_index(field, kind)
+
+    @_writing
+    def drop_index(self, field):
+        """
+        Remove the index on a field.
+
+        :param field: the indexed field
+        """
+
+        self._storage.drop_index(field)
+
+    @_reading
+    def explain(self, cond):
+        """
+        Show how a query would be run on the table.
+
+        >>> table.explain(where('name') == 'John')
+        Filter(('==', ('name',), 'John'), source=IndexScan(hash index on name: == 'John', rows=1))
+
+        :param cond: the query to plan
+        :rtype: flata.planner.Filter
+        """
+
+        return plan(cond, self._storage)
+
+    def _candidates(self, cond):
+        """
+        Get the elements which may match a condition, and the test to check
+        them with.
+
+        Uses the table's indexes if the query allows it, otherwise all
+        elements are candidates.
+        """
+
+        query_plan = plan(cond, self._storage)
+        data = self._read()
+        ids = query_plan.ids()
+
+        if ids is None:
+            return itervalues(data), query_plan.test
+
+        return (data[id] for id in self._storage.sort(ids)), query_plan.test
 
     def clear_cache(self):
         """
@@ -319,17 +914,28 @@ class Table(object):
 
         A simple helper that clears the internal query cache.
         """
-        self._query_cache.clear()
+        with self._cache_lock:
+            self._query_cache.clear()
 
     def _get_next_id(self):
         """
         Increment the ID used the last time and return it
         """
 
-        current_id = self._last_id + 1
-        self._last_id = current_id
+        return self._reserve_ids(1)
+
+    @_writing
+    def _reserve_ids(self, count):
+        """
+        Reserve a number of consecutive IDs and return the first one.
+        """
+
+        # Another table object (or process) may have used more ids since
+        first_id = max(self._last_id,
+                       self._storage.meta().get('last_id', 0)) + 1
+        self._last_id = first_id + count - 1
 
-        return current_id
+        return first_id
 
     def _read(self):
         """
@@ -341,23 +947,104 @@ class Table(object):
 
         return self._storage.read()
 
-    def _write(self, values):
+    def _write(self, values, op='write'):
         """
         Writing access to the DB.
 
-        :param values: the new values to write
-        :type values: dict
+        :param values: the new values to write, or the elements/ids affected
+                       by ``op``
+        :type values: list
+        :param op: the operation to persist (``write``, ``insert``,
+                   ``update`` or ``remove``)
+        """
+
+        fresh = self._storage.apply(op, values, self._known_last_id)
+
+        with self._cache_lock:
+            if fresh and op != 'write':
+                self._update_query_cache(op, values)
+            else:
+                self._query_cache.clear()
+
+    def _update_query_cache(self, op, values):
         """
+        Bring the cached query results up to date with a write.
 
-        self._query_cache.clear()
-        self._storage.write(values)
+        Only the written elements are checked against the cached queries.
+        Results holding none of them and matching no new one are left as
+        they are, the others are changed in place. Results an updated
+        element newly matches are dropped, as the element's position in
+        them isn't known.
 
+        :param op: ``insert``, ``update`` or ``remove``
+        :param values: the elements or ids written
+        """
+
+        cache = self._query_cache
+        if not cache:
+            return
+
+        id_field = self._id_field
+        if op == 'remove':
+            changed = []
+            touched = set(values)
+        else:
+            data = self._read()
+            changed = [data[value[id_field]] for value in values]
+            touched = set(record[id_field] for record in changed)
+
+        for cond in cache.lru:
+            results = cache.peek(cond)
+            if results is None:
+                continue  # Evicted by a result grown before
+
+            try:
+                test = compile_query(cond)
+                matched = [record for record in changed if test(record)]
+            except Exception:
+                del cache[cond]
+                continue
+
+            hit = not results.ids.isdisjoint(touched)
+            new = [record for record in matched
+                   if record[id_field] not in results.ids]
+
+            if not hit and not new:
+                continue
+
+            if new and op != 'insert':
+                del cache[cond]
+                continue
+
+            if hit:
+                matched_ids = dict((record[id_field], record)
+                                   for record in matched)
+                kept = []
+
+                for element in results:
+                    if element.id in touched:
+                        record = matched_ids.get(element.id)
+                        if record is None:
+                            continue  # Removed or doesn't match anymore
+                        element = self._element(record)
+                    kept.append(element)
+
+                results[:] = kept
+                results.ids.difference_update(touched - set(matched_ids))
+
+            # Inserted elements are added to the end of the table
+            results.extend(self._element(record) for record in new)
+            results.ids.update(record[id_field] for record in new)
+            cache.reweigh(cond)
+
+    @_reading
     def __len__(self):
         """
         Get the total number of elements in the table.
         """
-        return len(self._read())
+        return self._storage.count()
 
+    @_reading
     def all(self):
         """
         Get all elements stored in the table.
@@ -366,7 +1053,7 @@ class Table(object):
         :rtype: list[Element]
         """
 
-        return  list(itervalues(self._read()))
+        return [self._element(record) for record in itervalues(self._read())]
 
     def __iter__(self):
         """
@@ -376,9 +1063,15 @@ class Table(object):
         :rtype: listiterator[Element]
         """
 
-        for value in itervalues(self._read()):
-            yield value
+        # Only getting the records holds the lock, so the loop may write to
+        # the table. Streamed records come from a snapshot of the storage.
+        with self._lock.reading():
+            records = self._storage.iter()
+
+        for record in records:
+            yield self._element(record)
 
+    @_writing
     def insert(self, element):
         """
         Insert a new element into the table.
@@ -395,42 +1088,79 @@ class Table(object):
         if not isinstance(element, dict):
             raise ValueError('Element is not a dictionary')
 
-        data = self._read()
-
-        items = list(data.values())
         element[self._id_field] = id
-        items.append(element)
 
-        self._write(items)
+        self._write([copy_nested(element)], op='insert')
 
         return element
 
-    def insert_multiple(self, elements):
+    @_writing
+    def insert_multiple(self, elements, chunk_size=None, callback=None,
+                        return_elements=True):
         """
         Insert multiple elements into the table.
 
-        :param elements: a list of elements to insert
-        :returns: a list containing the inserted elements with IDs
+        The elements may come from any iterable. They are written in chunks
+        of ``chunk_size`` elements, one storage write per chunk, so a
+        generator doesn't have to be turned into a list first:
+
+        >>> table.insert_multiple(({'i': i} for i in range(10 ** 6)),
+        ...                       chunk_size=10000)
+
+        Note that storages without support for appending (e.g.
+        :class:`~flata.storages.JSONStorage`) rewrite the whole table for
+        every chunk.
+
+        With ``return_elements=False`` the inserted elements aren't
+        collected, so only one chunk is held in memory at a time.
+
+        :param elements: an iterable of elements to insert
+        :param chunk_size: how many elements to write at once or ``None`` to
+                           write all elements at once
+        :param callback: a function called with the number of elements
+                         inserted so far after every chunk
+        :param return_elements: return the inserted elements instead of
+                                their number
+        :returns: a list containing the inserted elements with IDs, or the
+                  number of inserted elements
         """
         if not isinstance(self, Table):
             raise ValueError('Only table instance can support insert action.')
 
-        ids = []
-        data = self._read()
-        items = list(data.values())
+        if chunk_size is not None and chunk_size < 1:
+            raise ValueError('Chunk size must be at least 1.')
+
+        elements = iter(elements)
+        inserted = []
+        count = 0
+
+        while True:
+            chunk = list(islice(elements, chunk_size))
+            if not chunk:
+                break
+
+            for element in chunk:
+                if not isinstance(element, dict):
+                    raise ValueError('Element is not a dictionary')
+
+            # Reserve the ids of the whole chunk at once
+            first_id = self._reserve_ids(len(chunk))
 
-        for element in elements:
-            id = self._get_next_id()
-            ids.append(id)
-            element[self._id_field] = id
-            items.append(element)
+            for id, element in enumerate(chunk, first_id):
+                element[self._id_field] = id
 
-            # data[id] = element
+            self._write([copy_nested(element) for element in chunk],
+                        op='insert')
+            count += len(chunk)
+            if return_elements:
+                inserted.extend(chunk)
 
-        self._write(items)
+            if callback is not None:
+                callback(count)
 
-        return elements
+        return inserted if return_elements else count
 
+    @_writing
     def remove(self, cond=None, ids=None):
         """
         Remove all matching elements.
@@ -445,6 +1175,7 @@ class Table(object):
         return self.process_elements(lambda data, id: data.pop(id),
                                      cond, ids)
 
+    @_writing
     def update(self, fields, cond=None, ids=None):
         """
         Update all matching elements to have a given set of fields.
@@ -460,24 +1191,32 @@ class Table(object):
         """
 
         if callable(fields):
-            return self.process_elements(
-                lambda data, id: fields(data[id]),
-                cond, ids
-            )
+            def transform(data, id):
+                # Given an element, so ``fields`` can use its id
+                element = Element(data[id], id)
+                fields(element)
+                data[id] = copy_nested(element)
+
+            return self.process_elements(transform, cond, ids)
         else:
             return self.process_elements(
-                lambda data, id: data[id].update(fields),
+                lambda data, id: data[id].update(copy_nested(fields)),
                 cond, ids
             )
 
+    @_writing
     def purge(self):
         """
         Purge the table by removing all elements.
+
+        IDs aren't reused, new elements continue after the last ID used
+        before.
         """
 
+        self._last_id  # Resolved first, so it is kept in the metadata
         self._write({})
-        self._last_id = 0
 
+    @_reading
     def search(self, cond):
         """
         Search for all elements matching a 'where' cond.
@@ -489,14 +1228,21 @@ class Table(object):
         :rtype: list[Element]
         """
 
-        if cond in self._query_cache:
-            return self._query_cache[cond][:]
+        with self._cache_lock:
+            cached = self._query_cache.get(cond)
+        if cached is not None:
+            return cached[:]
+
+        candidates, test = self._candidates(cond)
+        elements = _QueryResult(self._element(record)
+                                for record in candidates if test(record))
 
-        elements = [element for element in self.all() if cond(element)]
-        self._query_cache[cond] = elements
+        with self._cache_lock:
+            self._query_cache[cond] = elements
 
         return elements[:]
 
+    @_reading
     def get(self, cond=None, id=None):
         """
         Get exactly one element specified by a query or and ID.
@@ -517,13 +1263,16 @@ class Table(object):
 
         if id is not None:
             # Element specified by ID
-            return self._read().get(id, None)
+            element = self._read().get(id, None)
+            return self._element(element) if element is not None else None
 
         # Element specified by condition
-        for element in self.all():
-            if cond(element):
-                return element
+        candidates, test = self._candidates(cond)
+        for record in candidates:
+            if test(record):
+                return self._element(record)
 
+    @_reading
     def count(self, cond):
         """
         Count the elements matching a condition.
@@ -534,6 +1283,7 @@ class Table(object):
 
         return len(self.search(cond))
 
+    @_reading
     def contains(self, cond=None, ids=None):
         """
         Check wether the database contains an element matching a condition or
@@ -549,7 +1299,8 @@ class Table(object):
 
         if ids is not None:
             # Elements specified by ID
-            return any(self.get(id=id) for id in ids)
+            data = self._read()
+            return any(id in data for id in ids)
 
         # Element specified by condition
         return self.get(cond) is not None
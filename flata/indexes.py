@@ -0,0 +1,379 @@
+"""
+Contains the secondary :class:`indexes <flata.indexes.Index>` a table can
+keep on the fields of its elements.
+
+An index maps the value of a field to the ids of the elements holding it.
+Lookups return candidate ids: every matching element is among them, but
+the query still has to be checked against each candidate.
+"""
+
+from bisect import bisect_left, bisect_right
+import numbers
+from operator import itemgetter
+
+from .utils import freeze
+
+try:
+    string_types = basestring  # noqa, Python 2
+except NameError:
+    string_types = str
+
+__all__ = ('HashIndex', 'SortedIndex')
+
+# Marks a field that isn't present in an element
+_MISSING = object()
+
+
+def resolve(element, path):
+    """
+    Get the value at ``path`` in an element the same way queries do.
+    """
+
+    try:
+        for part in path:
+            element = element[part]
+    except (KeyError, TypeError):
+        return _MISSING
+
+    return element
+
+
+def _normalize_path(field):
+    if isinstance(field, (list, tuple)):
+        return tuple(field)
+    return (field,)
+
+
+class Index(object):
+    """
+    The base class for all indexes.
+    """
+
+    #: The name used to create this kind of index
+    kind = None
+
+    #: The query operations the index can answer
+    operations = ()
+
+    def __init__(self, field):
+        """
+        :param field: The field to index, either a name or a path of names
+                      (like ``Query().a.b`` uses)
+        """
+
+        self.path = _normalize_path(field)
+
+    def build(self, data):
+        """
+        Index all elements of a table.
+
+        :param data: The elements by their id.
+        """
+
+        self.clear()
+        for id, element in data.items():
+            self.add(id, element)
+
+    def __len__(self):
+        """
+        Get the number of indexed elements.
+        """
+
+        raise NotImplementedError('To be overridden!')
+
+    def clear(self):
+        raise NotImplementedError('To be overridden!')
+
+    def add(self, id, element):
+        raise NotImplementedError('To be overridden!')
+
+    def discard(self, id):
+        raise NotImplementedError('To be overridden!')
+
+    def lookup(self, op, value):
+        """
+        Get the ids of all elements that may match a query operation.
+
+        :param op: The query operation (e.g. ``==``)
+        :param value: The value of the query as stored in its hash.
+        :returns: a set of ids or ``None`` if the operation can't be answered
+        """
+
+        raise NotImplementedError('To be overridden!')
+
+    def estimate(self, op, value):
+        """
+        Get (an upper bound of) the number of ids :meth:`lookup` returns,
+        without collecting them.
+
+        :returns: the number of ids or ``None`` if the operation can't be
+                  answered
+        """
+
+        raise NotImplementedError('To be overridden!')
+
+
+class HashIndex(Index):
+    """
+    Index the values of a field in a hash map.
+
+    Answers equality (``==``) and, for list fields, membership
+    (``any([...])``) queries.
+    """
+
+    kind = 'hash'
+    operations = ('==', 'any')
+
+    def __init__(self, field):
+        super(HashIndex, self).__init__(field)
+        self.clear()
+
+    def __len__(self):
+        return len(self._keys)
+
+    def clear(self):
+        self._values = {}  # value -> ids
+        self._members = {}  # list member -> ids
+        self._keys = {}  # id -> (value, members)
+
+        # Elements whose value can't be hashed or which are iterable
+        # without being a list (strings, dicts) can match a membership
+        # query in ways the index doesn't track, so they're always
+        # candidates
+        self._unhashable = set()
+        self._iterables = set()
+
+    def add(self, id, element):
+        value = resolve(element, self.path)
+        if value is _MISSING:
+            self._keys[id] = (_MISSING, ())
+            return
+
+        try:
+            key = freeze(value)
+            hash(key)
+        except TypeError:
+            self._unhashable.add(id)
+            self._keys[id] = (_MISSING, ())
+            return
+
+        members = ()
+        if isinstance(value, list):
+            try:
+                members = set(freeze(member) for member in value)
+            except TypeError:
+                self._unhashable.add(id)
+                members = ()
+        elif hasattr(value, '__iter__'):
+            self._iterables.add(id)
+
+        self._values.setdefault(key, set()).add(id)
+        for member in members:
+            self._members.setdefault(member, set()).add(id)
+
+        self._keys[id] = (key, members)
+
+    def discard(self, id):
+        key, members = self._keys.pop(id, (_MISSING, ()))
+        self._unhashable.discard(id)
+        self._iterables.discard(id)
+
+        if key is not _MISSING:
+            _discard(self._values, key, id)
+        for member in members:
+            _discard(self._members, member, id)
+
+    def lookup(self, op, value):
+        try:
+            if op == '==':
+                ids = set(self._values.get(value, ()))
+
+            elif op == 'any' and isinstance(value, tuple):
+                ids = set(self._iterables)
+                for member in value:
+                    ids.update(self._members.get(member, ()))
+
+            else:
+                return None
+        except TypeError:
+            # The query value isn't hashable
+            return None
+
+        ids.update(self._unhashable)
+        return ids
+
+    def estimate(self, op, value):
+        try:
+            if op == '==':
+                count = len(self._values.get(value, ()))
+
+            elif op == 'any' and isinstance(value, tuple):
+                count = len(self._iterables) + sum(
+                    len(self._members.get(member, ())) for member in value)
+
+            else:
+                return None
+        except TypeError:
+            return None
+
+        return count + len(self._unhashable)
+
+
+class SortedIndex(Index):
+    """
+    Keep the values of a field in sorted order.
+
+    Answers equality (``==``) and range (``<``, ``<=``, ``>``, ``>=``)
+    queries on numbers and strings.
+
+    Values that can't be ordered together with the queried value (strings
+    for a number, ``None``, lists, ...) are candidates of every range
+    query, so checking the query on them fails or not just like a full
+    scan of the table does.
+    """
+
+    kind = 'sorted'
+    operations = ('==', '<', '<=', '>', '>=')
+
+    def __init__(self, field):
+        super(SortedIndex, self).__init__(field)
+        self.clear()
+
+    def __len__(self):
+        return len(self._keys)
+
+    def clear(self):
+        # Numbers and strings can't be compared with each other, so they
+        # are kept in separate sorted lists of (values, ids)
+        self._sorted = {}
+        self._keys = {}  # id -> value
+        self._others = set()  # The ids of values without a family
+
+    def build(self, data):
+        # Sorted once instead of inserting every element in place; the sort
+        # is stable, so equal values keep the order of the table like
+        # :meth:`add` keeps them
+        self.clear()
+
+        entries = {}
+        for id, element in data.items():
+            value = resolve(element, self.path)
+            family = _family(value)
+            if family is not None:
+                entries.setdefault(family, []).append((value, id))
+                self._keys[id] = value
+            elif value is not _MISSING:
+                self._others.add(id)
+
+        for family, pairs in entries.items():
+            pairs.sort(key=itemgetter(0))
+            self._sorted[family] = ([value for value, _ in pairs],
+                                    [id for _, id in pairs])
+
+    def add(self, id, element):
+        value = resolve(element, self.path)
+        family = _family(value)
+        if family is None:
+            if value is not _MISSING:
+                self._others.add(id)
+            return
+
+        values, ids = self._sorted.setdefault(family, ([], []))
+        pos = bisect_right(values, value)
+        values.insert(pos, value)
+        ids.insert(pos, id)
+        self._keys[id] = value
+
+    def discard(self, id):
+        value = self._keys.pop(id, _MISSING)
+        if value is _MISSING:
+            self._others.discard(id)
+            return
+
+        values, ids = self._sorted[_family(value)]
+        pos = bisect_left(values, value)
+        while ids[pos] != id:
+            pos += 1
+
+        del values[pos]
+        del ids[pos]
+
+    def lookup(self, op, value):
+        bounds = self._bounds(op, value)
+        if bounds is None:
+            return None
+
+        family = _family(value)
+        ids = self._sorted.get(family, ((), ()))[1]
+        result = set(ids[bounds[0]:bounds[1]])
+
+        if op != '==':
+            result.update(self._others)
+            for other, (_, ids) in self._sorted.items():
+                if other != family:
+                    result.update(ids)
+
+        return result
+
+    def estimate(self, op, value):
+        bounds = self._bounds(op, value)
+        if bounds is None:
+            return None
+
+        rows = bounds[1] - bounds[0]
+
+        if op != '==':
+            family = _family(value)
+            rows += len(self._others)
+            rows += sum(len(ids) for other, (_, ids) in self._sorted.items()
+                        if other != family)
+
+        return rows
+
+    def _bounds(self, op, value):
+        """
+        Get the slice of the sorted values matching a query operation.
+        """
+
+        family = _family(value)
+        if op not in self.operations or family is None:
+            return None
+
+        values = self._sorted.get(family, ((), ()))[0]
+
+        if op == '==':
+            start, end = bisect_left(values, value), bisect_right(values, value)
+        elif op == '<':
+            start, end = 0, bisect_left(values, value)
+        elif op == '<=':
+            start, end = 0, bisect_right(values, value)
+        elif op == '>':
+            start, end = bisect_right(values, value), len(values)
+        else:
+            start, end = bisect_left(values, value), len(values)
+
+        return start, end
+
+
+def _family(value):
+    """
+    Get the group of mutually comparable values a value belongs to.
+    """
+
+    if isinstance(value, numbers.Real) and value == value:  # Skip NaN
+        return 'number'
+    if isinstance(value, string_types):
+        return 'string'
+    return None
+
+
+def _discard(mapping, key, id):
+    ids = mapping.get(key)
+    if ids is not None:
+        ids.discard(id)
+        if not ids:
+            del mapping[key]
+
+
+#: The index classes by their kind
+INDEX_KINDS = dict((cls.kind, cls) for cls in (HashIndex, SortedIndex))
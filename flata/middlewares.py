@@ -2,7 +2,14 @@
 Contains the :class:`base class <flata.middlewares.Middleware>` for
 middlewares and implementations.
 """
+from collections import OrderedDict
+import json
+import threading
+import time
+
 from .database import Flata
+from .storages import (META_KEY, apply_indexed, apply_operation, get_meta,
+                       set_meta)
 
 
 class Middleware(object):
@@ -18,6 +25,9 @@ class Middleware(object):
     example).
     """
 
+    #: Whether the middleware may be used from several threads at once
+    thread_safe = False
+
     def __init__(self, storage_cls=Flata.DEFAULT_STORAGE):
         self._storage_cls = storage_cls
         self.storage = None
@@ -64,6 +74,47 @@ class Middleware(object):
 
         return self
 
+    def append(self, table, op, payload, id_field='id', meta=None):
+        """
+        Persist a single operation on a table.
+
+        Goes through the middleware's own ``read``/``write`` so the
+        operation never bypasses the middleware and reaches the underlying
+        storage directly.
+        """
+
+        data = self.read() or {}
+        data[table] = apply_operation(data.get(table), op, payload, id_field)
+        set_meta(data, table, meta)
+        self.write(data)
+
+    # The table methods of the storage also go through read/write
+
+    def read_table(self, table):
+        return (self.read() or {}).get(table)
+
+    def write_table(self, table, rows, meta=None):
+        self.append(table, 'write', rows, meta=meta)
+
+    def read_meta(self, table):
+        return get_meta(self.read(), table)
+
+    def drop_table(self, table):
+        data = self.read() or {}
+        if table in data:
+            del data[table]
+            (data.get(META_KEY) or {}).pop(table, None)
+            self.write(data)
+
+    def table_names(self):
+        return set(self.read() or {}) - set([META_KEY])
+
+    def iter_table(self, table):
+        return iter(list(self.read_table(table) or []))
+
+    def table_stamp(self, table):
+        return self.stamp()
+
     def __getattr__(self, name):
         """
         Forward all unknown attribute calls to the underlying storage so we
@@ -78,39 +129,586 @@ class CachingMiddleware(Middleware):
     Add some caching to Flata.
 
     This Middleware aims to improve the performance of Flata by writing only
-    the last DB state every :attr:`WRITE_CACHE_SIZE` time and reading always
-    from cache.
+    the last DB state from time to time and reading always from cache.
+
+    When the cache is written (flushed) is decided per instance, by any
+    combination of:
+
+    - the number of writes since the last flush (``write_cache_size``),
+    - the time since the first unflushed write (``flush_interval``),
+    - the size of the unflushed changes (``max_dirty_bytes``), estimated
+      as the length of their JSON encoding. Writes of the whole database
+      aren't estimated, encoding it would cost as much as flushing it.
+
+    With ``background=True`` a thread flushes the cache once its changes
+    are ``flush_interval`` seconds old, so writes never wait for the time
+    policy. An error of the background flush is raised by the next write
+    or flush.
+
+    >>> storage = CachingMiddleware(JSONStorage, flush_interval=0.05,
+    ...                             background=True)
+
+    The cache remembers which tables were changed. If the storage can write
+    single tables cheaply (see
+    :attr:`flata.storages.Storage.partial_writes`), a flush only writes
+    those.
+
+    While the cache holds no unwritten changes, changes made to the storage
+    by other processes are picked up (see
+    :meth:`flata.storages.Storage.stamp`).
     """
 
     #: The number of write operations to cache before writing to disc
     WRITE_CACHE_SIZE = 1000
 
-    def __init__(self, storage_cls=Flata.DEFAULT_STORAGE):
+    #: The seconds after which cached writes are written to disc
+    FLUSH_INTERVAL = None
+
+    #: The estimated size of cached writes after which they are written to
+    #: disc
+    MAX_DIRTY_BYTES = None
+
+    @property
+    def thread_safe(self):
+        # All calls hold self._lock, but a locking storage has to be locked
+        # for whole transactions, which the database does
+        return not getattr(self.storage, 'locking', False)
+
+    def __init__(self, storage_cls=Flata.DEFAULT_STORAGE,
+                 write_cache_size=None, flush_interval=None,
+                 max_dirty_bytes=None, background=False):
+        """
+        :param storage_cls: The class of the storage to cache.
+        :param write_cache_size: Flush after this many writes.
+        :param flush_interval: Flush once the oldest unflushed write is this
+                               many seconds old.
+        :param max_dirty_bytes: Flush once the unflushed changes are about
+                                this many bytes.
+        :param background: Flush in a background thread once the oldest
+                           unflushed write is ``flush_interval`` seconds old.
+        """
+
         super(CachingMiddleware, self).__init__(storage_cls)
 
+        if write_cache_size is not None:
+            self.WRITE_CACHE_SIZE = write_cache_size
+        if flush_interval is not None:
+            self.FLUSH_INTERVAL = flush_interval
+        if max_dirty_bytes is not None:
+            self.MAX_DIRTY_BYTES = max_dirty_bytes
+        if background and not self.FLUSH_INTERVAL:
+            raise ValueError('A background flush needs a flush interval')
+        self.background = background
+
         self.cache = None
         self._cache_modified_count = 0
+        self._cache_stamp = None
+        self._indexes = {}
+        self._generation = 0
+
+        # Bumped when the whole cache is replaced, and per changed table
+        self._epoch = 0
+        self._generations = {}
+
+        self._dirty_since = None
+        self._dirty_bytes = 0
+        # The changed tables, None if the whole database was written
+        self._dirty_tables = set()
+
+        # The background thread flushes while other threads write
+        self._lock = threading.RLock()
+        self._stopped = threading.Event()
+        self._flusher = None
+        self._flush_error = None
+
+    def __call__(self, *args, **kwargs):
+        super(CachingMiddleware, self).__call__(*args, **kwargs)
+
+        if self.background and self._flusher is None:
+            self._flusher = threading.Thread(target=self._flush_periodically)
+            self._flusher.daemon = True
+            self._flusher.start()
+
+        return self
+
+    def _flush_periodically(self):
+        while not self._stopped.wait(self.FLUSH_INTERVAL / 2.0):
+            with self._lock:
+                if (self._dirty_since is None or
+                        time.time() - self._dirty_since < self.FLUSH_INTERVAL):
+                    continue
+
+                try:
+                    self.flush()
+                except Exception as e:
+                    self._flush_error = e
+
+    def _storage_stamp(self):
+        stamp = getattr(self.storage, 'stamp', None)
+        return stamp() if stamp is not None else None
+
+    def _refresh(self):
+        """
+        Read the storage again if it was changed by someone else, unless
+        that would drop unwritten changes.
+        """
+
+        if self.cache is not None and (
+                self._cache_modified_count or self._cache_stamp is None or
+                self._storage_stamp() == self._cache_stamp):
+            return
+
+        # Taken before reading, so a change made in between is noticed
+        # by the next refresh
+        self._cache_stamp = self._storage_stamp()
+        self.cache = self.storage.read()
+        self._indexes.clear()
+        self._generation += 1
+        self._epoch += 1
+
+    def stamp(self):
+        with self._lock:
+            self._refresh()
+            return self._generation
+
+    def table_stamp(self, table):
+        with self._lock:
+            self._refresh()
+            return (self._epoch, self._generations.get(table, 0))
+
+    def table_names(self):
+        with self._lock:
+            return super(CachingMiddleware, self).table_names()
 
     def read(self):
-        if self.cache is None:
-            self.cache = self.storage.read()
-        return self.cache
+        with self._lock:
+            self._refresh()
+            return self.cache
 
     def write(self, data):
-        self.cache = data
+        with self._lock:
+            self._raise_flush_error()
+            if data is not self.cache:
+                self._indexes.clear()
+
+            self.cache = data
+            self._dirty_tables = None
+            self._epoch += 1
+            self._changed()
+
+    def append(self, table, op, payload, id_field='id', meta=None):
+        with self._lock:
+            self._raise_flush_error()
+            data = self.read()
+            if data is None:
+                data = {}
+
+            if (not payload and op != 'write' and table in data and
+                    meta in (None, get_meta(data, table))):
+                return  # Changes nothing
+
+            apply_indexed(data, self._indexes, table, op, payload, id_field)
+            set_meta(data, table, meta)
+            self.cache = data
+            self._mark_dirty(table)
+            self._changed(payload)
+
+    def drop_table(self, table):
+        with self._lock:
+            self._raise_flush_error()
+            data = self.read()
+            if not data or table not in data:
+                return
+
+            del data[table]
+            (data.get(META_KEY) or {}).pop(table, None)
+            self._mark_dirty(table)
+            self._changed(table)
+
+    def _mark_dirty(self, table):
+        self._generations[table] = self._generations.get(table, 0) + 1
+        if self._dirty_tables is not None:
+            self._dirty_tables.add(table)
+
+    def _changed(self, change=None):
+        """
+        Account for a cached write and flush if a policy says so.
+
+        :param change: the written data, to estimate its size, or ``None``
+                       if the whole database was written
+        """
+
+        now = time.time()
+        if self._dirty_since is None:
+            self._dirty_since = now
+
         self._cache_modified_count += 1
+        self._generation += 1
+        if self.MAX_DIRTY_BYTES and change is not None:
+            self._dirty_bytes += len(json.dumps(change, default=repr))
 
-        if self._cache_modified_count >= self.WRITE_CACHE_SIZE:
+        if (self._cache_modified_count >= self.WRITE_CACHE_SIZE or
+                (self.MAX_DIRTY_BYTES and
+                 self._dirty_bytes >= self.MAX_DIRTY_BYTES) or
+                (self.FLUSH_INTERVAL is not None and not self.background and
+                 now - self._dirty_since >= self.FLUSH_INTERVAL)):
             self.flush()
 
+    def _raise_flush_error(self):
+        error, self._flush_error = self._flush_error, None
+        if error is not None:
+            raise error
+
     def flush(self):
         """
         Flush all unwritten data to disk.
         """
-        if self._cache_modified_count > 0:
-            self.storage.write(self.cache)
-            self._cache_modified_count = 0
+        with self._lock:
+            self._raise_flush_error()
+
+            if self._cache_modified_count > 0:
+                if (self._dirty_tables is not None and
+                        getattr(self.storage, 'partial_writes', False)):
+                    self._flush_tables(self._dirty_tables)
+                else:
+                    self.storage.write(self.cache)
+
+                self._cache_modified_count = 0
+                self._dirty_tables = set()
+                self._cache_stamp = self._storage_stamp()
+                self._dirty_since = None
+                self._dirty_bytes = 0
+
+    def _flush_tables(self, tables):
+        data = self.cache or {}
+
+        for table in tables:
+            if table in data:
+                self.storage.write_table(table, data[table],
+                                         get_meta(data, table))
+            else:
+                self.storage.drop_table(table)
 
     def close(self):
+        if self._flusher is not None:
+            self._stopped.set()
+            self._flusher.join()
+            self._flusher = None
+
         self.flush()  # Flush potentially unwritten data
         self.storage.close()
+
+
+class BoundedCachingMiddleware(CachingMiddleware):
+    """
+    A :class:`CachingMiddleware` which keeps only as many tables in memory
+    as fit into a budget of records.
+
+    Tables are read into the cache when they are used. When the cached
+    tables hold more than ``max_rows`` records, the least recently used
+    (``policy='lru'``) or least frequently used (``policy='lfu'``) tables
+    are evicted; changed tables are written to the storage first. A single
+    table larger than the budget isn't kept at all.
+
+    Tables which aren't cached are streamed from the storage when iterated
+    over (see :meth:`flata.storages.Storage.iter_table`). Flushes write the
+    changed tables one by one, so this works best with storages with
+    :attr:`~flata.storages.Storage.partial_writes`.
+
+    The numbers of cache hits, misses and evictions are counted, see
+    :meth:`stats`.
+
+    >>> storage = BoundedCachingMiddleware(DirectoryStorage, max_rows=10 ** 6)
+    """
+
+    #: The number of records to keep in memory
+    MAX_ROWS = 100000
+
+    POLICIES = ('lru', 'lfu')
+
+    def __init__(self, storage_cls=Flata.DEFAULT_STORAGE, max_rows=None,
+                 policy='lru', **kwargs):
+        """
+        :param storage_cls: The class of the storage to cache.
+        :param max_rows: The number of records to keep in memory.
+        :param policy: Which tables to evict first, the least recently
+                       (``lru``) or least frequently (``lfu``) used ones.
+
+        The other keyword arguments set the flush policy, see
+        :class:`CachingMiddleware`.
+        """
+
+        if policy not in self.POLICIES:
+            raise ValueError('Unknown eviction policy: {0}'.format(policy))
+
+        super(BoundedCachingMiddleware, self).__init__(storage_cls, **kwargs)
+
+        if max_rows is not None:
+            self.MAX_ROWS = max_rows
+        self.policy = policy
+
+        # The cached tables: their records, metadata and the storage's stamp
+        # of the table when it was read
+        self._rows = {}
+        self._metas = {}
+        self._stamps = {}
+        self._size = 0
+
+        # Usage: recency (oldest first) and frequency
+        self._recency = OrderedDict()
+        self._uses = {}
+
+        self._dirty = set()
+        self._dropped = set()
+        # Bumped by every change of a table
+        self._versions = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def stats(self):
+        """
+        Get the cache statistics.
+
+        :returns: the number of ``hits``, ``misses`` and ``evictions`` and
+                  the number of cached ``tables`` and ``rows``
+        :rtype: dict
+        """
+
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions, 'tables': len(self._rows),
+                    'rows': self._size}
+
+    # --- Cached tables -------------------------------------------------------
+
+    def _storage_table_stamp(self, table):
+        table_stamp = getattr(self.storage, 'table_stamp', None)
+        return table_stamp(table) if table_stamp is not None else None
+
+    def _use(self, table):
+        self._recency.pop(table, None)
+        self._recency[table] = None
+        self._uses[table] = self._uses.get(table, 0) + 1
+
+    def _load(self, table):
+        """
+        Get the records of a table, reading them into the cache if needed.
+        """
+
+        if table in self._rows:
+            # Clean tables are read again if someone else changed them
+            if (table in self._dirty or self._stamps[table] is None or
+                    self._stamps[table] == self._storage_table_stamp(table)):
+                self.hits += 1
+                self._use(table)
+                return self._rows[table]
+            self._forget(table)
+
+        self.misses += 1
+        if table in self._dropped:
+            return None
+
+        stamp = self._storage_table_stamp(table)
+        rows = self.storage.read_table(table)
+        if rows is None:
+            return None
+
+        self._cache(table, rows, self.storage.read_meta(table), stamp)
+        self._evict(keep=table)
+        return rows
+
+    def _cache(self, table, rows, meta, stamp=None):
+        self._forget(table)
+
+        self._rows[table] = rows
+        self._metas[table] = meta
+        self._stamps[table] = stamp
+        self._size += len(rows)
+        self._use(table)
+
+    def _forget(self, table):
+        if table not in self._rows:
+            return
+
+        self._size -= len(self._rows.pop(table))
+        self._metas.pop(table)
+        self._stamps.pop(table)
+        self._indexes.pop(table, None)
+        self._recency.pop(table)
+
+    def _evict(self, keep=None):
+        """
+        Evict tables until the cache fits into its budget. ``keep`` is only
+        evicted if it doesn't fit on its own.
+        """
+
+        while self._size > self.MAX_ROWS and self._rows:
+            candidates = [table for table in self._recency if table != keep]
+            if not candidates:
+                candidates = [keep]
+
+            if self.policy == 'lru':
+                victim = candidates[0]
+            else:
+                # The oldest of the least frequently used
+                victim = min(candidates, key=self._uses.__getitem__)
+
+            if victim in self._dirty:
+                self._write_back(victim)
+            self._forget(victim)
+            self.evictions += 1
+
+    def _write_back(self, table):
+        self.storage.write_table(table, self._rows[table], self._metas[table])
+        self._dirty.discard(table)
+        self._stamps[table] = self._storage_table_stamp(table)
+
+    def _bump(self, table):
+        self._versions[table] = self._versions.get(table, 0) + 1
+
+    def _change(self, table, change):
+        self._bump(table)
+        self._dirty.add(table)
+        self._dropped.discard(table)
+        self._stamps[table] = None
+        self._changed(change)
+        self._evict(keep=table)
+
+    # --- Storage methods -----------------------------------------------------
+
+    def stamp(self):
+        return self._generation
+
+    def table_stamp(self, table):
+        with self._lock:
+            version = self._versions.get(table, 0)
+            if table in self._dirty or table in self._dropped:
+                return version
+            return (version, self._storage_table_stamp(table))
+
+    def read_table(self, table):
+        with self._lock:
+            return self._load(table)
+
+    def read_meta(self, table):
+        with self._lock:
+            if table in self._rows:
+                return self._metas[table]
+            if table in self._dropped:
+                return None
+            return self.storage.read_meta(table)
+
+    def iter_table(self, table):
+        with self._lock:
+            if table in self._rows:
+                self.hits += 1
+                self._use(table)
+                return iter(list(self._rows[table]))
+
+            if table in self._dropped:
+                return iter([])
+
+        self.misses += 1
+        return self.storage.iter_table(table)
+
+    def table_names(self):
+        with self._lock:
+            return ((self.storage.table_names() | set(self._rows)) -
+                    self._dropped)
+
+    def read(self):
+        with self._lock:
+            data = {}
+            for table in self.table_names():
+                rows = self._load(table)
+                if rows is not None:
+                    data[table] = rows
+                    set_meta(data, table, self.read_meta(table))
+
+            return data or None
+
+    def write(self, data):
+        with self._lock:
+            self._raise_flush_error()
+
+            data = dict(data or {})
+            metas = data.pop(META_KEY, None) or {}
+
+            for table in self.table_names() - set(data):
+                self._forget(table)
+                self._bump(table)
+                self._dirty.discard(table)
+                self._dropped.add(table)
+
+            for table, rows in data.items():
+                self._cache(table, rows, metas.get(table))
+                self._bump(table)
+                self._dirty.add(table)
+                self._dropped.discard(table)
+                self._stamps[table] = None
+
+            self._changed()
+            self._evict()
+
+    def write_table(self, table, rows, meta=None):
+        with self._lock:
+            self._raise_flush_error()
+            self._cache(table, rows, meta)
+            self._change(table, rows)
+
+    def append(self, table, op, payload, id_field='id', meta=None):
+        with self._lock:
+            self._raise_flush_error()
+
+            rows = self._load(table)
+            if rows is None:
+                self._cache(table, [], None)
+            elif table not in self._rows:
+                # Larger than the budget, kept until the change is written
+                # back to the storage
+                self._cache(table, rows, self.storage.read_meta(table),
+                            self._storage_table_stamp(table))
+
+            if (rows is not None and not payload and op != 'write' and
+                    meta in (None, self._metas[table])):
+                self._evict()
+                return  # Changes nothing
+
+            size = len(self._rows[table])
+            apply_indexed(self._rows, self._indexes, table, op, payload,
+                          id_field)
+            self._size += len(self._rows[table]) - size
+
+            if meta is not None:
+                self._metas[table] = meta
+            self._change(table, payload)
+
+    def drop_table(self, table):
+        with self._lock:
+            self._raise_flush_error()
+            self._forget(table)
+            self._bump(table)
+            self._dirty.discard(table)
+            self._dropped.add(table)
+            self._changed(table)
+
+    def flush(self):
+        """
+        Write all changed tables to the storage.
+        """
+
+        with self._lock:
+            self._raise_flush_error()
+
+            for table in sorted(self._dropped):
+                self.storage.drop_table(table)
+            self._dropped.clear()
+
+            for table in sorted(self._dirty):
+                self._write_back(table)
+
+            self._cache_modified_count = 0
+            self._dirty_since = None
+            self._dirty_bytes = 0
@@ -0,0 +1,208 @@
+"""
+Contains the query planner.
+
+The planner walks the hash of a :class:`~flata.queries.QueryImpl` to decide
+how a table finds the elements matching it: which
+:mod:`indexes <flata.indexes>` to use, in which order to intersect them and
+in which order to check the parts of an AND on the candidates.
+
+>>> plan(where('name') == 'John', table._storage)
+Filter(('==', ('name',), 'John'), source=IndexScan(hash index on name: == 'John', rows=1))
+"""
+
+from .compiler import compile_query, cost
+
+__all__ = ('plan', 'Filter', 'FullScan', 'IndexScan', 'Intersect', 'Union')
+
+
+class Plan(object):
+    """
+    The base class for all plan nodes.
+
+    Every node finds the ids of the elements that may match (a part of) a
+    query.
+    """
+
+    #: The estimated number of elements the node finds
+    rows = 0
+
+    def ids(self):
+        """
+        Find the ids.
+
+        :returns: a set of ids or ``None`` for all elements of the table
+        """
+
+        raise NotImplementedError('To be overridden!')
+
+
+class FullScan(Plan):
+    """
+    Check every element of the table.
+    """
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def ids(self):
+        return None
+
+    def __repr__(self):
+        return 'FullScan(rows={0})'.format(self.rows)
+
+
+class IndexScan(Plan):
+    """
+    Look up the candidates in an index.
+    """
+
+    def __init__(self, index, op, value):
+        self.index = index
+        self.op = op
+        self.value = value
+        self.rows = index.estimate(op, value)
+
+    def ids(self):
+        return self.index.lookup(self.op, self.value)
+
+    def __repr__(self):
+        return 'IndexScan({0} index on {1}: {2} {3!r}, rows={4})'.format(
+            self.index.kind, '.'.join(str(p) for p in self.index.path),
+            self.op, self.value, self.rows)
+
+
+class Intersect(Plan):
+    """
+    Intersect the candidates of all parts of an AND, most selective first.
+
+    Stops as soon as the intersection is empty.
+    """
+
+    def __init__(self, children):
+        self.children = sorted(children, key=lambda child: child.rows)
+        self.rows = self.children[0].rows
+
+    def ids(self):
+        result = None
+
+        for child in self.children:
+            ids = child.ids()
+            result = ids if result is None else result & ids
+            if not result:
+                break
+
+        return result
+
+    def __repr__(self):
+        return 'Intersect({0}, rows={1})'.format(
+            ', '.join(repr(child) for child in self.children), self.rows)
+
+
+class Union(Plan):
+    """
+    Join the candidates of all parts of an OR.
+    """
+
+    def __init__(self, children, total):
+        self.children = children
+        self.rows = min(total, sum(child.rows for child in children))
+
+    def ids(self):
+        return set().union(*(child.ids() for child in self.children))
+
+    def __repr__(self):
+        return 'Union({0}, rows={1})'.format(
+            ', '.join(repr(child) for child in self.children), self.rows)
+
+
+class Filter(Plan):
+    """
+    Check the candidates found by ``source`` against the query.
+
+    The query is compiled (see :mod:`flata.compiler`), which checks the
+    parts of an AND cheapest first.
+    """
+
+    def __init__(self, cond, source):
+        self.cond = cond
+        self.source = source
+        self.rows = source.rows
+
+        #: The parts of the query in the order they are checked
+        self.conditions = sorted(_conjuncts(cond), key=cost)
+        self.test = compile_query(cond)
+
+    def ids(self):
+        return self.source.ids()
+
+    def __repr__(self):
+        return 'Filter({0}, source={1!r})'.format(
+            ' and '.join(_describe(c) for c in self.conditions), self.source)
+
+
+def plan(cond, storage):
+    """
+    Plan a query on a table.
+
+    :param cond: the query
+    :param storage: the table's :class:`~flata.database.StorageProxy`
+    :rtype: Filter
+    """
+
+    total = len(storage.read())
+    source = _plan(getattr(cond, 'hashval', None), storage, total)
+
+    return Filter(cond, source if source is not None else FullScan(total))
+
+
+def _plan(hashval, storage, total):
+    """
+    Plan the lookup of the candidates for a query hash.
+
+    :returns: a plan node or ``None`` if only a full scan can tell
+    """
+
+    if not storage.indexes or not isinstance(hashval, tuple) or not hashval:
+        return None
+
+    op = hashval[0]
+
+    if op in ('and', 'or'):
+        children = [_plan(part, storage, total) for part in hashval[1]]
+
+        if op == 'and':
+            # Any index narrows down the candidates of an AND
+            children = [child for child in children if child is not None]
+            if not children:
+                return None
+            return children[0] if len(children) == 1 else Intersect(children)
+
+        # All parts of an OR need an index
+        if None in children:
+            return None
+        return Union(children, total)
+
+    if len(hashval) == 3 and isinstance(hashval[1], tuple):
+        index = storage.indexes.get(hashval[1])
+        if index is not None and index.estimate(op, hashval[2]) is not None:
+            return IndexScan(index, op, hashval[2])
+
+    return None
+
+
+def _conjuncts(cond):
+    """
+    Split a query into the parts of its (nested) ANDs.
+    """
+
+    hashval = getattr(cond, 'hashval', None)
+    operands = getattr(cond, 'operands', ())
+
+    if operands and isinstance(hashval, tuple) and hashval[0] == 'and':
+        return [part for operand in operands for part in _conjuncts(operand)]
+
+    return [cond]
+
+
+def _describe(cond):
+    return repr(getattr(cond, 'hashval', cond))
@@ -36,10 +36,16 @@ class QueryImpl(object):
     query is evaluated by calling the object.
 
     Queries can be combined with logical and/or and modified with logical not.
+    Combined queries keep the queries they were built from as ``operands``,
+    queries on a field keep its ``path`` and the raw ``args`` of the test so
+    they can be compiled (see :mod:`flata.compiler`).
     """
-    def __init__(self, test, hashval):
+    def __init__(self, test, hashval, operands=(), path=None, args=()):
         self.test = test
         self.hashval = hashval
+        self.operands = operands
+        self.path = path
+        self.args = args
 
     def __call__(self, value):
         return self.test(value)
@@ -51,6 +57,9 @@ class QueryImpl(object):
         return 'QueryImpl{0}'.format(self.hashval)
 
     def __eq__(self, other):
+        if not isinstance(other, QueryImpl):
+            # Queries are compared with other values as parts of hashes
+            return False
         return self.hashval == other.hashval
 
     # --- Query modifiers -----------------------------------------------------
@@ -59,17 +68,19 @@ class QueryImpl(object):
         # We use a frozenset for the hash as the AND operation is commutative
         # (a | b == b | a)
         return QueryImpl(lambda value: self(value) and other(value),
-                         ('and', frozenset([self.hashval, other.hashval])))
+                         ('and', frozenset([self.hashval, other.hashval])),
+                         (self, other))
 
     def __or__(self, other):
         # We use a frozenset for the hash as the OR operation is commutative
         # (a & b == b & a)
         return QueryImpl(lambda value: self(value) or other(value),
-                         ('or', frozenset([self.hashval, other.hashval])))
+                         ('or', frozenset([self.hashval, other.hashval])),
+                         (self, other))
 
     def __invert__(self):
         return QueryImpl(lambda value: not self(value),
-                         ('not', self.hashval))
+                         ('not', self.hashval), (self,))
 
 
 class Query(object):
@@ -114,12 +125,13 @@ class Query(object):
 
     __getitem__ = __getattr__
 
-    def _generate_test(self, test, hashval):
+    def _generate_test(self, test, hashval, args=()):
         """
         Generate a query based on a test function.
 
         :param test: The test the query executes.
         :param hashval: The hash of the query.
+        :param args: The arguments of the test.
         :return: A :class:`~flata.queries.QueryImpl` object
         """
         if not self._path:
@@ -135,7 +147,7 @@ class Query(object):
             else:
                 return test(value)
 
-        return QueryImpl(impl, hashval)
+        return QueryImpl(impl, hashval, path=tuple(self._path), args=args)
 
     def __eq__(self, rhs):
         """
@@ -164,7 +176,8 @@ class Query(object):
                 return value == rhs
 
         return self._generate_test(lambda value: test(value),
-                                   ('==', tuple(self._path), freeze(rhs)))
+                                   ('==', tuple(self._path), freeze(rhs)),
+                                   (rhs,))
 
     def __ne__(self, rhs):
         """
@@ -175,7 +188,8 @@ class Query(object):
         :param rhs: The value to compare against
         """
         return self._generate_test(lambda value: value != rhs,
-                                   ('!=', tuple(self._path), freeze(rhs)))
+                                   ('!=', tuple(self._path), freeze(rhs)),
+                                   (rhs,))
 
     def __lt__(self, rhs):
         """
@@ -186,7 +200,7 @@ class Query(object):
         :param rhs: The value to compare against
         """
         return self._generate_test(lambda value: value < rhs,
-                                   ('<', tuple(self._path), rhs))
+                                   ('<', tuple(self._path), rhs), (rhs,))
 
     def __le__(self, rhs):
         """
@@ -197,7 +211,7 @@ class Query(object):
         :param rhs: The value to compare against
         """
         return self._generate_test(lambda value: value <= rhs,
-                                   ('<=', tuple(self._path), rhs))
+                                   ('<=', tuple(self._path), rhs), (rhs,))
 
     def __gt__(self, rhs):
         """
@@ -208,7 +222,7 @@ class Query(object):
         :param rhs: The value to compare against
         """
         return self._generate_test(lambda value: value > rhs,
-                                   ('>', tuple(self._path), rhs))
+                                   ('>', tuple(self._path), rhs), (rhs,))
 
     def __ge__(self, rhs):
         """
@@ -219,7 +233,7 @@ class Query(object):
         :param rhs: The value to compare against
         """
         return self._generate_test(lambda value: value >= rhs,
-                                   ('>=', tuple(self._path), rhs))
+                                   ('>=', tuple(self._path), rhs), (rhs,))
 
     def exists(self):
         """
@@ -241,7 +255,8 @@ class Query(object):
         :param regex: The regular expression to use for matching
         """
         return self._generate_test(lambda value: re.match(regex, value),
-                                   ('matches', tuple(self._path), regex))
+                                   ('matches', tuple(self._path), regex),
+                                   (regex,))
 
     def matches_ignore_case(self, regex):
         """
@@ -254,7 +269,9 @@ class Query(object):
         """
         regex = regex.lower()
         return self._generate_test(lambda value: re.match(regex, value.lower()),
-                                   ('matches', tuple(self._path), regex))                                   
+                                   ('matches_ignore_case', tuple(self._path),
+                                    regex),
+                                   (regex,))
 
     def search(self, regex):
         """
@@ -266,7 +283,8 @@ class Query(object):
         :param regex: The regular expression to use for matching
         """
         return self._generate_test(lambda value: re.search(regex, value),
-                                   ('search', tuple(self._path), regex))
+                                   ('search', tuple(self._path), regex),
+                                   (regex,))
 
     def search_ignore_case(self, regex):
         """
@@ -279,7 +297,9 @@ class Query(object):
         """
         regex = regex.lower()
         return self._generate_test(lambda value: re.search(regex, value.lower()),
-                                   ('search', tuple(self._path), regex))                                   
+                                   ('search_ignore_case', tuple(self._path),
+                                    regex),
+                                   (regex,))
 
     def test(self, func, *args):
         """
@@ -295,7 +315,8 @@ class Query(object):
         :param args: Additional arguments to pass to the test function
         """
         return self._generate_test(lambda value: func(value, *args),
-                                   ('test', tuple(self._path), func, args))
+                                   ('test', tuple(self._path), func, args),
+                                   (func, args))
 
     def any(self, cond):
         """
@@ -329,7 +350,8 @@ class Query(object):
                 return is_sequence(value) and any(e in cond for e in value)
 
         return self._generate_test(lambda value: _cmp(value),
-                                   ('any', tuple(self._path), freeze(cond)))
+                                   ('any', tuple(self._path), freeze(cond)),
+                                   (cond,))
 
     def all(self, cond):
         """
@@ -361,7 +383,8 @@ class Query(object):
                 return is_sequence(value) and all(e in value for e in cond)
 
         return self._generate_test(lambda value: _cmp(value),
-                                   ('all', tuple(self._path), freeze(cond)))
+                                   ('all', tuple(self._path), freeze(cond)),
+                                   (cond,))
 
 
 def where(key):
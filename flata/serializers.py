@@ -0,0 +1,445 @@
+"""
+Contains the :class:`base class <flata.serializers.Serializer>` for
+serializers and implementations.
+
+A serializer turns the data of a database into bytes and back. File based
+storages accept one to choose their file format:
+
+>>> from flata.serializers import BinarySerializer
+>>> db = Flata('db.bin', storage=JSONStorage, serializer=BinarySerializer())
+
+Any format can be compressed with a :class:`CompressedSerializer`:
+
+>>> db = Flata('db.json.gz', storage=JSONStorage,
+...            serializer=CompressedSerializer(JSONSerializer(), 'gzip'))
+
+Files can be converted from one format to another with :func:`convert`.
+"""
+
+from abc import ABCMeta, abstractmethod
+import codecs
+import os
+import pickle
+import struct
+import zlib
+
+from .utils import iteritems, with_metaclass
+
+try:
+    import ujson as json
+except ImportError:
+    import json
+
+try:
+    import bz2
+except ImportError:  # Python built without bz2
+    bz2 = None
+
+try:
+    import lzma
+except ImportError:  # Python 2
+    lzma = None
+
+try:
+    text_types = (str, unicode)  # noqa, Python 2
+except NameError:
+    text_types = (str,)
+
+__all__ = ('Serializer', 'JSONSerializer', 'PickleSerializer',
+           'BinarySerializer', 'CompressedSerializer', 'convert')
+
+#: How many bytes to collect before writing them out when streaming
+CHUNK_SIZE = 64 * 1024
+
+
+class Serializer(with_metaclass(ABCMeta, object)):
+    """
+    The abstract base class for all Serializers.
+    """
+
+    #: The file extension of the format
+    extension = None
+
+    @abstractmethod
+    def dumps(self, data):
+        """
+        Serialize data.
+
+        :param data: The data of the database.
+        :type data: dict
+        :rtype: bytes
+        """
+
+        raise NotImplementedError('To be overridden!')
+
+    @abstractmethod
+    def loads(self, content):
+        """
+        Deserialize data.
+
+        :param content: The serialized data, any bytes-like object (e.g. a
+                        memory mapped file).
+        :rtype: dict
+        """
+
+        raise NotImplementedError('To be overridden!')
+
+    def dump(self, data, handle):
+        """
+        Serialize data into a binary file.
+
+        The default implementation writes the result of :meth:`dumps`.
+        Serializers that can produce their output in parts override this,
+        so it never has to be held in memory as a whole.
+
+        :param data: The data of the database.
+        :param handle: An object with a ``write(bytes)`` method.
+        """
+
+        handle.write(self.dumps(data))
+
+
+class JSONSerializer(Serializer):
+    """
+    Serialize the data as UTF-8 encoded JSON.
+    """
+
+    extension = 'json'
+
+    def __init__(self, **kwargs):
+        """
+        :param kwargs: Passed on to ``json.dumps``.
+        """
+
+        self.kwargs = kwargs
+
+    def dumps(self, data):
+        return json.dumps(data, **self.kwargs).encode('utf-8')
+
+    def loads(self, content):
+        # Decoded straight from the buffer, without copying it into a bytes
+        # object first
+        return json.loads(codecs.decode(content, 'utf-8'))
+
+    def dump(self, data, handle):
+        encoder = getattr(json, 'JSONEncoder', None)
+        if encoder is None:
+            # ujson can't encode in parts
+            return super(JSONSerializer, self).dump(data, handle)
+
+        chunks = []
+        size = 0
+
+        for chunk in encoder(**self.kwargs).iterencode(data):
+            chunks.append(chunk)
+            size += len(chunk)
+            if size >= CHUNK_SIZE:
+                handle.write(''.join(chunks).encode('utf-8'))
+                chunks, size = [], 0
+
+        handle.write(''.join(chunks).encode('utf-8'))
+
+
+class PickleSerializer(Serializer):
+    """
+    Serialize the data with :mod:`pickle`.
+
+    Unpickling can run arbitrary code, so only read files you trust.
+    """
+
+    extension = 'pickle'
+
+    #: The protocol used by default, 5 where available
+    DEFAULT_PROTOCOL = min(5, pickle.HIGHEST_PROTOCOL)
+
+    def __init__(self, protocol=None):
+        """
+        :param protocol: The pickle protocol to use.
+        """
+
+        self.protocol = (self.DEFAULT_PROTOCOL if protocol is None
+                         else protocol)
+
+    def dumps(self, data):
+        return pickle.dumps(data, self.protocol)
+
+    def loads(self, content):
+        return pickle.loads(bytes(content))
+
+
+# The type tags of the binary format
+_NONE, _FALSE, _TRUE, _INT, _FLOAT, _TEXT, _LIST, _DICT, _RECORDS = range(9)
+
+_DOUBLE = struct.Struct('<d')
+
+
+class BinarySerializer(Serializer):
+    """
+    Serialize the data in a compact binary format.
+
+    The format stores the same values as JSON:
+
+    - integers as variable length integers (small numbers take one byte),
+    - floats as 8 byte doubles,
+    - strings and lists prefixed with their length,
+    - the keys of all dicts once, in a table at the start of the file;
+      dicts refer to them by their position,
+    - lists of dicts (like the elements of a table) as length-prefixed
+      records, which can be skipped without decoding them.
+
+    Like JSON, tuples are stored as lists. Dict keys have to be strings.
+    """
+
+    extension = 'bin'
+
+    #: The first bytes of every file
+    MAGIC = b'FLB1'
+
+    def dumps(self, data):
+        keys = {}
+        body = bytearray()
+        _encode(data, body, keys)
+
+        out = bytearray(self.MAGIC)
+        _write_uint(out, len(keys))
+        for key, _ in sorted(iteritems(keys), key=lambda item: item[1]):
+            _write_text(out, key)
+        out += body
+
+        return bytes(out)
+
+    def loads(self, content):
+        content = bytearray(content)  # Indexes to ints on Python 2 and 3
+
+        if content[:len(self.MAGIC)] != self.MAGIC:
+            raise ValueError('Not a binary Flata file')
+
+        decoder = _Decoder(content, len(self.MAGIC))
+        decoder.keys = [decoder.text() for _ in range(decoder.uint())]
+
+        return decoder.value()
+
+
+def _write_uint(out, value):
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _write_text(out, value):
+    encoded = value.encode('utf-8')
+    _write_uint(out, len(encoded))
+    out += encoded
+
+
+def _encode(value, out, keys):
+    # bool is checked before int, as it is a subclass of it
+    if value is None:
+        out.append(_NONE)
+    elif value is True:
+        out.append(_TRUE)
+    elif value is False:
+        out.append(_FALSE)
+    elif isinstance(value, text_types):
+        out.append(_TEXT)
+        _write_text(out, value)
+    elif isinstance(value, int) or type(value).__name__ == 'long':
+        out.append(_INT)
+        # Zigzag encoding keeps small negative numbers small
+        _write_uint(out, value * 2 if value >= 0 else -value * 2 - 1)
+    elif isinstance(value, float):
+        out.append(_FLOAT)
+        out += _DOUBLE.pack(value)
+    elif isinstance(value, dict):
+        out.append(_DICT)
+        _write_uint(out, len(value))
+        for key, item in iteritems(value):
+            if not isinstance(key, text_types):
+                raise TypeError('Keys must be strings: {0!r}'.format(key))
+            _write_uint(out, keys.setdefault(key, len(keys)))
+            _encode(item, out, keys)
+    elif isinstance(value, (list, tuple)):
+        if value and all(isinstance(item, dict) for item in value):
+            out.append(_RECORDS)
+            _write_uint(out, len(value))
+            for item in value:
+                record = bytearray()
+                _encode(item, record, keys)
+                _write_uint(out, len(record))
+                out += record
+        else:
+            out.append(_LIST)
+            _write_uint(out, len(value))
+            for item in value:
+                _encode(item, out, keys)
+    else:
+        raise TypeError('{0!r} is not serializable'.format(value))
+
+
+class _Decoder(object):
+    def __init__(self, content, pos):
+        self.content = content
+        self.pos = pos
+        self.keys = []
+
+    def uint(self):
+        content = self.content
+        result = shift = 0
+
+        while True:
+            byte = content[self.pos]
+            self.pos += 1
+            result |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                return result
+            shift += 7
+
+    def text(self):
+        size = self.uint()
+        start = self.pos
+        self.pos += size
+        return self.content[start:self.pos].decode('utf-8')
+
+    def value(self):
+        tag = self.content[self.pos]
+        self.pos += 1
+
+        if tag == _INT:
+            value = self.uint()
+            return value >> 1 if not value & 1 else -((value + 1) >> 1)
+        if tag == _TEXT:
+            return self.text()
+        if tag == _DICT:
+            keys = self.keys
+            return dict((keys[self.uint()], self.value())
+                        for _ in range(self.uint()))
+        if tag == _RECORDS:
+            records = []
+            for _ in range(self.uint()):
+                self.uint()  # The length is only needed to skip a record
+                records.append(self.value())
+            return records
+        if tag == _LIST:
+            return [self.value() for _ in range(self.uint())]
+        if tag == _FLOAT:
+            value, = _DOUBLE.unpack_from(self.content, self.pos)
+            self.pos += _DOUBLE.size
+            return value
+        if tag == _NONE:
+            return None
+        if tag == _TRUE:
+            return True
+        if tag == _FALSE:
+            return False
+
+        raise ValueError('Unknown type tag {0} at {1}'.format(tag,
+                                                             self.pos - 1))
+
+
+class CompressedSerializer(Serializer):
+    """
+    Compress the output of another serializer.
+
+    Serializers that write their output in parts (like
+    :class:`JSONSerializer`) are compressed while they write, so the
+    uncompressed output never exists in memory as a whole.
+    """
+
+    #: The file extensions of the compression methods
+    EXTENSIONS = {'zlib': 'zz', 'gzip': 'gz', 'bz2': 'bz2', 'lzma': 'xz'}
+
+    def __init__(self, serializer=None, method='gzip', level=None):
+        """
+        :param serializer: The serializer to compress the output of
+                           (default: :class:`JSONSerializer`).
+        :param method: ``zlib``, ``gzip``, ``bz2`` or ``lzma``.
+        :param level: The compression level (or ``lzma`` preset), the
+                      method's default if ``None``.
+        """
+
+        if method not in self.EXTENSIONS:
+            raise ValueError('Unknown compression method: {0}'.format(method))
+        if (method == 'bz2' and bz2 is None) or (method == 'lzma' and
+                                                lzma is None):
+            raise ValueError('Compression method not available: {0}'.format(
+                method))
+
+        self.serializer = serializer or JSONSerializer()
+        self.method = method
+        self.level = level
+        self.extension = '{0}.{1}'.format(self.serializer.extension,
+                                          self.EXTENSIONS[method])
+
+    def _compressor(self):
+        level = self.level
+        if self.method == 'zlib':
+            return zlib.compressobj(-1 if level is None else level)
+        if self.method == 'gzip':
+            # wbits 31 writes a gzip header and trailer
+            return zlib.compressobj(-1 if level is None else level,
+                                    zlib.DEFLATED, 31)
+        if self.method == 'bz2':
+            return bz2.BZ2Compressor(9 if level is None else level)
+        return lzma.LZMACompressor(preset=level)
+
+    def _decompressor(self):
+        if self.method == 'zlib':
+            return zlib.decompressobj()
+        if self.method == 'gzip':
+            return zlib.decompressobj(31)
+        if self.method == 'bz2':
+            return bz2.BZ2Decompressor()
+        return lzma.LZMADecompressor()
+
+    def dumps(self, data):
+        chunks = []
+        self.dump(data, _Sink(chunks.append))
+        return b''.join(chunks)
+
+    def dump(self, data, handle):
+        compressor = self._compressor()
+        self.serializer.dump(data, _Sink(
+            lambda chunk: handle.write(compressor.compress(chunk))))
+        handle.write(compressor.flush())
+
+    def loads(self, content):
+        return self.serializer.loads(
+            self._decompressor().decompress(bytes(content)))
+
+
+class _Sink(object):
+    """
+    A file-like object passing everything written to a function.
+    """
+
+    def __init__(self, write):
+        self.write = write
+
+
+def convert(source, target, source_serializer, target_serializer):
+    """
+    Convert a database file from one format to another.
+
+    >>> convert('db.json', 'db.bin', JSONSerializer(), BinarySerializer())
+
+    :param source: The path of the file to convert.
+    :param target: The path of the converted file, which is replaced
+                   atomically.
+    :param source_serializer: The format of ``source``.
+    :type source_serializer: Serializer
+    :param target_serializer: The format of ``target``.
+    :type target_serializer: Serializer
+    """
+
+    with open(source, 'rb') as handle:
+        content = handle.read()
+
+    data = source_serializer.loads(content) if content else None
+    del content
+
+    tmp_path = target + '.tmp'
+    with open(tmp_path, 'wb') as handle:
+        if data is not None:
+            target_serializer.dump(data, handle)
+    getattr(os, 'replace', os.rename)(tmp_path, target)
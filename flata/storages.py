@@ -4,9 +4,20 @@ implementations.
 """
 
 from abc import ABCMeta, abstractmethod
+from bisect import bisect_left, insort
+from collections import OrderedDict
+from contextlib import contextmanager
+import mmap
 import os
+import re
+import stat as stat_module
+import tempfile
+import threading
+import zlib
 
-from .utils import with_metaclass
+from .serializers import JSONSerializer
+from .streaming import JSONStreamReader
+from .utils import NullLock, iteritems, with_metaclass
 
 
 try:
@@ -14,6 +25,15 @@ try:
 except ImportError:
     import json
 
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+
+#: Atomically replace a file (``os.rename`` can't overwrite on Windows)
+replace = getattr(os, 'replace', os.rename)
+
 
 def touch(fname, times=None, create_dirs=False):
     if create_dirs:
@@ -24,6 +44,256 @@ def touch(fname, times=None, create_dirs=False):
         os.utime(fname, times)
 
 
+def checksum(content):
+    """
+    Get the CRC32 checksum of some bytes, the same on Python 2 and 3.
+    """
+
+    return zlib.crc32(content) & 0xffffffff
+
+
+def line_kwargs(kwargs):
+    """
+    Get the ``json.dumps`` arguments to encode a record of a log with, which
+    has to stay on a single line: ``indent`` and ``separators`` are dropped.
+    """
+
+    return dict((key, value) for key, value in kwargs.items()
+                if key not in ('indent', 'separators'))
+
+
+def fsync_dir(path):
+    """
+    Sync the directory containing a file, so a rename of the file is
+    durable. Does nothing where directories can't be synced (e.g. Windows).
+    """
+
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    except OSError:
+        return
+
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def apply_operation(rows, op, payload, id_field='id'):
+    """
+    Apply a single table operation to the records stored for a table.
+
+    The records are changed in place if ``rows`` is a list.
+
+    :param rows: The records currently stored in the table.
+    :param op: One of ``insert``, ``update``, ``remove`` or ``write``.
+    :param payload: The records to insert or update, the ids to remove or the
+                    new content of the table.
+    :param id_field: The field holding the id of a record.
+    :returns: The records of the table after the operation.
+    :rtype: list
+    """
+
+    if op == 'write':
+        return list(payload)
+
+    if not isinstance(rows, list):
+        rows = list(rows or [])
+
+    if op == 'insert':
+        rows.extend(payload)
+    elif op == 'update':
+        changed = dict((record[id_field], record) for record in payload)
+        for i, record in enumerate(rows):
+            if record.get(id_field) in changed:
+                rows[i] = changed[record[id_field]]
+    elif op == 'remove':
+        removed = set(payload)
+        rows[:] = [record for record in rows
+                   if record.get(id_field) not in removed]
+    else:
+        raise ValueError('Unknown operation: {0}'.format(op))
+
+    return rows
+
+
+class PrimaryIndex(object):
+    """
+    Maps the ids of a table's records to their position in the table.
+
+    Operations on single records then only touch the affected records
+    instead of scanning the whole table.
+
+    Every record keeps the slot it got when it was indexed or inserted.
+    Removed slots are kept as sorted tombstones, so a record's position is
+    its slot minus the tombstones before it and a remove doesn't have to
+    renumber the records behind it. The slots are renumbered once the
+    tombstones outnumber the records.
+    """
+
+    #: The number of tombstones below which the slots are never renumbered
+    COMPACT_MIN_REMOVED = 1000
+
+    def __init__(self, rows, id_field='id'):
+        self.rows = rows
+        self.id_field = id_field
+        self.compact()
+
+    def covers(self, rows, id_field):
+        """
+        Check whether the index belongs to the given list of records.
+        """
+
+        return self.rows is rows and self.id_field == id_field
+
+    def compact(self):
+        """
+        Renumber the slots to the current positions and drop the
+        tombstones.
+        """
+
+        self.slots = dict((record.get(self.id_field), i)
+                          for i, record in enumerate(self.rows))
+        self.removed = []
+
+    def position(self, id):
+        """
+        Get the position of a record in the table.
+
+        :returns: the position or ``None`` if there's no record with the id
+        """
+
+        slot = self.slots.get(id)
+        if slot is None:
+            return None
+
+        return slot - bisect_left(self.removed, slot)
+
+    def apply(self, op, payload):
+        """
+        Apply an ``insert``, ``update`` or ``remove`` operation to the
+        indexed records.
+
+        :returns: the indexed records
+        """
+
+        rows = self.rows
+        slots = self.slots
+        id_field = self.id_field
+
+        if op == 'insert':
+            for record in payload:
+                slots[record[id_field]] = len(rows) + len(self.removed)
+                rows.append(record)
+
+        elif op == 'update':
+            for record in payload:
+                pos = self.position(record[id_field])
+                if pos is not None:
+                    rows[pos] = record
+
+        elif op == 'remove':
+            positions = set(self.position(id) for id in set(payload)
+                            if id in slots)
+            if not positions:
+                return rows
+
+            start = min(positions)
+            if len(positions) == 1:
+                del rows[start]
+            else:
+                rows[start:] = [record for i, record
+                                in enumerate(rows[start:], start)
+                                if i not in positions]
+
+            for id in set(payload):
+                slot = slots.pop(id, None)
+                if slot is not None:
+                    insort(self.removed, slot)
+
+            if len(self.removed) > max(self.COMPACT_MIN_REMOVED, len(rows)):
+                self.compact()
+
+        else:
+            raise ValueError('Unknown operation: {0}'.format(op))
+
+        return rows
+
+
+def apply_indexed(data, indexes, table, op, payload, id_field='id'):
+    """
+    Apply a single table operation to a database, using and maintaining a
+    :class:`PrimaryIndex` per table.
+
+    Indexes are built on the first ``update`` or ``remove`` of a table.
+
+    :param data: The database, is changed in place.
+    :param indexes: The primary indexes by table name.
+    """
+
+    rows = data.get(table)
+
+    if op != 'write' and isinstance(rows, list):
+        index = indexes.get(table)
+
+        if index is None or not index.covers(rows, id_field):
+            if op == 'insert':
+                indexes.pop(table, None)
+                rows.extend(payload)
+                return
+
+            index = indexes[table] = PrimaryIndex(rows, id_field)
+
+        index.apply(op, payload)
+        return
+
+    indexes.pop(table, None)
+    data[table] = apply_operation(rows, op, payload, id_field)
+
+
+#: The key under which storages keep the metadata of the tables (the last
+#: id, the number of records, ...) next to the tables themselves
+META_KEY = '__meta__'
+
+
+def set_meta(data, table, meta):
+    """
+    Store the metadata of a table in a database, in place.
+
+    :param meta: The metadata, nothing is changed if ``None``.
+    """
+
+    if meta is not None:
+        data.setdefault(META_KEY, {})[table] = meta
+
+
+def get_meta(data, table):
+    """
+    Get the metadata of a table from a database.
+    """
+
+    return ((data or {}).get(META_KEY) or {}).get(table)
+
+
+def meta_first(data):
+    """
+    Get a database with the metadata ordered before the tables, so it can
+    be read from the start of a file without scanning the tables.
+    """
+
+    if not data or META_KEY not in data:
+        return data
+
+    ordered = OrderedDict([(META_KEY, data[META_KEY])])
+    for key, value in iteritems(data):
+        if key != META_KEY:
+            ordered[key] = value
+
+    return ordered
+
+
 class Storage(with_metaclass(ABCMeta, object)):
     """
     The abstract base class for all Storages.
@@ -35,6 +305,14 @@ class Storage(with_metaclass(ABCMeta, object)):
     # Using ABCMeta as metaclass allows instantiating only storages that have
     # implemented read and write
 
+    #: Whether writing a single table (see :meth:`write_table`) costs less
+    #: than writing the whole database
+    partial_writes = False
+
+    #: Whether the storage may be used from several threads at once. A
+    #: thread safe database serializes all calls to other storages.
+    thread_safe = False
+
     @abstractmethod
     def read(self):
         """
@@ -61,6 +339,120 @@ class Storage(with_metaclass(ABCMeta, object)):
 
         raise NotImplementedError('To be overridden!')
 
+    def append(self, table, op, payload, id_field='id', meta=None):
+        """
+        Persist a single operation on a table.
+
+        The default implementation reads the whole database, applies the
+        operation and writes it back. Storages that can persist a change
+        without rewriting everything (see :class:`LogStorage`) override this.
+
+        :param table: The name of the table.
+        :param op: The operation, see :func:`apply_operation`.
+        :param payload: The records or ids affected by the operation.
+        :param id_field: The field holding the id of a record.
+        :param meta: The new metadata of the table, persisted together with
+                     the operation.
+        """
+
+        data = self.read() or {}
+        data[table] = apply_operation(data.get(table), op, payload, id_field)
+        set_meta(data, table, meta)
+        self.write(data)
+
+    def stamp(self):
+        """
+        Optional: Return a value that changes whenever the stored data
+        changes.
+
+        Readers use it to keep decoded data around between reads. Return
+        ``None`` (the default) if changes can't be detected, so the data is
+        read again every time.
+        """
+
+        return None
+
+    def read_table(self, table):
+        """
+        Read the records of a single table.
+
+        The default implementation reads the whole database. Storages that
+        keep tables apart (see :class:`DirectoryStorage`) override this and
+        the other table methods.
+
+        :param table: The name of the table.
+        :returns: The records or ``None`` if the table doesn't exist.
+        :rtype: list
+        """
+
+        return (self.read() or {}).get(table)
+
+    def write_table(self, table, rows, meta=None):
+        """
+        Replace the records of a single table.
+
+        :param table: The name of the table.
+        :param rows: The new records of the table.
+        :param meta: The new metadata of the table.
+        """
+
+        self.append(table, 'write', rows, meta=meta)
+
+    def read_meta(self, table):
+        """
+        Read the metadata of a single table.
+
+        :param table: The name of the table.
+        :returns: The metadata or ``None`` if none was stored.
+        :rtype: dict
+        """
+
+        return get_meta(self.read(), table)
+
+    def drop_table(self, table):
+        """
+        Remove a single table and its metadata.
+
+        :param table: The name of the table.
+        """
+
+        data = self.read() or {}
+        if table in data:
+            del data[table]
+            (data.get(META_KEY) or {}).pop(table, None)
+            self.write(data)
+
+    def table_names(self):
+        """
+        Get the names of all tables.
+
+        :rtype: set[str]
+        """
+
+        return set(self.read() or {}) - set([META_KEY])
+
+    def iter_table(self, table):
+        """
+        Iterate over the records of a single table.
+
+        Storages that can decode records one at a time (see
+        :class:`JSONStorage`) override this, so tables don't have to fit
+        into memory. The default implementation iterates over a copy of
+        the records, so the table can be written to meanwhile.
+
+        :param table: The name of the table.
+        """
+
+        return iter(list(self.read_table(table) or []))
+
+    def table_stamp(self, table):
+        """
+        Optional: Like :meth:`stamp`, but only has to change when the given
+        table changes.
+        """
+
+        return self.stamp()
+
     def close(self):
         """
         Optional: Close open file handles, etc.
@@ -72,9 +464,54 @@ class Storage(with_metaclass(ABCMeta, object)):
 class JSONStorage(Storage):
     """
     Store the data in a JSON file.
+
+    In WAL mode (``wal=True``) changes to single tables are appended to a
+    write-ahead log next to the file (``<path>-wal``) instead of rewriting
+    the file. The log is synced to disk before a write returns, and writes
+    from several threads waiting at the same time share one sync (group
+    commit). Once the log holds ``checkpoint_size`` records, the data is
+    written to a temporary file that replaces the JSON file (a checkpoint).
+    The log is replayed when the storage is opened again, so a crash loses
+    no committed change and never leaves a half written JSON file.
+
+    In WAL mode the data is kept in memory, so the file must not be changed
+    by other processes while it is open.
+
+    With ``mmap=True`` the file is memory mapped and parsed from the mapped
+    buffer instead of going through a text file object. The mapping is kept
+    until the file's size or modification time changes, so reading a large,
+    rarely changed file again is served from the OS page cache. Other
+    processes must not shrink the file while it is mapped.
+
+    With ``atomic=True`` writes go to a temporary file in the same
+    directory, which is synced to disk and then renamed over the file. A
+    crash never leaves a half written file and readers in other processes
+    see either the old or the new data. Every storage notices when the file
+    was replaced (its inode changed) and reopens it.
+
+    With ``locking=True`` several processes can share the file: reads hold
+    a shared lock and writes an exclusive one (see :class:`FileLock`). Every
+    write bumps a generation counter in the lock file (``<path>.lock``), so
+    the other processes notice a change by reading a few bytes instead of
+    reading the file again. Tables hold the exclusive lock for a whole
+    insert, update or removal (see :meth:`transaction`), so they are always
+    applied to the latest data and ids are never handed out twice. Locking
+    can't be combined with WAL mode.
+
+    The file format can be changed by passing a
+    :class:`~flata.serializers.Serializer` (JSON by default). The
+    write-ahead log always holds JSON.
+
+    The metadata of the tables is written before the tables (unless the
+    keys are sorted), so :meth:`read_meta` only reads the start of the file.
     """
 
-    def __init__(self, path, create_dirs=False, **kwargs):
+    #: The number of logged records after which the log is checkpointed
+    CHECKPOINT_SIZE = 1000
+
+    def __init__(self, path, create_dirs=False, wal=False, sync=True,
+                 checkpoint_size=None, mmap=False, serializer=None,
+                 atomic=False, locking=False, **kwargs):
         """
         Create a new instance.
 
@@ -82,17 +519,151 @@ class JSONStorage(Storage):
 
         :param path: Where to store the JSON data.
         :type path: str
+        :param wal: Log changes to a write-ahead log instead of rewriting
+                    the file. The records of the log are always written
+                    on a single line, ignoring ``indent`` and
+                    ``separators``.
+        :param sync: In WAL mode, sync every change to disk before
+                     returning.
+        :param checkpoint_size: In WAL mode, the number of logged records
+                                after which the file is rewritten.
+        :param mmap: Read the file through a memory mapping.
+        :param serializer: The format of the file, by default JSON written
+                           with ``json.dumps(data, **kwargs)``.
+        :type serializer: flata.serializers.Serializer
+        :param atomic: Replace the file atomically instead of overwriting
+                       it.
+        :param locking: Lock the file, so several processes can use it at
+                        the same time.
         """
 
+        if locking and wal:
+            raise ValueError('Locking can not be used in WAL mode')
+
         super(JSONStorage, self).__init__()
         touch(path, create_dirs=create_dirs)  # Create file if not exists
+        self.path = path
         self.kwargs = kwargs
-        self._handle = open(path, 'r+')
+        self.serializer = serializer or JSONSerializer(**kwargs)
+        self._generation = 0
+        self.atomic = atomic
+
+        self.locking = locking
+        self._file_lock = FileLock(path + '.lock') if locking else NullLock()
+
+        self._mmap_enabled = mmap
+        self._map = None
+        self._map_stamp = None
+
+        self._wal = None
+        if not wal:
+            self._handle = open(path, 'r+b')
+            return
+
+        self._handle = None
+        self.partial_writes = True  # Appended to the log
+        self.thread_safe = True  # Changes are made holding self._lock
+        self.checkpoint_size = checkpoint_size or self.CHECKPOINT_SIZE
+        self._lock = threading.Lock()
+        self._indexes = {}
+
+        # Bumped when the whole database is replaced, and per changed table
+        self._epoch = 0
+        self._generations = {}
+
+        with open(path, 'rb') as handle:
+            content = handle.read()
+        self._data = self.serializer.loads(content) if content else None
+
+        self._wal = WriteAheadLog(path + '-wal', sync=sync)
+        for record in self._wal.replay(checksum(content)):
+            self._apply(record)
 
     def close(self):
-        self._handle.close()
+        if self._wal is None:
+            self._unmap()
+            self._handle.close()
+            if self.locking:
+                self._file_lock.close()
+            return
+
+        if self._wal.records:
+            self.checkpoint()
+        self._wal.close()
+
+    def stamp(self):
+        if self._wal is not None:
+            # Only changed through this instance
+            return self._generation
+
+        if self.locking:
+            # Every write by any process bumps the counter
+            return (self._generation, self._file_lock.generation())
+
+        # Our own writes bump the generation, changes by other processes
+        # show up in the file's modification time and size
+        stat = self._reopen_if_replaced()
+        return (self._generation, getattr(stat, 'st_mtime_ns', stat.st_mtime),
+                stat.st_size, stat.st_ino)
+
+    def table_stamp(self, table):
+        if self._wal is None:
+            # The file is rewritten as a whole
+            return self.stamp()
+
+        return (self._epoch, self._generations.get(table, 0))
+
+    def _reopen_if_replaced(self):
+        """
+        Reopen the file if it was replaced since it was opened.
+
+        :returns: the file's ``stat`` result
+        """
+
+        stat = os.fstat(self._handle.fileno())
+
+        try:
+            current = os.stat(self.path)
+        except OSError:
+            return stat  # Being replaced right now, keep the old file
+
+        if (current.st_ino, current.st_dev) != (stat.st_ino, stat.st_dev):
+            self._unmap()
+            self._handle.close()
+            self._handle = open(self.path, 'r+b')
+            stat = os.fstat(self._handle.fileno())
+
+        return stat
+
+    def transaction(self):
+        """
+        Hold the exclusive lock on the file while several operations are
+        made. Other processes can't read or change the file meanwhile.
+
+        Does nothing if the storage isn't ``locking``.
+
+        >>> with storage.transaction():
+        ...     data = storage.read()
+        ...     storage.write(change(data))
+        """
+
+        return self._file_lock.writing()
 
     def read(self):
+        if self._wal is not None:
+            with self._lock:
+                # A copy, other threads may add tables meanwhile
+                return dict(self._data) if self._data is not None else None
+
+        with self._file_lock.reading():
+            return self._read()
+
+    def _read(self):
+        self._reopen_if_replaced()
+
+        if self._mmap_enabled:
+            return self._read_mapped()
+
         # Get the file size
         self._handle.seek(0, os.SEEK_END)
         size = self._handle.tell()
@@ -102,14 +673,805 @@ class JSONStorage(Storage):
             return None
         else:
             self._handle.seek(0)
-            return json.load(self._handle)
+            return self.serializer.loads(self._handle.read())
 
     def write(self, data):
+        if self._wal is not None:
+            with self._lock:
+                self._checkpoint(data)
+                self._epoch += 1
+            return
+
+        with self._file_lock.writing():
+            self._write(data)
+            if self.locking:
+                self._file_lock.bump()
+
+    def _write(self, data):
+        # The file can't be truncated while it is mapped on some systems
+        self._unmap()
+
+        if self.atomic:
+            self._replace(data)
+            return
+
         self._handle.seek(0)
-        serialized = json.dumps(data, **self.kwargs)
+        serialized = self.serializer.dumps(meta_first(data))
         self._handle.write(serialized)
         self._handle.flush()
         self._handle.truncate()
+        self._generation += 1
+
+    def _streamable(self):
+        # Only plain JSON files can be decoded record by record, in WAL mode
+        # the data is in memory already
+        return self._wal is None and type(self.serializer) is JSONSerializer
+
+    def table_names(self):
+        if not self._streamable():
+            return super(JSONStorage, self).table_names()
+
+        with self._file_lock.reading(), open(self.path, 'rb') as handle:
+            return set(JSONStreamReader(handle).tables()) - set([META_KEY])
+
+    def read_meta(self, table):
+        if not self._streamable():
+            return super(JSONStorage, self).read_meta(table)
+
+        with self._file_lock.reading(), open(self.path, 'rb') as handle:
+            return (JSONStreamReader(handle).value(META_KEY) or {}).get(table)
+
+    def iter_table(self, table):
+        # A file overwritten in place may change under a stream that is
+        # still open (e.g. when another table is written while iterating),
+        # only replaced files can be streamed, others are read at once
+        if not self._streamable() or not self.atomic:
+            return super(JSONStorage, self).iter_table(table)
+
+        return self._iter_table(table)
+
+    def _iter_table(self, table):
+        with open(self.path, 'rb') as handle:
+            for record in JSONStreamReader(handle).records(table):
+                yield record
+
+    def _replace(self, data):
+        directory, name = os.path.split(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(prefix=name + '.', suffix='.tmp',
+                                        dir=directory)
+
+        try:
+            with os.fdopen(fd, 'wb') as handle:
+                self.serializer.dump(meta_first(data), handle)
+                handle.flush()
+                os.fsync(handle.fileno())
+
+            # Keep the permissions of the file (mkstemp creates it private)
+            os.chmod(tmp_path, stat_module.S_IMODE(
+                os.fstat(self._handle.fileno()).st_mode))
+
+            # Open files can't be replaced on Windows
+            self._handle.close()
+            replace(tmp_path, self.path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        finally:
+            if self._handle.closed:
+                self._handle = open(self.path, 'r+b')
+
+        fsync_dir(self.path)
+        self._generation += 1
+
+    def _read_mapped(self):
+        stat = os.fstat(self._handle.fileno())
+        stamp = (getattr(stat, 'st_mtime_ns', stat.st_mtime), stat.st_size)
+
+        if self._map is None or stamp != self._map_stamp:
+            self._unmap()
+            if not stat.st_size:
+                # File is empty, empty files can't be mapped
+                return None
+
+            self._map = mmap.mmap(self._handle.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+            self._map_stamp = stamp
+
+        return self.serializer.loads(self._map)
+
+    def _unmap(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+            self._map_stamp = None
+
+    def append(self, table, op, payload, id_field='id', meta=None):
+        if self._wal is None:
+            # Read, changed and written without another process in between
+            with self._file_lock.writing():
+                return super(JSONStorage, self).append(table, op, payload,
+                                                       id_field, meta)
+
+        # Serialize first so a record that can't be encoded changes nothing
+        record = {'op': op, 'table': table, 'data': payload, 'key': id_field}
+        if meta is not None:
+            record['meta'] = meta
+        line = json.dumps(record, **line_kwargs(self.kwargs))
+
+        with self._lock:
+            position = self._wal.write(line)
+
+            # Apply the decoded line, so the state is exactly what a replay
+            # of the log would produce
+            self._apply(json.loads(line))
+
+            if self._wal.records >= self.checkpoint_size:
+                self._checkpoint(self._data)
+
+        self._wal.sync(position)
+
+    def checkpoint(self):
+        """
+        In WAL mode, write the data to the JSON file and empty the log.
+        """
+
+        with self._lock:
+            self._checkpoint(self._data)
+
+    def _checkpoint(self, data):
+        content = self.serializer.dumps(meta_first(data))
+
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as handle:
+            handle.write(content)
+            handle.flush()
+            os.fsync(handle.fileno())
+        replace(tmp_path, self.path)
+        fsync_dir(self.path)
+
+        # A crash before the log is reset leaves a log that doesn't match
+        # the new file, it is dropped on the next open
+        self._wal.reset(checksum(content))
+
+        self._data = data
+        self._indexes.clear()
+        self._generation += 1
+
+    def _apply(self, record):
+        if self._data is None:
+            self._data = {}
+
+        table = record['table']
+        apply_indexed(self._data, self._indexes, table, record['op'],
+                      record['data'], record.get('key', 'id'))
+        set_meta(self._data, table, record.get('meta'))
+        self._generation += 1
+        self._generations[table] = self._generations.get(table, 0) + 1
+
+
+class FileLock(object):
+    """
+    An advisory lock shared between processes (with ``fcntl.flock``), kept
+    in a file of its own so the locked file can be replaced.
+
+    The lock file also holds a generation counter, which the holder of the
+    exclusive lock bumps after every change. Reading the counter tells
+    whether another process changed something without reading the data.
+
+    The lock is reentrant. A shared lock can't be upgraded to an exclusive
+    one. Only available where :mod:`fcntl` is (i.e. not on Windows).
+    """
+
+    def __init__(self, path):
+        """
+        :param path: The lock file, created if it doesn't exist.
+        """
+
+        if fcntl is None:
+            raise ValueError('File locking is not available on this platform')
+
+        self.path = path
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o666)
+
+        # Locks held by other threads of this process share the file lock,
+        # they wait here instead
+        self._guard = threading.RLock()
+        self._depth = 0
+        self._exclusive = False
+
+    def _acquire(self, exclusive):
+        self._guard.acquire()
+        try:
+            if not self._depth:
+                fcntl.flock(self._fd,
+                            fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+                self._exclusive = exclusive
+            elif exclusive and not self._exclusive:
+                raise RuntimeError('A shared lock can not be upgraded')
+        except Exception:
+            self._guard.release()
+            raise
+
+        self._depth += 1
+
+    def _release(self):
+        self._depth -= 1
+        if not self._depth:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self._guard.release()
+
+    @contextmanager
+    def reading(self):
+        self._acquire(False)
+        try:
+            yield
+        finally:
+            self._release()
+
+    @contextmanager
+    def writing(self):
+        self._acquire(True)
+        try:
+            yield
+        finally:
+            self._release()
+
+    def generation(self):
+        """
+        Get the generation counter.
+
+        :returns: the counter or ``None`` if it couldn't be read (e.g.
+                  while it is written)
+        """
+
+        with self._guard:
+            os.lseek(self._fd, 0, os.SEEK_SET)
+            content = os.read(self._fd, 32)
+
+        try:
+            return int(content) if content else 0
+        except ValueError:
+            return None
+
+    def bump(self):
+        """
+        Increment the generation counter. Requires the exclusive lock.
+        """
+
+        generation = (self.generation() or 0) + 1
+
+        # Fixed width, so it is overwritten in a single write
+        os.lseek(self._fd, 0, os.SEEK_SET)
+        os.write(self._fd, '{0:020d}'.format(generation).encode('ascii'))
+
+        return generation
+
+    def close(self):
+        os.close(self._fd)
+
+
+class WriteAheadLog(object):
+    """
+    The write-ahead log of a :class:`JSONStorage` in WAL mode.
+
+    Holds one JSON record per line. The first line holds the CRC32 checksum
+    of the JSON file the log belongs to. A log whose checksum doesn't match
+    the file was written before the last checkpoint and is dropped.
+    """
+
+    def __init__(self, path, sync=True):
+        touch(path)
+        self.path = path
+        self.sync_enabled = sync
+
+        #: The number of records in the log
+        self.records = 0
+
+        self._handle = None
+        self._written = 0
+        self._synced = 0
+        self._sync_lock = threading.Lock()
+
+    def replay(self, checksum):
+        """
+        Read the logged records, if the log belongs to the file with the
+        given checksum.
+
+        A truncated last line (e.g. after a crash mid-append) is dropped.
+
+        :returns: the logged records
+        :rtype: list[dict]
+        """
+
+        records = []
+        offset = 0
+
+        with open(self.path, 'rb') as handle:
+            for line in handle:
+                try:
+                    record = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    break
+
+                if not offset and record.get('checksum') != checksum:
+                    break  # Stale log
+                if offset:
+                    records.append(record)
+                offset += len(line)
+
+        if not offset:
+            self.reset(checksum)
+            return []
+
+        if offset != os.path.getsize(self.path):
+            with open(self.path, 'r+b') as handle:
+                handle.truncate(offset)
+
+        self._handle = open(self.path, 'ab')
+        self.records = len(records)
+
+        return records
+
+    def reset(self, checksum):
+        """
+        Empty the log for the file with the given checksum.
+        """
+
+        with self._sync_lock:
+            if self._handle is not None:
+                self._handle.close()
+
+            with open(self.path, 'wb') as handle:
+                line = json.dumps({'checksum': checksum}) + '\n'
+                handle.write(line.encode('utf-8'))
+                handle.flush()
+                os.fsync(handle.fileno())
+
+            self._handle = open(self.path, 'ab')
+            self.records = 0
+            self._synced = self._written
+
+    def write(self, line):
+        """
+        Append a record to the log, without syncing it.
+
+        :returns: the position of the record to pass to :meth:`sync`
+        """
+
+        self._handle.write((line + '\n').encode('utf-8'))
+        self._handle.flush()
+        self.records += 1
+        self._written += 1
+
+        return self._written
+
+    def sync(self, position):
+        """
+        Make sure the log is on disk up to the given position.
+
+        Callers arriving while a sync is running wait for it. If it covered
+        their records too, they return without syncing again.
+        """
+
+        if not self.sync_enabled:
+            return
+
+        with self._sync_lock:
+            if self._synced >= position:
+                return
+
+            written = self._written
+            os.fsync(self._handle.fileno())
+            self._synced = written
+
+    def close(self):
+        self._handle.close()
+
+
+class LogStorage(Storage):
+    """
+    Store the data as an append-only log of table operations.
+
+    Every change is appended to the file as a single JSON line, so writing
+    costs the size of the change instead of the size of the database. The
+    log is replayed into memory when the storage is opened and compacted into
+    a snapshot once it has grown large compared to the live data, or when
+    :meth:`compact` is called.
+    """
+
+    #: The number of logged records below which the log is never compacted
+    COMPACT_MIN_RECORDS = 1000
+
+    partial_writes = True
+
+    def __init__(self, path, create_dirs=False, compact_ratio=2, **kwargs):
+        """
+        Create a new instance.
+
+        Also creates the log file, if it doesn't exist.
+
+        :param path: Where to store the log.
+        :type path: str
+        :param compact_ratio: Compact the log once it holds more than
+                              ``compact_ratio`` times as many records as the
+                              database.
+
+        All other keyword arguments are passed to ``json.dumps``, except
+        ``indent`` and ``separators`` which could split a record over
+        several lines.
+        """
+
+        super(LogStorage, self).__init__()
+        touch(path, create_dirs=create_dirs)  # Create file if not exists
+        self.path = path
+        self.compact_ratio = compact_ratio
+        self.kwargs = line_kwargs(kwargs)
+
+        self._data = None
+        self._indexes = {}
+        self._size = 0
+        self._logged = 0
+        self._generation = 0
+
+        # Bumped when the whole database is replaced, and per changed table
+        self._epoch = 0
+        self._generations = {}
+
+        self._replay()
+
+        self._handle = open(path, 'ab')
+
+    def _replay(self):
+        """
+        Rebuild the database state from the log file.
+
+        A truncated last line (e.g. after a crash mid-append) is dropped.
+        Any other line that can't be decoded means the file isn't a log
+        written by this storage, so it is left untouched.
+
+        :raises ValueError: if a line other than a truncated last one can't
+                            be decoded
+        """
+
+        offset = 0
+        with open(self.path, 'rb') as handle:
+            for line in handle:
+                try:
+                    record = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    # Lines are written with their newline at once, so only
+                    # an unterminated last line can be cut off by a crash
+                    if not offset or line.endswith(b'\n') or handle.read(1):
+                        raise ValueError('Invalid log record at byte {0} of '
+                                         '{1}'.format(offset, self.path))
+                    break
+                self._apply(record)
+                offset += len(line)
+
+        if offset != os.path.getsize(self.path):
+            with open(self.path, 'r+b') as handle:
+                handle.truncate(offset)
+
+    def _apply(self, record):
+        op = record['op']
+        self._generation += 1
+
+        if op == 'reset':
+            self._data = record['data']
+            self._indexes.clear()
+            self._epoch += 1
+            self._size = sum(len(rows) for rows in (self._data or {}).values()
+                             if isinstance(rows, list))
+            self._logged = 0
+            return
+
+        if self._data is None:
+            self._data = {}
+
+        table = record['table']
+        self._generations[table] = self._generations.get(table, 0) + 1
+        size = len(self._data.get(table) or [])
+        payload = record['data']
+        apply_indexed(self._data, self._indexes, table, op, payload,
+                      record.get('key', 'id'))
+        set_meta(self._data, table, record.get('meta'))
+        self._size += len(self._data[table]) - size
+        self._logged += len(payload) or 1
+
+    def _log(self, record):
+        # Serialize first so a record that can't be encoded changes nothing
+        line = json.dumps(record, **self.kwargs)
+        self._handle.write((line + '\n').encode('utf-8'))
+        self._handle.flush()
+
+        # Apply the decoded line, so the state is exactly what a replay
+        # of the log would produce
+        self._apply(json.loads(line))
+
+        if self._logged > max(self.COMPACT_MIN_RECORDS,
+                              self.compact_ratio * self._size):
+            self.compact()
+
+    def compact(self):
+        """
+        Replace the log by a single snapshot of the current state.
+        """
+
+        self._rewrite(self._data)
+
+    def _rewrite(self, data):
+        line = json.dumps({'op': 'reset', 'data': data}, **self.kwargs) + '\n'
+
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as handle:
+            handle.write(line.encode('utf-8'))
+            handle.flush()
+            os.fsync(handle.fileno())
+
+        # The snapshot replaces the whole log, so it has to be on disk
+        # before the rename and the rename before anything is appended
+        self._handle.close()
+        replace(tmp_path, self.path)
+        fsync_dir(self.path)
+        self._handle = open(self.path, 'ab')
+
+        self._apply(json.loads(line))
+
+    def close(self):
+        self._handle.close()
+
+    def stamp(self):
+        return self._generation
+
+    def table_stamp(self, table):
+        return (self._epoch, self._generations.get(table, 0))
+
+    def read(self):
+        return self._data
+
+    def write(self, data):
+        self._rewrite(data)
+
+    def append(self, table, op, payload, id_field='id', meta=None):
+        record = {'op': op, 'table': table, 'data': payload, 'key': id_field}
+        if meta is not None:
+            record['meta'] = meta
+        self._log(record)
+
+
+class DirectoryStorage(Storage):
+    """
+    Store every table in its own JSON file inside a directory.
+
+    A manifest file maps the table names to their files. Changing a table
+    only rewrites the file of that table, and tables are only read when they
+    are used.
+
+    The table files are written with a
+    :class:`~flata.serializers.Serializer` (JSON by default), the manifest
+    is always JSON. The manifest also holds the metadata of the tables; it
+    is written before the table file, so a crash in between can leave the
+    metadata ahead of the records but never lets an id be used twice.
+    """
+
+    #: The name of the manifest file
+    MANIFEST = 'manifest.json'
+
+    partial_writes = True
+
+    def __init__(self, path, create_dirs=False, serializer=None, **kwargs):
+        """
+        Create a new instance.
+
+        Also creates the directory, if it doesn't exist.
+
+        :param path: The directory to store the tables in.
+        :type path: str
+        :param create_dirs: Also create missing parent directories.
+        :param serializer: The format of the table files, by default JSON
+                           written with ``json.dumps(data, **kwargs)``.
+        :type serializer: flata.serializers.Serializer
+        """
+
+        super(DirectoryStorage, self).__init__()
+        if not os.path.isdir(path):
+            if create_dirs:
+                os.makedirs(path)
+            else:
+                os.mkdir(path)
+
+        self.path = path
+        self.kwargs = kwargs
+        self.serializer = serializer or JSONSerializer(**kwargs)
+
+        self._manifest = None
+        self._manifest_stamp = None
+        self._meta = {}
+
+        # The records of the tables read so far and the stamps of their
+        # files at that time
+        self._rows = {}
+        self._stamps = {}
+        self._indexes = {}
+        self._generations = {}
+
+    def _file_stamp(self, table):
+        if table not in self._tables():
+            return None
+
+        try:
+            stat = os.stat(self._table_path(table))
+        except OSError:
+            return None
+
+        # Our own writes bump the generation, changes by other processes
+        # show up in the file's modification time, size or inode
+        return (self._generations.get(table, 0),
+                getattr(stat, 'st_mtime_ns', stat.st_mtime), stat.st_size,
+                stat.st_ino)
+
+    def _tables(self):
+        """
+        Get the manifest, reading it again if it was changed.
+        """
+
+        manifest_path = os.path.join(self.path, self.MANIFEST)
+        try:
+            stat = os.stat(manifest_path)
+        except OSError:
+            self._manifest, self._manifest_stamp = None, None
+            self._meta = {}
+            return {}
+
+        stamp = (getattr(stat, 'st_mtime_ns', stat.st_mtime), stat.st_size,
+                 stat.st_ino)
+        if self._manifest is None or stamp != self._manifest_stamp:
+            with open(manifest_path) as handle:
+                manifest = json.load(handle)
+            self._manifest = manifest['tables']
+            self._meta = manifest.get('meta', {})
+            self._manifest_stamp = stamp
+
+        return self._manifest
+
+    def _save_manifest(self, tables, meta=None):
+        meta = self._meta if meta is None else meta
+        self._dump(self.MANIFEST, {'tables': tables, 'meta': meta},
+                   JSONSerializer())
+        self._manifest = tables
+        self._meta = meta
+        self._manifest_stamp = None
+
+    def _table_path(self, table):
+        return os.path.join(self.path, self._tables()[table])
+
+    def _add_table(self, table, meta=None):
+        """
+        Assign a file to a new table and store its metadata.
+        """
+
+        tables = dict(self._tables())
+        if meta is not None:
+            meta = dict(self._meta, **{table: meta})
+        if table in tables:
+            if meta is not None:
+                self._save_manifest(tables, meta)
+            return
+
+        base = re.sub(r'[^A-Za-z0-9_-]', '_', table) or '_'
+        used = set(tables.values())
+        used.add(self.MANIFEST)
+
+        extension = self.serializer.extension
+        name, i = '{0}.{1}'.format(base, extension), 1
+        while name in used:
+            name, i = '{0}-{1}.{2}'.format(base, i, extension), i + 1
+
+        tables[table] = name
+        self._save_manifest(tables, meta)
+
+    def _dump(self, name, data, serializer):
+        # Write to a temporary file first, so readers never see a half
+        # written file
+        path = os.path.join(self.path, name)
+
+        with open(path + '.tmp', 'wb') as handle:
+            serializer.dump(data, handle)
+        replace(path + '.tmp', path)
+
+    def _load(self, table):
+        """
+        Get the records of a table, reading its file if it was changed.
+        """
+
+        stamp = self._file_stamp(table)
+        if stamp is None:
+            self._forget(table)
+            return None
+
+        if stamp != self._stamps.get(table):
+            with open(self._table_path(table), 'rb') as handle:
+                self._rows[table] = self.serializer.loads(handle.read())
+            self._stamps[table] = stamp
+            self._indexes.pop(table, None)
+
+        return self._rows[table]
+
+    def _forget(self, table):
+        for cache in (self._rows, self._stamps, self._indexes):
+            cache.pop(table, None)
+
+    def _save(self, table, meta=None):
+        self._add_table(table, meta)
+        self._dump(self._tables()[table], self._rows[table], self.serializer)
+
+        self._generations[table] = self._generations.get(table, 0) + 1
+        self._stamps[table] = self._file_stamp(table)
+
+    def stamp(self):
+        tables = self._tables()
+        return (self._manifest_stamp,) + tuple(
+            self._file_stamp(table) for table in sorted(tables))
+
+    def table_stamp(self, table):
+        return self._file_stamp(table)
+
+    def table_names(self):
+        return set(self._tables())
+
+    def read_table(self, table):
+        return self._load(table)
+
+    def read_meta(self, table):
+        self._tables()
+        return self._meta.get(table)
+
+    def write_table(self, table, rows, meta=None):
+        self._rows[table] = rows
+        self._indexes.pop(table, None)
+        self._save(table, meta)
+
+    def drop_table(self, table):
+        tables = dict(self._tables())
+        name = tables.pop(table, None)
+        if name is None:
+            return
+
+        meta = dict(self._meta)
+        meta.pop(table, None)
+        self._save_manifest(tables, meta)
+        os.remove(os.path.join(self.path, name))
+        self._forget(table)
+
+    def read(self):
+        if not os.path.exists(os.path.join(self.path, self.MANIFEST)):
+            return None
+
+        data = dict((table, self._load(table)) for table in self._tables())
+        if self._meta:
+            data[META_KEY] = dict(self._meta)
+        return data
+
+    def write(self, data):
+        data = dict(data)
+        meta = data.pop(META_KEY, None) or {}
+
+        for table in set(self._tables()) - set(data):
+            self.drop_table(table)
+
+        for table, rows in data.items():
+            self._rows[table] = rows
+            self._indexes.pop(table, None)
+            self._save(table, meta.get(table))
+
+        if not data:
+            self._save_manifest({}, {})
+
+    def append(self, table, op, payload, id_field='id', meta=None):
+        self._load(table)
+        apply_indexed(self._rows, self._indexes, table, op, payload, id_field)
+        self._save(table, meta)
 
 
 class MemoryStorage(Storage):
@@ -117,6 +1479,8 @@ class MemoryStorage(Storage):
     Store the data as JSON in memory.
     """
 
+    partial_writes = True
+
     def __init__(self,*args, **kwargs):
         """
         Create a new instance.
@@ -124,9 +1488,34 @@ class MemoryStorage(Storage):
 
         super(MemoryStorage, self).__init__()
         self.memory = None
+        self._indexes = {}
+        self._generation = 0
+
+        # Bumped when the whole database is replaced, and per changed table
+        self._epoch = 0
+        self._generations = {}
+
+    def stamp(self):
+        return self._generation
+
+    def table_stamp(self, table):
+        return (self._epoch, self._generations.get(table, 0))
 
     def read(self):
         return self.memory
 
     def write(self, data):
         self.memory = data
+        self._indexes.clear()
+        self._generation += 1
+        self._epoch += 1
+
+    def append(self, table, op, payload, id_field='id', meta=None):
+        if self.memory is None:
+            self.memory = {}
+
+        apply_indexed(self.memory, self._indexes, table, op, payload,
+                      id_field)
+        set_meta(self.memory, table, meta)
+        self._generation += 1
+        self._generations[table] = self._generations.get(table, 0) + 1
@@ -0,0 +1,226 @@
+"""
+Contains a streaming reader for JSON database files.
+
+:class:`JSONStreamReader` reads a database file in chunks and decodes one
+table record at a time, so tables larger than the available memory can be
+iterated over, and the names of the tables can be listed without decoding
+any record:
+
+>>> with open('db.json', 'rb') as handle:
+...     for record in JSONStreamReader(handle).records('users'):
+...         print(record)
+"""
+
+import codecs
+import json
+import re
+
+__all__ = ('JSONStreamReader',)
+
+#: How many bytes to read at once
+CHUNK_SIZE = 64 * 1024
+
+_NON_WHITESPACE = re.compile(r'\S')
+_STRUCTURAL = re.compile(r'["\[\]{}]')
+_STRING_SPECIAL = re.compile(r'["\\]')
+
+
+class JSONStreamReader(object):
+    """
+    Reads a JSON database file (an object holding a list of records per
+    table) incrementally.
+
+    Only the records being decoded and one chunk of the file are held in
+    memory. The values of tables that aren't wanted are skipped without
+    decoding them.
+    """
+
+    def __init__(self, handle, chunk_size=CHUNK_SIZE):
+        """
+        :param handle: The file to read, opened in binary mode.
+        :param chunk_size: How many bytes to read at once.
+        """
+
+        self._handle = handle
+        self.chunk_size = chunk_size
+
+        self._text = codecs.getincrementaldecoder('utf-8')()
+        self._decoder = json.JSONDecoder()
+        self._buffer = ''
+        self._pos = 0
+        self._eof = False
+
+    def tables(self):
+        """
+        Get the names of the tables in the file.
+
+        :returns: a generator of table names
+        """
+
+        for name in self._keys():
+            yield name
+            self._skip()
+
+    def records(self, table):
+        """
+        Get the records of a table, one at a time.
+
+        Yields nothing if the table doesn't exist.
+
+        :param table: The name of the table.
+        :returns: a generator of records
+        """
+
+        for name in self._keys():
+            if name != table:
+                self._skip()
+                continue
+
+            self._expect('[')
+            if self._peek() == ']':
+                return
+
+            while True:
+                yield self._decode()
+                if self._expect(',]') == ']':
+                    return
+
+    def value(self, key):
+        """
+        Decode the value of a single top level key, skipping the others.
+
+        :param key: The key.
+        :returns: the value or ``None`` if the key doesn't exist
+        """
+
+        for name in self._keys():
+            if name == key:
+                return self._decode()
+            self._skip()
+
+    # --- Parsing -------------------------------------------------------------
+
+    def _keys(self):
+        """
+        Walk the top level object, yielding its keys. The value of a key has
+        to be consumed before the next key is yielded.
+        """
+
+        if self._peek() == '':
+            return  # Empty file
+
+        self._expect('{')
+        if self._peek() == '}':
+            return
+
+        while True:
+            name = self._decode()
+            self._expect(':')
+            yield name
+            if self._expect(',}') == '}':
+                return
+
+    def _fill(self, size=None):
+        """
+        Read the next chunk, dropping the consumed part of the buffer.
+
+        :returns: ``False`` at the end of the file
+        """
+
+        if self._eof:
+            return False
+
+        chunk = self._handle.read(size or self.chunk_size)
+        self._eof = not chunk
+
+        self._buffer = (self._buffer[self._pos:] +
+                        self._text.decode(chunk, final=self._eof))
+        self._pos = 0
+
+        return bool(chunk)
+
+    def _peek(self):
+        """
+        Skip whitespace and get the next character, ``''`` at the end of
+        the file.
+        """
+
+        while True:
+            match = _NON_WHITESPACE.search(self._buffer, self._pos)
+            if match is not None:
+                self._pos = match.start()
+                return self._buffer[self._pos]
+
+            self._pos = len(self._buffer)
+            if not self._fill():
+                return ''
+
+    def _expect(self, chars):
+        char = self._peek()
+        if not char or char not in chars:
+            raise ValueError('Expected {0!r} at {1!r}'.format(
+                chars, self._buffer[self._pos:self._pos + 20]))
+
+        self._pos += 1
+        return char
+
+    def _decode(self):
+        """
+        Decode the next value.
+        """
+
+        self._peek()
+
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._pos)
+            except ValueError:
+                # Probably cut off at the end of the buffer, read at least
+                # as much again so large values don't take many attempts
+                if self._fill(max(self.chunk_size, len(self._buffer))):
+                    continue
+                raise
+
+            if end == len(self._buffer) and self._fill():
+                continue  # A number could go on in the next chunk
+
+            self._pos = end
+            return value
+
+    def _skip(self):
+        """
+        Skip the next value without decoding it.
+        """
+
+        if self._peek() not in '[{':
+            self._decode()  # Strings and scalars are cheap to decode
+            return
+
+        depth = 0
+        in_string = False
+
+        while True:
+            pattern = _STRING_SPECIAL if in_string else _STRUCTURAL
+            match = pattern.search(self._buffer, self._pos)
+
+            if match is None or (match.group() == '\\' and
+                                 match.end() == len(self._buffer)):
+                # Keep a trailing backslash, it escapes the next character
+                self._pos = match.start() if match else len(self._buffer)
+                if not self._fill():
+                    raise ValueError('Unexpected end of file')
+                continue
+
+            char = match.group()
+            self._pos = match.end()
+
+            if char == '\\':
+                self._pos += 1
+            elif char == '"':
+                in_string = not in_string
+            elif char in '[{':
+                depth += 1
+            else:
+                depth -= 1
+                if not depth:
+                    return
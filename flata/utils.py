@@ -2,9 +2,16 @@
 Utility functions.
 """
 
+from collections import OrderedDict
 from contextlib import contextmanager
+import threading
 import warnings
 
+try:
+    get_ident = threading.get_ident
+except AttributeError:  # Python 2
+    get_ident = threading._get_ident
+
 # Python 2/3 independant dict iteration
 iteritems = getattr(dict, 'iteritems', dict.items)
 itervalues = getattr(dict, 'itervalues', dict.values)
@@ -13,32 +20,86 @@ itervalues = getattr(dict, 'itervalues', dict.values)
 class LRUCache(dict):
     """
     A simple LRU cache.
+
+    The usage order is kept in an :class:`~collections.OrderedDict`, so hits,
+    inserts and evictions take constant time.
+
+    Besides the number of items, the cache can be bounded by their total
+    weight, e.g. the number of elements in cached query results:
+
+    >>> cache = LRUCache(capacity=10, max_weight=1000, weigher=len)
     """
 
     def __init__(self, *args, **kwargs):
         """
         :param capacity: How many items to store before cleaning up old items
                          or ``None`` for an unlimited cache size
+        :param max_weight: The total weight of the items to store before
+                           cleaning up old items or ``None`` for no limit
+        :param weigher: A function returning the weight of an item
+                        (defaults to ``len``)
         """
 
         self.capacity = kwargs.pop('capacity', None) or float('nan')
-        self.lru = []
+        self.max_weight = kwargs.pop('max_weight', None) or float('nan')
+        self.weigher = kwargs.pop('weigher', None) or len
+        self.weight = 0
 
-        super(LRUCache, self).__init__(*args, **kwargs)
+        self._order = OrderedDict()
+        self._weights = {}
+
+        super(LRUCache, self).__init__()
+
+        for key, value in iteritems(dict(*args, **kwargs)):
+            self[key] = value
+
+    @property
+    def lru(self):
+        """
+        The keys from the least to the most recently used one.
+        """
+
+        return list(self._order)
 
     def refresh(self, key):
         """
         Push a key to the tail of the LRU queue
         """
-        if key in self.lru:
-            self.lru.remove(key)
-        self.lru.append(key)
+        self._order.pop(key, None)
+        self._order[key] = None
 
     def get(self, key, default=None):
-        item = super(LRUCache, self).get(key, default)
-        self.refresh(key)
+        if key not in self:
+            return default
 
-        return item
+        return self[key]
+
+    def peek(self, key, default=None):
+        """
+        Get an item without marking it as used.
+        """
+
+        return super(LRUCache, self).get(key, default)
+
+    def reweigh(self, key):
+        """
+        Update the weight of an item that was changed in place, without
+        marking it as used.
+        """
+
+        if not self._weighted:
+            return
+
+        weight = self.weigher(super(LRUCache, self).__getitem__(key))
+        if weight > self.max_weight:
+            del self[key]
+            return
+
+        self.weight += weight - self._weights.pop(key, 0)
+        if weight:
+            self._weights[key] = weight
+
+        self._shrink()
 
     def __getitem__(self, key):
         item = super(LRUCache, self).__getitem__(key)
@@ -47,23 +108,174 @@ class LRUCache(dict):
         return item
 
     def __setitem__(self, key, value):
+        weight = self.weigher(value) if self._weighted else 0
+        if weight > self.max_weight:
+            # A single item heavier than the whole cache isn't kept, and
+            # doesn't push out the others
+            self.pop(key, None)
+            return
+
+        if key in self:
+            self.weight -= self._weights.pop(key, 0)
+
         super(LRUCache, self).__setitem__(key, value)
 
         self.refresh(key)
+        if weight:
+            self._weights[key] = weight
+            self.weight += weight
+
+        self._shrink()
+
+    def _shrink(self):
+        """
+        Remove the least recently used items until the cache is within its
+        bounds again.
+        """
 
         # Check, if the cache is full and we have to remove old items
         # If the queue is of unlimited size, self.capacity is NaN and
         # x > NaN is always False in Python and the cache won't be cleared.
-        if len(self) > self.capacity:
-            self.pop(self.lru.pop(0))
+        while len(self) > self.capacity or self.weight > self.max_weight:
+            del self[next(iter(self._order))]
 
     def __delitem__(self, key):
         super(LRUCache, self).__delitem__(key)
-        self.lru.remove(key)
+        del self._order[key]
+        self.weight -= self._weights.pop(key, 0)
+
+    def pop(self, key, *default):
+        if key not in self:
+            return super(LRUCache, self).pop(key, *default)
+
+        value = super(LRUCache, self).__getitem__(key)
+        del self[key]
+
+        return value
 
     def clear(self):
         super(LRUCache, self).clear()
-        del self.lru[:]
+        self._order.clear()
+        self._weights.clear()
+        self.weight = 0
+
+    @property
+    def _weighted(self):
+        return self.max_weight == self.max_weight  # NaN != NaN
+
+
+class ReadWriteLock(object):
+    """
+    A readers-writer lock: many threads may read at once, a writer has the
+    lock to itself.
+
+    Waiting writers are preferred over new readers, so a steady stream of
+    reads can't starve them. Both sides are reentrant and the thread
+    holding the write lock may also read, but a read lock can't be
+    upgraded to a write lock.
+
+    >>> lock = ReadWriteLock()
+    >>> with lock.reading():
+    ...     pass
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = {}  # Thread ident -> depth
+        self._writer = None
+        self._writer_depth = 0
+        self._waiting_writers = 0
+
+    def acquire_read(self):
+        me = get_ident()
+        with self._cond:
+            if self._writer == me or me in self._readers:
+                self._readers[me] = self._readers.get(me, 0) + 1
+                return
+
+            while self._writer is not None or self._waiting_writers:
+                self._cond.wait()
+            self._readers[me] = 1
+
+    def release_read(self):
+        me = get_ident()
+        with self._cond:
+            depth = self._readers[me] - 1
+            if depth:
+                self._readers[me] = depth
+                return
+
+            del self._readers[me]
+            if not self._readers:
+                self._cond.notify_all()
+
+    def acquire_write(self):
+        me = get_ident()
+        with self._cond:
+            if self._writer == me:
+                self._writer_depth += 1
+                return
+            if me in self._readers:
+                raise RuntimeError('A read lock can not be upgraded')
+
+            self._waiting_writers += 1
+            try:
+                while self._writer is not None or self._readers:
+                    self._cond.wait()
+            finally:
+                self._waiting_writers -= 1
+
+            self._writer = me
+            self._writer_depth = 1
+
+    def release_write(self):
+        with self._cond:
+            self._writer_depth -= 1
+            if not self._writer_depth:
+                self._writer = None
+                self._cond.notify_all()
+
+    @contextmanager
+    def reading(self):
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read()
+
+    @contextmanager
+    def writing(self):
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release_write()
+
+
+class NullLock(object):
+    """
+    A lock that doesn't lock, used where no synchronization is wanted.
+
+    Stands in for both a :class:`threading.Lock` and a
+    :class:`ReadWriteLock`.
+    """
+
+    def acquire(self, *args):
+        return True
+
+    def release(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def reading(self):
+        return self
+
+    writing = reading
 
 
 # Source: https://github.com/PythonCharmers/python-future/blob/466bfb2dfa36d865285dc31fe2b0c0a53ff0f181/future/utils/__init__.py#L102-L134
@@ -138,3 +350,22 @@ def freeze(obj):
         return frozenset(obj)
     else:
         return obj
+
+
+def copy_nested(obj):
+    """
+    Copy a value together with the dicts and lists nested in it, so
+    changing the copy never changes the original. Other values are shared.
+    """
+
+    if isinstance(obj, dict):
+        copy = dict(obj)
+        for key, value in iteritems(obj):
+            if isinstance(value, (dict, list)):
+                copy[key] = copy_nested(value)
+        return copy
+    elif isinstance(obj, list):
+        return [copy_nested(el) if isinstance(el, (dict, list)) else el
+                for el in obj]
+    else:
+        return obj
@@ -0,0 +1,114 @@
+import asyncio
+
+import pytest
+
+from flata import where
+from flata.aio import AsyncFlata
+from flata.storages import MemoryStorage
+
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def test_crud(tmpdir):
+    async def main():
+        async with AsyncFlata(str(tmpdir.join('db.json'))) as db:
+            table = db.table('t')
+
+            assert await table.insert({'int': 1}) == {'id': 1, 'int': 1}
+            assert await table.insert_multiple([{'int': 2}, {'int': 3}]) == [
+                {'id': 2, 'int': 2}, {'id': 3, 'int': 3}]
+
+            assert await table.update({'int': 4}, where('int') == 3) == (
+                [3], [{'id': 3, 'int': 4}])
+            assert await table.remove(ids=[1]) == ([1], [])
+
+            assert await table.search(where('int') > 1) == [
+                {'id': 2, 'int': 2}, {'id': 3, 'int': 4}]
+            assert await table.get(id=2) == {'id': 2, 'int': 2}
+            assert await table.count() == 2
+            assert await table.count(where('int') == 4) == 1
+            assert await table.contains(ids=[1]) is False
+            assert len(await table.all()) == 2
+
+            assert await db.tables() == set(['t'])
+            await db.purge_table('t')
+            assert await db.tables() == set()
+
+            with pytest.raises(ValueError):
+                await table.insert('a')
+
+    run(main())
+
+
+def test_writes_coalesced():
+    async def main():
+        db = AsyncFlata(storage=MemoryStorage)
+        table = db.table('t')
+        await table.count()
+
+        writes = []
+        apply = table.table._storage.apply
+        table.table._storage.apply = lambda op, payload, last_id: (
+            writes.append(op), apply(op, payload, last_id))[1]
+
+        elements = await asyncio.gather(*[table.insert({'i': i})
+                                          for i in range(50)])
+        assert [element['id'] for element in elements] == list(range(1, 51))
+        assert writes == ['insert']
+
+        # Other writes aren't merged
+        del writes[:]
+        await asyncio.gather(table.update({'j': 1}, ids=[1]),
+                             table.update({'j': 2}, ids=[2]),
+                             table.insert({'i': 60}), table.insert({'i': 61}))
+        assert writes == ['update', 'update', 'insert']
+
+        # Reads made after writes see them
+        results = await asyncio.gather(table.remove(where('i') < 10),
+                                       table.count(), table.insert({'i': 50}),
+                                       table.count())
+        assert results[1] == 42
+        assert results[3] == 43
+
+        await db.close()
+
+    run(main())
+
+
+def test_errors_reported_per_operation():
+    async def main():
+        db = AsyncFlata(storage=MemoryStorage)
+        table = db.table('t')
+
+        results = await asyncio.gather(table.insert({'i': 1}),
+                                       table.remove(ids=[5]),
+                                       table.insert({'i': 2}),
+                                       return_exceptions=True)
+        assert results[0] == {'id': 1, 'i': 1}
+        assert isinstance(results[1], KeyError)
+        assert results[2] == {'id': 2, 'i': 2}
+
+        await db.close()
+
+    run(main())
+
+
+def test_close_doesnt_block_the_loop():
+    async def main():
+        db = AsyncFlata(storage=MemoryStorage)
+        await db.table('t').insert({'i': 1})
+
+        shutdowns = []
+        shutdown = db._executor.shutdown
+        db._executor.shutdown = lambda wait=True: (
+            shutdowns.append(wait), shutdown(wait))
+        await db.close()
+        assert shutdowns == [False]
+
+    run(main())
@@ -0,0 +1,107 @@
+import threading
+
+from flata import where
+from flata.compiler import compile_query
+from flata.queries import QueryImpl
+
+elements = [
+    {'int': 1, 'char': 'a', 'list': [1, 2], 'nested': {'x': 'Abc'}},
+    {'int': 2, 'char': 'b', 'list': [{'y': 1}], 'nested': {'x': 'abd'}},
+    {'int': 3, 'char': 'A', 'list': [], 'nested': None},
+    {'char': 'c'},
+]
+
+
+def test_compiled_matches_original():
+    def is_odd(value, mod):
+        return value % mod == 1
+
+    queries = [
+        where('int') == 1,
+        where('int') != 1,
+        where('int') < 2,
+        where('int') <= 2,
+        where('int') > 2,
+        where('int') >= 2,
+        where('int').exists(),
+        where('nested').x.exists(),
+        where('nested').x.matches('A'),
+        where('nested').x.matches_ignore_case('a'),
+        where('nested').x.search('b'),
+        where('nested').x.search_ignore_case('B'),
+        where('int').test(is_odd, 2),
+        where('list').any([2, 3]),
+        where('list').any([{'y': 1}]),
+        where('list').any(where('y') == 1),
+        where('list').all([1]),
+        where('list').all(where('y') == 1),
+        where('char').any('ab'),
+        (where('int') == 1) & (where('char') == 'a'),
+        (where('int') == 1) | (where('char') == 'c'),
+        ~(where('int') == 1),
+        ~~(where('int') == 1),
+        ((where('int') > 1) & ~(where('char') == 'b')) | where('list').any([1]),
+    ]
+
+    for query in queries:
+        compiled = compile_query(query)
+        assert compiled is not query
+        for element in elements:
+            assert bool(compiled(element)) == bool(query(element)), query
+
+
+def test_compiled_cached():
+    assert compile_query(where('int') == 1) is compile_query(where('int') == 1)
+    assert compile_query(where('int') == 1) is not compile_query(
+        where('int') == 2)
+
+
+def test_compiled_cache_threads():
+    errors = []
+
+    def compile_many(offset):
+        try:
+            for i in range(2000):
+                query = where('int') == (i + offset) % 600
+                assert compile_query(query)({'int': (i + offset) % 600})
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=compile_many, args=(i * 100,))
+               for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+
+
+def test_compiled_long_chain():
+    query = where('int') == 0
+    for i in range(1, 500):
+        query = query | (where('int') == i)
+
+    compiled = compile_query(query)
+    assert compiled({'int': 499})
+    assert not compiled({'int': 500})
+
+
+def test_compiled_reorder_falls_back():
+    query = where('x').test(lambda x: x == 3) & (where('x') < 5)
+    compiled = compile_query(query)
+
+    assert not compiled({'x': 'b'})
+    assert compiled({'x': 3})
+
+
+def test_compile_opaque_query():
+    query = QueryImpl(lambda value: value.get('int') == 1, ('custom',))
+
+    assert compile_query(query)({'int': 1})
+    assert compile_query(query & (where('char') == 'a'))(elements[0])
+
+
+def test_ignore_case_hash():
+    assert where('a').matches('x') != where('a').matches_ignore_case('x')
+    assert where('a').search('x') != where('a').search_ignore_case('x')
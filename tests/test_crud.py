@@ -4,7 +4,7 @@ import sys
 import pytest
 
 from flata import Flata, where, Query
-from flata.storages import MemoryStorage
+from flata.storages import DirectoryStorage, LogStorage, MemoryStorage
 from flata.middlewares import Middleware, CachingMiddleware
 
 def test_insert(db):
@@ -75,6 +75,49 @@ def test_insert_multiple_with_ids(db):
                                      {'id': 3, 'char': 'c', 'int': 1}]
 
 
+def test_insert_multiple_chunks(db):
+    db.purge_tables()
+    table = db.table('t')
+    assert len(table) == 0  # Creates the table
+    writes = []
+    progress = []
+
+    apply = table._storage.apply
+    table._storage.apply = lambda op, payload, last_id: (
+        writes.append(len(payload)), apply(op, payload, last_id))[1]
+
+    inserted = table.insert_multiple(({'int': i} for i in range(10)),
+                                     chunk_size=4, callback=progress.append)
+
+    assert writes == [4, 4, 2]
+    assert progress == [4, 8, 10]
+    assert [e['id'] for e in inserted] == list(range(1, 11))
+    assert table.get(id=10) == {'id': 10, 'int': 9}
+
+
+def test_insert_multiple_count(db):
+    db.purge_tables()
+    table = db.table('t')
+    progress = []
+
+    assert table.insert_multiple(({'int': i} for i in range(10)),
+                                 chunk_size=4, callback=progress.append,
+                                 return_elements=False) == 10
+    assert progress == [4, 8, 10]
+    assert table.insert_multiple([], return_elements=False) == 0
+    assert table.get(id=10) == {'id': 10, 'int': 9}
+
+
+def test_insert_multiple_invalid(db):
+    with pytest.raises(ValueError):
+        db.table('t').insert_multiple([{'int': 1}, 1])
+
+    with pytest.raises(ValueError):
+        db.table('t').insert_multiple([{'int': 1}], chunk_size=0)
+
+    assert len(db.table('t')) == 3
+
+
 def test_remove(db):
     db.table('t').remove(where('char') == 'b')
     assert len(db.table('t').all()) == 2
@@ -146,6 +189,34 @@ def test_update_transform(db):
     assert db.table('t').count(where('int') == 1) == 2
 
 
+def test_update_transform_element(db):
+    def tag(el):
+        el['tag'] = el.id * 10
+
+    db.table('t').update(tag, where('char') == 'b')
+
+    assert db.table('t').get(where('char') == 'b')['tag'] == 20
+    assert db.table('t').count(where('tag').exists()) == 1
+
+
+def test_update_fails_partway(db):
+    db.purge_tables()
+    tb = db.table('t')
+    tb.create_index('n')
+    tb.insert_multiple([{'n': 1}, {'n': 'x'}])
+
+    def transform(el):
+        el['n'] += 1
+
+    with pytest.raises(TypeError):
+        tb.update(transform, where('n').exists())
+
+    # Nothing was changed, not even the element processed before the error
+    assert tb.all() == [{'id': 1, 'n': 1}, {'id': 2, 'n': 'x'}]
+    assert tb.search(where('n') == 1) == [{'id': 1, 'n': 1}]
+    assert tb.search(where('n') == 2) == []
+
+
 def test_update_ids(db):
     db.table('t').update({'int': 2}, ids=[1, 2])
 
@@ -339,6 +410,26 @@ def test_unique_ids(tmpdir):
         assert len(ids) == len(set(ids))
 
 
+def test_lazy_table(tmpdir):
+    path = str(tmpdir.join('test.db.json'))
+
+    with Flata(path) as _db:
+        _db.table('t').insert({'i': 1})
+
+    with Flata(path) as _db:
+        reads = []
+        read = _db._storage.read
+        _db._storage.read = lambda: reads.append(1) or read()
+
+        table = _db.table('t')
+        _db.table('unused')
+        assert _db.get('t') is table
+        assert not reads
+
+        assert _db.tables() == set(['t', 'unused'])
+        assert table.insert({'i': 2})['id'] == 2
+
+
 def test_lastid_after_open(tmpdir):
     NUM = 100
     path = str(tmpdir.join('test.db.json'))
@@ -350,6 +441,54 @@ def test_lastid_after_open(tmpdir):
         assert _db.table('t')._last_id == NUM
 
 
+@pytest.mark.parametrize('options', [{}, {'wal': True},
+                                     {'storage': LogStorage},
+                                     {'storage': DirectoryStorage},
+                                     {'storage': MemoryStorage}])
+def test_ids_monotonic(tmpdir, options):
+    path = str(tmpdir.join('test.db.json'))
+
+    with Flata(path, **options) as _db:
+        table = _db.table('t')
+        table.insert_multiple({'i': i} for i in range(3))
+        table.remove(ids=[3])
+        table.purge()
+        assert table.insert({'i': 3})['id'] == 4
+        assert table._storage.meta()['last_id'] == 4
+
+    if options.get('storage') is not MemoryStorage:
+        with Flata(path, **options) as _db:
+            table = _db.table('t')
+            table.purge()
+            assert table.insert({'i': 4})['id'] == 5
+
+
+def test_len_from_meta(tmpdir):
+    path = str(tmpdir.join('test.db.json'))
+
+    with Flata(path) as _db:
+        table = _db.table('t')
+        table.insert_multiple({'i': i} for i in range(10))
+        table.remove(where('i') < 3)
+
+    with Flata(path) as _db:
+        table = _db.table('t')
+        assert len(table) == 7
+        assert table._storage._data is None  # Not read
+
+        assert table.insert({'i': 10})['id'] == 11
+        assert len(table) == 8
+
+
+def test_mixed_key_types():
+    table = Flata(storage=MemoryStorage).table('t')
+    table.insert({1: 'a', 'b': 2})
+    table.insert({None: 3})
+
+    assert table.get(id=1) == {1: 'a', 'b': 2, 'id': 1}
+    assert table._storage.meta()['fields'] == [1, None, 'b', 'id']
+
+
 @pytest.mark.skipif(sys.version_info >= (3, 0),
                     reason="requires python2")
 def test_unicode_memory(db):
@@ -0,0 +1,180 @@
+import pytest
+
+from flata import Flata, where
+from flata.indexes import HashIndex, SortedIndex
+from flata.storages import MemoryStorage
+
+
+@pytest.fixture
+def table():
+    db = Flata(storage=MemoryStorage)
+    table = db.table('t')
+    table.insert_multiple([
+        {'name': 'john', 'age': 30, 'tags': ['a', 'b'], 'address': {'zip': 1}},
+        {'name': 'jane', 'age': 25, 'tags': ['b'], 'address': {'zip': 2}},
+        {'name': 'jack', 'age': 41, 'tags': 'abc'},
+        {'name': 'jill', 'tags': []},
+        {'age': 25.0},
+    ])
+    return table
+
+
+def scan(table, cond):
+    return [element for element in table.all() if cond(element)]
+
+
+def test_hash_index(table):
+    table.create_index('name')
+    table.create_index('tags')
+
+    for cond in [where('name') == 'jane',
+                 where('name') == 'nobody',
+                 where('tags') == ['b'],
+                 where('tags').any(['b']),
+                 where('tags').any(['c', 'x']),
+                 (where('name') == 'john') | (where('name') == 'jack'),
+                 (where('name') == 'john') & (where('age') == 30),
+                 (where('name') == 'john') & (where('age') == 31)]:
+        assert table.search(cond) == scan(table, cond)
+
+    assert table.explain(where('name') == 'jane').ids() == set([2])
+    # Strings are iterable, so they are candidates for every membership test
+    assert table.explain(where('tags').any(['x'])).ids() == set([3])
+
+
+def test_sorted_index(table):
+    table.create_index('age', kind='sorted')
+
+    for cond in [where('age') == 25,
+                 where('age') < 30,
+                 where('age') <= 30,
+                 where('age') > 30,
+                 where('age') >= 30,
+                 (where('age') > 20) & (where('age') < 40)]:
+        assert table.search(cond) == scan(table, cond)
+
+    assert table.explain(where('age') < 30).ids() == set([2, 5])
+
+
+def test_sorted_index_mixed_types(table):
+    table.insert({'age': 'old'})
+    table.insert({'age': None})
+    table.create_index('age', kind='sorted')
+
+    def outcome(search, cond):
+        try:
+            return search(cond)
+        except TypeError:  # Python 3 doesn't order mixed types
+            return TypeError
+
+    # Range queries check the values of other types like a full scan does,
+    # instead of skipping them
+    for cond in [where('age') > 30,
+                 where('age') <= 'x',
+                 where('age') == 25]:
+        assert outcome(table.search, cond) == outcome(
+            lambda c: scan(table, c), cond)
+
+    table.remove(where('age').test(lambda age: age in ('old', None)))
+    assert table.search(where('age') < 30) == scan(table, where('age') < 30)
+
+
+def test_nested_index(table):
+    table.create_index(['address', 'zip'])
+
+    assert table.search(where('address').zip == 2) == [
+        {'id': 2, 'name': 'jane', 'age': 25, 'tags': ['b'],
+         'address': {'zip': 2}}]
+    assert table.explain(where('address').zip == 2).ids() == set([2])
+
+
+def test_index_maintained(table):
+    table.create_index('name')
+    table.create_index('age', kind='sorted')
+
+    table.insert({'name': 'jane', 'age': 19})
+    table.update({'name': 'jane'}, where('name') == 'john')
+    table.remove(where('age') == 25)
+
+    assert [e.id for e in table.search(where('name') == 'jane')] == [1, 6]
+    assert [e.id for e in table.search(where('age') < 31)] == [1, 6]
+    assert table.get(where('name') == 'jane').id == 1
+    assert table.count(where('name') == 'jack') == 1
+    assert not table.contains(where('name') == 'john')
+
+
+def test_index_rebuilt_after_external_change(table):
+    table.create_index('name')
+    table._storage._storage.write({'t': [{'id': 1, 'name': 'jim'}]})
+
+    assert table.search(where('name') == 'jim') == [{'id': 1, 'name': 'jim'}]
+    assert table.search(where('name') == 'jane') == []
+
+
+def test_drop_index(table):
+    table.create_index('name')
+    table.drop_index('name')
+
+    assert table.explain(where('name') == 'jane').ids() is None
+    assert len(table.search(where('name') == 'jane')) == 1
+
+
+def test_index_definitions_persisted(tmpdir):
+    path = str(tmpdir.join('db.json'))
+
+    with Flata(path) as db:
+        table = db.table('t')
+        table.insert_multiple({'name': name} for name in 'abc')
+        table.create_index('name')
+        table.create_index(['address', 'zip'], kind='sorted')
+        table.drop_index(['address', 'zip'])
+
+    with Flata(path) as db:
+        table = db.table('t')
+        assert table.explain(where('name') == 'b').ids() == set([2])
+        assert list(table._storage.indexes) == [('name',)]
+
+
+def test_unknown_index_kind(table):
+    with pytest.raises(ValueError):
+        table.create_index('name', kind='btree')
+
+
+def test_index_classes():
+    hash_index = HashIndex('x')
+    sorted_index = SortedIndex('x')
+
+    for index in (hash_index, sorted_index):
+        index.build({1: {'x': 1}, 2: {'x': 'a'}, 3: {'y': 1}, 4: {'x': None}})
+
+    assert hash_index.lookup('==', 1) == set([1])
+    assert hash_index.lookup('<', 1) is None
+    assert sorted_index.lookup('==', 1) == set([1])
+    assert sorted_index.lookup('==', None) is None
+
+    # Values of other types are candidates of every range query
+    assert sorted_index.lookup('<=', 1) == set([1, 2, 4])
+    assert sorted_index.lookup('>', 'A') == set([1, 2, 4])
+    assert sorted_index.estimate('<=', 1) == 3
+
+    for index in (hash_index, sorted_index):
+        index.discard(1)
+        assert index.lookup('==', 1) == set()
+
+
+def test_sorted_index_build_matches_add():
+    data = dict((id, {'x': value}) for id, value in enumerate(
+        [3, 'b', 1, 2.5, 1, 'a', None, True, 3, 'b'], 1))
+
+    built = SortedIndex('x')
+    built.build(data)
+
+    added = SortedIndex('x')
+    for id, element in data.items():
+        added.add(id, element)
+
+    assert built._sorted == added._sorted
+    assert len(built) == len(added) == 9
+
+    built.discard(1)
+    assert built.lookup('==', 3) == set([9])
@@ -1,8 +1,12 @@
+import json
 import os
+import time
 
-from flata import Flata
-from flata.middlewares import CachingMiddleware
-from flata.storages import MemoryStorage, JSONStorage
+import pytest
+
+from flata import Flata, where
+from flata.middlewares import BoundedCachingMiddleware, CachingMiddleware
+from flata.storages import DirectoryStorage, MemoryStorage, JSONStorage
 
 if 'xrange' not in dir(__builtins__):
     # noinspection PyShadowingBuiltins
@@ -94,3 +98,173 @@ def test_caching_json_write(tmpdir):
     # Repoen database
     with Flata(path, storage=CachingMiddleware(JSONStorage)) as db:
         assert db.table('t').all() == [{'id':1, 'key': 'value'}]
+
+
+def test_caching_policies(monkeypatch):
+    storage = CachingMiddleware(MemoryStorage, write_cache_size=3)()
+    other = CachingMiddleware(MemoryStorage)()
+    assert (storage.WRITE_CACHE_SIZE, other.WRITE_CACHE_SIZE) == (3, 1000)
+
+    storage = CachingMiddleware(MemoryStorage, max_dirty_bytes=100)()
+    storage.append('t', 'insert', [{'id': 1, 'text': 'a' * 50}])
+    assert storage.storage.memory is None
+    storage.append('t', 'insert', [{'id': 2, 'text': 'b' * 50}])
+    assert len(storage.storage.memory['t']) == 2
+
+    # Writing the whole database isn't encoded to estimate its size
+    storage = CachingMiddleware(MemoryStorage, max_dirty_bytes=100)()
+    encoded = []
+    monkeypatch.setattr(json, 'dumps', lambda *args, **kwargs: (
+        encoded.append(args[0]), '')[1])
+    storage.write({'t': [{'id': 1, 'text': 'a' * 200}]})
+    storage.append('t', 'remove', [1])
+    assert encoded == [[1]]
+    monkeypatch.undo()
+
+    storage = CachingMiddleware(MemoryStorage, flush_interval=0.01)()
+    storage.write({'t': []})
+    assert storage.storage.memory is None
+    time.sleep(0.02)
+    storage.write({'t': [{'id': 1}]})
+    assert storage.storage.memory == {'t': [{'id': 1}]}
+
+
+def test_caching_background_flush():
+    with pytest.raises(ValueError):
+        CachingMiddleware(MemoryStorage, background=True)
+
+    storage = CachingMiddleware(MemoryStorage, flush_interval=0.01,
+                                background=True)()
+    storage.write(element)
+    assert storage.storage.memory is None
+
+    for _ in range(100):
+        if storage.storage.memory:
+            break
+        time.sleep(0.01)
+    assert storage.storage.memory == element
+
+    # Errors of the background flush are raised by the next write
+    def fail(data):
+        raise IOError('disk full')
+
+    storage.storage.write = fail
+    storage.write({})
+    time.sleep(0.1)
+    with pytest.raises(IOError):
+        storage.write(element)
+
+    del storage.storage.write
+    storage.close()
+    assert storage.storage.memory == {}
+
+
+def test_caching_flushes_dirty_tables():
+    storage = CachingMiddleware(MemoryStorage)()
+    storage.write({'a': [{'id': 1}], 'b': [], 'c': []})
+    storage.flush()
+
+    calls = []
+    write, write_table = storage.storage.write, storage.storage.write_table
+    storage.storage.write = lambda data: (calls.append('all'), write(data))
+    storage.storage.write_table = lambda table, rows, meta=None: (
+        calls.append(table), write_table(table, rows, meta))
+
+    # Nothing changed
+    storage.flush()
+    storage.append('a', 'update', [])
+    storage.flush()
+    assert calls == []
+
+    storage.append('a', 'insert', [{'id': 2}], meta={'last_id': 2})
+    storage.append('a', 'remove', [1])
+    storage.drop_table('c')
+    storage.flush()
+
+    assert calls == ['a']
+    assert storage.storage.memory == {
+        'a': [{'id': 2}], 'b': [], '__meta__': {'a': {'last_id': 2}}}
+
+    # Storages rewriting everything anyway get a single write
+    storage.storage.partial_writes = False
+    storage.append('a', 'insert', [{'id': 3}])
+    storage.append('b', 'insert', [{'id': 1}])
+    storage.flush()
+    assert calls == ['a', 'all']
+
+
+@pytest.mark.parametrize('policy', ['lru', 'lfu'])
+def test_bounded_caching(tmpdir, policy):
+    path = str(tmpdir.join('db'))
+    storage = BoundedCachingMiddleware(DirectoryStorage, max_rows=10,
+                                       policy=policy)
+
+    with Flata(path, storage=storage) as db:
+        for name in 'abc':
+            db.table(name).insert_multiple({'i': i} for i in range(4))
+
+        # Only two tables fit, the first was evicted and written back
+        stats = storage.stats()
+        assert (stats['tables'], stats['rows']) == (2, 8)
+        assert stats['evictions'] == 1
+        assert sorted(storage._rows) == ['b', 'c']
+        assert len(DirectoryStorage(path).read_table('a')) == 4
+
+        for _ in range(3):
+            db.table('b').get(id=1)
+            storage.read_table('b')
+        storage.read_table('c')
+        hits = storage.hits
+
+        # LRU evicts b (c was used after it), LFU evicts c (used less)
+        db.table('a').update({'i': 9}, ids=[1])
+        assert sorted(storage._rows) == (['a', 'c'] if policy == 'lru'
+                                         else ['a', 'b'])
+        assert storage.misses >= 4 and storage.hits > hits
+
+        # Uncached tables are still complete
+        assert db.table('c').count(where('i') < 2) == 2
+        assert db.tables() == set('abc')
+
+    with Flata(path, storage=DirectoryStorage) as db:
+        assert db.table('a').get(id=1) == {'id': 1, 'i': 9}
+        assert len(db.table('b')) == 4
+
+
+def test_bounded_caching_drop():
+    storage = BoundedCachingMiddleware(MemoryStorage, max_rows=3)()
+    storage.write({'a': [{'id': 1}], 'b': [{'id': 1}, {'id': 2}]})
+    assert storage.storage.memory is None
+
+    storage.flush()
+    assert storage.read() == {'a': [{'id': 1}], 'b': [{'id': 1}, {'id': 2}]}
+
+    storage.drop_table('a')
+    assert storage.table_names() == set(['b'])
+    assert storage.read_table('a') is None
+    storage.flush()
+    assert storage.storage.table_names() == set(['b'])
+
+    with pytest.raises(ValueError):
+        BoundedCachingMiddleware(MemoryStorage, policy='fifo')
+
+
+def test_bounded_caching_oversized_table(tmpdir):
+    path = str(tmpdir.join('db'))
+    storage = BoundedCachingMiddleware(DirectoryStorage, max_rows=2)
+
+    with Flata(path, storage=storage) as db:
+        tb = db.table('t')
+        tb.insert_multiple({'i': i} for i in range(3))
+        assert storage.stats()['tables'] == 0
+
+        # Changing a table larger than the budget writes it back at once
+        tb.insert({'i': 3})
+        assert storage.stats()['tables'] == 0
+        assert len(DirectoryStorage(path).read_table('t')) == 4
+
+        storage.append('t', 'remove', [])
+        assert storage.stats()['tables'] == 0
+
+    with Flata(path, storage=DirectoryStorage) as db:
+        assert [e['i'] for e in db.table('t')] == [0, 1, 2, 3]
@@ -0,0 +1,91 @@
+import pytest
+
+from flata import Flata, where
+from flata.planner import FullScan, IndexScan, Intersect, Union, cost
+from flata.storages import MemoryStorage
+
+
+@pytest.fixture
+def table():
+    db = Flata(storage=MemoryStorage)
+    table = db.table('t')
+    table.insert_multiple({'name': name, 'age': age, 'city': city}
+                          for name, age, city in [('john', 30, 'paris'),
+                                                  ('jane', 25, 'paris'),
+                                                  ('jack', 41, 'rome'),
+                                                  ('jill', 19, 'paris')])
+    table.create_index('name')
+    table.create_index('city')
+    table.create_index('age', kind='sorted')
+    return table
+
+
+def test_explain_index_scan(table):
+    plan = table.explain(where('name') == 'jane')
+
+    assert isinstance(plan.source, IndexScan)
+    assert plan.rows == 1
+    assert repr(plan) == ("Filter(('==', ('name',), 'jane'), "
+                          "source=IndexScan(hash index on name: == 'jane', "
+                          "rows=1))")
+
+
+def test_explain_full_scan(table):
+    def is_old(age):
+        return age > 40
+
+    assert isinstance(table.explain(where('age').test(is_old)).source,
+                      FullScan)
+    assert isinstance(table.explain(~(where('name') == 'jane')).source,
+                      FullScan)
+    assert isinstance(table.explain((where('name') == 'jane') |
+                                    where('age').test(is_old)).source,
+                      FullScan)
+    assert table.search(where('age').test(is_old)) == [
+        {'id': 3, 'name': 'jack', 'age': 41, 'city': 'rome'}]
+
+
+def test_explain_and_most_selective_first(table):
+    plan = table.explain((where('city') == 'paris') & (where('name') == 'john'))
+
+    assert isinstance(plan.source, Intersect)
+    assert [child.rows for child in plan.source.children] == [1, 3]
+    assert plan.ids() == set([1])
+
+
+def test_explain_and_short_circuit(table):
+    plan = table.explain((where('name') == 'nobody') & (where('age') > 0))
+
+    calls = []
+    table._storage.indexes[('age',)].lookup = lambda *args: calls.append(args)
+
+    assert plan.ids() == set()
+    assert table.search((where('name') == 'nobody') & (where('age') > 0)) == []
+    assert not calls
+
+
+def test_explain_or(table):
+    plan = table.explain((where('name') == 'jack') | (where('age') < 20))
+
+    assert isinstance(plan.source, Union)
+    assert plan.ids() == set([3, 4])
+    assert [e.id for e in table.search(
+        (where('name') == 'jack') | (where('age') < 20))] == [3, 4]
+
+
+def test_filter_cheapest_first(table):
+    cond = where('name').matches('^j') & (where('age') > 20)
+    plan = table.explain(cond)
+
+    assert [c.hashval[0] for c in plan.conditions] == ['>', 'matches']
+    assert cost(where('name').matches('^j')) > cost(where('age') > 20)
+
+
+def test_filter_reorder_falls_back():
+    db = Flata(storage=MemoryStorage)
+    table = db.table('t')
+    table.insert_multiple([{'x': 'b'}, {'x': 3}])
+
+    # Checking 'b' < 5 first would raise, the original order doesn't
+    cond = where('x').test(lambda x: x == 3) & (where('x') < 5)
+    assert table.search(cond) == [{'id': 2, 'x': 3}]
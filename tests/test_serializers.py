@@ -0,0 +1,143 @@
+# coding=utf-8
+import gzip
+
+import pytest
+
+from flata import Flata, where
+from flata.serializers import (BinarySerializer, CompressedSerializer,
+                               JSONSerializer, PickleSerializer, convert)
+from flata.storages import DirectoryStorage, JSONStorage
+
+data = {
+    't': [{'id': 1, 'int': -3, 'big': 2 ** 70, 'float': 3.25, 'none': None,
+           'bool': [True, False], 'text': u'été', 'list': [1, 'a'],
+           'nested': {'a': {'b': []}}},
+          {'id': 2, 'int': 0, 'empty': {}}],
+    'u': [],
+    'v': [[1, 2], []],
+}
+
+serializers = [JSONSerializer(), PickleSerializer(), BinarySerializer()]
+
+
+@pytest.mark.parametrize('serializer', serializers)
+def test_roundtrip(serializer):
+    content = serializer.dumps(data)
+
+    assert isinstance(content, bytes)
+    assert serializer.loads(content) == data
+    assert serializer.loads(bytearray(content)) == data
+
+
+def test_binary_compact():
+    rows = {'t': [{'id': i, 'name': 'user', 'active': True}
+                  for i in range(1000)]}
+
+    binary = BinarySerializer().dumps(rows)
+    assert len(binary) < len(JSONSerializer().dumps(rows)) / 2
+
+    # Keys are stored once
+    assert binary.count(b'name') == 1
+
+
+def test_binary_tuples():
+    serializer = BinarySerializer()
+    assert serializer.loads(serializer.dumps({'a': (1, 2)})) == {'a': [1, 2]}
+
+
+def test_binary_errors():
+    serializer = BinarySerializer()
+
+    with pytest.raises(TypeError):
+        serializer.dumps({1: 'a'})
+    with pytest.raises(TypeError):
+        serializer.dumps({'a': set([1])})
+    with pytest.raises(ValueError):
+        serializer.loads(b'{"a": 1}')
+
+
+def test_convert(tmpdir):
+    source = str(tmpdir.join('db.json'))
+    target = str(tmpdir.join('db.bin'))
+
+    with Flata(source) as db:
+        db.table('t').insert_multiple({'int': i} for i in range(10))
+
+    convert(source, target, JSONSerializer(), BinarySerializer())
+
+    with Flata(target, serializer=BinarySerializer()) as db:
+        assert db.table('t').count(where('int') < 5) == 5
+
+
+@pytest.mark.parametrize('options', [{}, {'mmap': True}, {'wal': True}])
+def test_json_storage_serializer(tmpdir, options):
+    path = str(tmpdir.join('db.bin'))
+
+    with Flata(path, serializer=BinarySerializer(), **options) as db:
+        db.table('t').insert({'int': 1})
+        db.table('t').update({'int': 2}, ids=[1])
+
+    assert tmpdir.join('db.bin').read_binary().startswith(b'FLB1')
+    assert JSONStorage(path, serializer=BinarySerializer()).read_table(
+        't') == [{'id': 1, 'int': 2}]
+
+
+def test_directory_storage_serializer(tmpdir):
+    path = str(tmpdir.join('db'))
+
+    with Flata(path, storage=DirectoryStorage,
+               serializer=PickleSerializer()) as db:
+        db.table('t').insert({'int': 1})
+
+    assert tmpdir.join('db', 't.pickle').check()
+    with Flata(path, storage=DirectoryStorage,
+               serializer=PickleSerializer()) as db:
+        assert db.table('t').all() == [{'id': 1, 'int': 1}]
+
+
+@pytest.mark.parametrize('method', ['zlib', 'gzip', 'bz2', 'lzma'])
+def test_compressed(method):
+    rows = {'t': [{'id': i, 'name': 'user', 'active': True}
+                  for i in range(1000)]}
+
+    for inner in (JSONSerializer(), BinarySerializer()):
+        serializer = CompressedSerializer(inner, method, level=1)
+        content = serializer.dumps(rows)
+
+        assert serializer.loads(content) == rows
+        assert len(content) * 5 < len(inner.dumps(rows))
+
+
+def test_compressed_streams():
+    rows = {'t': [{'id': i, 'text': 'x' * 100} for i in range(2000)]}
+    writes = []
+
+    class Handle(object):
+        def write(self, chunk):
+            writes.append(len(chunk))
+
+    JSONSerializer().dump(rows, Handle())
+    assert len(writes) > 1
+    assert max(writes) < sum(writes)
+
+    serializer = CompressedSerializer(JSONSerializer(), 'zlib')
+    assert serializer.loads(serializer.dumps(rows)) == rows
+
+
+def test_compressed_storage(tmpdir):
+    path = str(tmpdir.join('db.json.gz'))
+    serializer = CompressedSerializer(method='gzip', level=9)
+    assert serializer.extension == 'json.gz'
+
+    with Flata(path, serializer=serializer) as db:
+        db.table('t').insert({'int': 1})
+
+    with gzip.open(path) as handle:
+        content = handle.read()
+    assert content.startswith(b'{"__meta__": ')
+    assert content.endswith(b'"t": [{"int": 1, "id": 1}]}')
+
+
+def test_compressed_unknown_method():
+    with pytest.raises(ValueError):
+        CompressedSerializer(method='zip')
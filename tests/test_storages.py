@@ -1,14 +1,22 @@
+import multiprocessing
 import os
 import random
 import tempfile
 
 import pytest
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 
 random.seed()
 
 from flata import Flata, where
-from flata.storages import JSONStorage, MemoryStorage, Storage
+from flata.middlewares import CachingMiddleware
+from flata.storages import (DirectoryStorage, JSONStorage, LogStorage,
+                            MemoryStorage, PrimaryIndex, Storage)
 
 element = {'none': [None, None], 'int': 42, 'float': 3.1415899999999999,
            'list': ['LITE', 'RES_ACID', 'SUS_DEXT'],
@@ -40,6 +48,16 @@ def test_json_kwargs(tmpdir):
     print(db_file.read())
 
     assert db_file.read() == '''{
+    "__meta__": {
+        "test_table": {
+            "count": 1,
+            "fields": [
+                "b",
+                "id"
+            ],
+            "last_id": 1
+        }
+    },
     "test_table": [
         {
             "b": 1,
@@ -50,6 +68,23 @@ def test_json_kwargs(tmpdir):
     db.close()
 
 
+@pytest.mark.parametrize('options', [{}, {'atomic': True}, {'wal': True}])
+def test_json_meta_first(tmpdir, options):
+    path = str(tmpdir.join('test.db'))
+
+    with Flata(path, **options) as db:
+        db.table('a').insert_multiple({'i': i} for i in range(100))
+        db.table('b').insert({'i': 1})
+
+    # The metadata is found without reading the tables
+    content = tmpdir.join('test.db').read()
+    assert content.startswith('{"__meta__": ')
+
+    storage = JSONStorage(path)
+    assert storage.read_meta('a')['count'] == 100
+    storage.close()
+
+
 def test_json_readwrite(tmpdir):
     """
     Regression test for issue #1
@@ -107,6 +142,516 @@ def test_json_invalid_directory():
             pass
 
 
+def test_json_atomic(tmpdir):
+    path = str(tmpdir.join('test.db'))
+
+    storage = JSONStorage(path, atomic=True)
+    reader = JSONStorage(path)
+    os.chmod(path, 0o640)
+    inode = os.stat(path).st_ino
+
+    storage.write(element)
+    assert os.stat(path).st_ino != inode
+    assert os.stat(path).st_mode & 0o777 == 0o640
+    assert os.listdir(str(tmpdir)) == ['test.db']
+
+    # Other instances reopen the replaced file
+    stamp = reader.stamp()
+    assert reader.read() == element
+    assert storage.read() == element
+
+    storage.write({'t': []})
+    assert reader.stamp() != stamp
+    assert reader.read() == {'t': []}
+
+    # A failed write leaves the file alone
+    with pytest.raises(TypeError):
+        storage.write({'t': [object()]})
+    assert storage.read() == {'t': []}
+    assert os.listdir(str(tmpdir)) == ['test.db']
+
+    storage.close()
+    reader.close()
+
+
+needs_fcntl = pytest.mark.skipif(fcntl is None, reason='requires fcntl')
+
+
+@needs_fcntl
+@pytest.mark.parametrize('atomic', [False, True])
+def test_json_locking(tmpdir, atomic):
+    path = str(tmpdir.join('test.db'))
+
+    first = Flata(path, locking=True, atomic=atomic)
+    second = Flata(path, locking=True, atomic=atomic)
+    stamp = second._storage.stamp()
+
+    # Ids are reserved inside the lock, so they never collide
+    assert first.table('t').insert({'n': 1})['id'] == 1
+    assert second._storage.stamp() != stamp
+    assert second.table('t').insert({'n': 2})['id'] == 2
+    assert first.table('t').insert({'n': 3})['id'] == 3
+
+    assert len(second.table('t')) == 3
+    assert first.table('t').search(where('n') > 1) == [
+        {'id': 2, 'n': 2}, {'id': 3, 'n': 3}]
+
+    # Changes of the same size in the same instant are noticed too
+    first.table('t').update({'n': 4}, ids=[1])
+    assert second.table('t').get(id=1) == {'id': 1, 'n': 4}
+
+    with first._storage.transaction():
+        with open(path + '.lock') as handle:
+            with pytest.raises((IOError, OSError)):
+                fcntl.flock(handle, fcntl.LOCK_SH | fcntl.LOCK_NB)
+
+    with pytest.raises(ValueError):
+        JSONStorage(path, locking=True, wal=True)
+
+    first.close()
+    second.close()
+
+
+@needs_fcntl
+def test_json_locking_change_while_reading(tmpdir):
+    path = str(tmpdir.join('test.db'))
+
+    writer = Flata(path, locking=True)
+    reader = Flata(path, locking=True)
+    writer.table('t').insert({'n': 1})
+
+    # Another process commits right after the reader read the file
+    storage = reader._storage
+    read = storage.read
+
+    def read_then_commit():
+        data = read()
+        storage.read = read
+        writer.table('t').insert({'n': 2})
+        return data
+
+    storage.read = read_then_commit
+    assert len(reader.table('t').all()) == 1
+    assert len(reader.table('t').all()) == 2
+
+    # The same holds for a cache
+    cached = CachingMiddleware(JSONStorage)(path, locking=True)
+    cached_read = cached.storage.read
+    cached.storage.read = lambda: (
+        setattr(cached.storage, 'read', cached_read), cached_read(),
+        writer.table('t').insert({'n': 3}))[1]
+    assert len(cached.read()['t']) == 2
+    assert len(cached.read()['t']) == 3
+
+    cached.close()
+    reader.close()
+    writer.close()
+
+
+@needs_fcntl
+def test_json_locking_caching(tmpdir):
+    path = str(tmpdir.join('test.db'))
+
+    cached = Flata(path, cache=CachingMiddleware(JSONStorage)(path,
+                                                              locking=True))
+    other = Flata(path, locking=True)
+
+    assert cached.table('t').all() == []
+    cached._storage.flush()
+
+    other.table('t').insert({'n': 1})
+    assert cached.table('t').all() == [{'id': 1, 'n': 1}]
+
+    # Unwritten changes aren't dropped
+    cached.table('t').insert({'n': 2})
+    other.table('t').insert({'n': 3})
+    assert len(cached.table('t')) == 2
+
+    cached.close()
+    other.close()
+
+
+def _insert_many(path, n):
+    with Flata(path, locking=True) as db:
+        for i in range(20):
+            db.table('t').insert({'n': n, 'i': i})
+
+
+@needs_fcntl
+def test_json_locking_processes(tmpdir):
+    path = str(tmpdir.join('test.db'))
+
+    processes = [multiprocessing.Process(target=_insert_many, args=(path, n))
+                 for n in range(4)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+        assert process.exitcode == 0
+
+    with Flata(path, locking=True) as db:
+        ids = sorted(element.id for element in db.table('t'))
+        assert ids == list(range(1, 81))
+
+
+def test_json_mmap(tmpdir):
+    path = str(tmpdir.join('test.db'))
+    storage = JSONStorage(path, mmap=True)
+    assert storage.read() is None
+
+    storage.write(element)
+    assert element == storage.read()
+
+    mapping = storage._map
+    assert element == storage.read()
+    assert storage._map is mapping  # Reused while the file is unchanged
+
+    # Changed by someone else
+    with open(path, 'w') as handle:
+        handle.write('{"t": [{"id": 1, "text": "\\u00e9"}]}')
+    assert storage.read() == {'t': [{'id': 1, 'text': u'\u00e9'}]}
+    assert storage._map is not mapping
+
+    storage.close()
+    assert storage._map is None
+
+
+def test_json_wal(tmpdir):
+    path = str(tmpdir.join('test.db'))
+
+    db = Flata(path, wal=True)
+    tb = db.table('t')
+    tb.insert_multiple({'int': i} for i in range(3))
+    tb.update({'int': 10}, ids=[1])
+    tb.remove(ids=[2])
+
+    # Changes only went to the log
+    assert tmpdir.join('test.db').read() == ''
+    assert len(tmpdir.join('test.db-wal').readlines()) == 5
+
+    # Reopening without closing (like after a crash) replays the log
+    with Flata(path, wal=True) as other:
+        assert other.table('t').all() == [{'id': 1, 'int': 10},
+                                          {'id': 3, 'int': 2}]
+
+    # Closing checkpointed the log into the file
+    with Flata(path) as other:
+        assert len(other.table('t')) == 2
+    assert len(tmpdir.join('test.db-wal').readlines()) == 1
+
+
+def test_json_wal_kwargs(tmpdir):
+    path = str(tmpdir.join('test.db'))
+
+    db = Flata(path, wal=True, indent=2)
+    db.table('t').insert({'int': 1})
+    db.table('t').insert({'int': 2})
+
+    # Reopening without closing replays the log
+    with Flata(path, wal=True, indent=2) as other:
+        assert other.table('t').all() == [{'id': 1, 'int': 1},
+                                          {'id': 2, 'int': 2}]
+
+    # The file itself is still written with the given arguments
+    assert tmpdir.join('test.db').read().startswith('{\n  ')
+
+
+def test_json_wal_checkpoint(tmpdir):
+    path = str(tmpdir.join('test.db'))
+
+    with Flata(path, wal=True, checkpoint_size=4) as db:
+        tb = db.table('t')  # Logs the creation of the table
+        tb.insert({'int': 1})
+        tb.insert({'int': 2})
+        assert tmpdir.join('test.db').read() == ''
+
+        tb.insert({'int': 3})
+        assert len(JSONStorage(path).read()['t']) == 3
+        assert len(tmpdir.join('test.db-wal').readlines()) == 1
+
+
+def test_json_wal_stale(tmpdir):
+    path = str(tmpdir.join('test.db'))
+
+    storage = JSONStorage(path, wal=True)
+    storage.append('t', 'insert', [{'id': 1}])
+    with open(path + '-wal', 'ab') as handle:
+        handle.write(b'{"op": "insert", "tab')
+
+    # The truncated record is dropped
+    assert JSONStorage(path, wal=True).read() == {'t': [{'id': 1}]}
+
+    # A checkpoint interrupted before the log was reset
+    with open(path, 'w') as handle:
+        handle.write('{"t": [{"id": 1}]}')
+    assert JSONStorage(path, wal=True).read() == {'t': [{'id': 1}]}
+
+
+def test_json_wal_group_commit(tmpdir, monkeypatch):
+    import threading
+    import time
+
+    path = str(tmpdir.join('test.db'))
+    storage = JSONStorage(path, wal=True)
+    syncs = []
+
+    def fsync(fd):
+        syncs.append(fd)
+        time.sleep(0.05)
+
+    monkeypatch.setattr(os, 'fsync', fsync)
+
+    threads = [threading.Thread(target=storage.append,
+                                args=('t', 'insert', [{'id': i}]))
+               for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(storage.read()['t']) == 8
+    assert len(syncs) < 8
+
+
+def test_json_wal_group_commit_thread_safe(tmpdir, monkeypatch):
+    import threading
+    import time
+
+    path = str(tmpdir.join('test.db'))
+    db = Flata(path, wal=True, thread_safe=True)
+    tables = [db.table(str(i)) for i in range(8)]
+    for table in tables:
+        len(table)  # Creates the table
+    syncs = []
+
+    def fsync(fd):
+        syncs.append(fd)
+        time.sleep(0.05)
+
+    monkeypatch.setattr(os, 'fsync', fsync)
+
+    # Writers to different tables don't wait for each other's syncs
+    threads = [threading.Thread(target=table.insert, args=({'n': 1},))
+               for table in tables]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(syncs) < 8
+    assert all(len(table) == 1 for table in tables)
+    assert db.tables() == set(str(i) for i in range(8))
+    monkeypatch.undo()
+    db.close()
+
+
+def test_log(tmpdir):
+    # Write contents
+    path = str(tmpdir.join('test.log'))
+    storage = LogStorage(path)
+    storage.write(element)
+
+    # Verify contents
+    assert element == storage.read()
+    storage.close()
+
+    # Verify contents after reopening
+    storage = LogStorage(path)
+    assert element == storage.read()
+    storage.close()
+
+
+def test_log_appends(tmpdir):
+    path = str(tmpdir.join('test.log'))
+
+    with Flata(path, storage=LogStorage) as db:
+        tb = db.table('t')
+        tb.insert({'int': 1})
+        size = os.path.getsize(path)
+        content = tmpdir.join('test.log').read()
+
+        tb.insert_multiple({'int': i} for i in range(2, 5))
+        tb.update({'int': 10}, ids=[1])
+        tb.remove(where('int') == 2)
+
+        # Existing content is never rewritten
+        assert os.path.getsize(path) > size
+        assert tmpdir.join('test.log').read().startswith(content)
+
+    with Flata(path, storage=LogStorage) as db:
+        assert db.table('t').all() == [{'id': 1, 'int': 10},
+                                       {'id': 3, 'int': 3},
+                                       {'id': 4, 'int': 4}]
+
+
+def test_log_compact(tmpdir):
+    path = str(tmpdir.join('test.log'))
+
+    with Flata(path, storage=LogStorage) as db:
+        tb = db.table('t')
+        for i in range(10):
+            tb.insert({'int': i})
+        tb.remove(where('int') < 8)
+
+        db._storage.compact()
+
+        assert len(tmpdir.join('test.log').readlines()) == 1
+        assert len(tb) == 2
+
+    with Flata(path, storage=LogStorage) as db:
+        assert db.table('t').all() == [{'id': 9, 'int': 8},
+                                       {'id': 10, 'int': 9}]
+
+
+def test_log_compact_synced(tmpdir, monkeypatch):
+    import flata.storages
+
+    path = str(tmpdir.join('test.log'))
+    storage = LogStorage(path)
+    storage.append('t', 'insert', [{'id': 1}])
+    synced = []
+
+    monkeypatch.setattr(os, 'fsync', lambda fd: synced.append('file'))
+    monkeypatch.setattr(flata.storages, 'fsync_dir',
+                        lambda path: synced.append('dir'))
+    storage.compact()
+
+    # The snapshot is on disk before it replaces the log
+    assert synced == ['file', 'dir']
+    storage.close()
+
+
+def test_log_auto_compact(tmpdir):
+    path = str(tmpdir.join('test.log'))
+    storage = LogStorage(path)
+    storage.COMPACT_MIN_RECORDS = 5
+
+    storage.append('t', 'insert', [{'id': i} for i in range(5)])
+    assert len(tmpdir.join('test.log').readlines()) == 1
+
+    # Removing records grows the log while the data shrinks
+    storage.append('t', 'remove', [0, 1, 2, 3])
+    assert len(tmpdir.join('test.log').readlines()) == 1
+    assert storage.read() == {'t': [{'id': 4}]}
+    storage.close()
+
+
+def test_log_truncated(tmpdir):
+    path = str(tmpdir.join('test.log'))
+    storage = LogStorage(path)
+    storage.append('t', 'insert', [{'id': 1}])
+    storage.close()
+
+    # Simulate a crash in the middle of an append
+    with open(path, 'a') as handle:
+        handle.write('{"op": "insert", "ta')
+
+    storage = LogStorage(path)
+    assert storage.read() == {'t': [{'id': 1}]}
+
+    storage.append('t', 'insert', [{'id': 2}])
+    storage.close()
+
+    assert LogStorage(path).read() == {'t': [{'id': 1}, {'id': 2}]}
+
+
+def test_log_kwargs(tmpdir):
+    path = str(tmpdir.join('test.log'))
+
+    with Flata(path, storage=LogStorage, indent=2) as db:
+        db.table('t').insert({'int': 1})
+        db.table('t').insert({'int': 2})
+
+    for line in tmpdir.join('test.log').readlines():
+        assert line.startswith('{"') and line.endswith('}\n')
+
+    with Flata(path, storage=LogStorage, indent=2) as db:
+        assert db.table('t').all() == [{'id': 1, 'int': 1},
+                                       {'id': 2, 'int': 2}]
+
+
+def test_log_invalid(tmpdir):
+    path = str(tmpdir.join('test.log'))
+    content = '{\n  "op": "reset",\n  "data": {}\n}\n'
+    tmpdir.join('test.log').write(content)
+
+    with pytest.raises(ValueError):
+        LogStorage(path)
+
+    # The file isn't truncated
+    assert tmpdir.join('test.log').read() == content
+
+
+def test_directory(tmpdir):
+    # Write contents
+    path = str(tmpdir.join('db'))
+    storage = DirectoryStorage(path)
+    storage.write(element)
+
+    # Verify contents
+    assert element == storage.read()
+    storage.close()
+
+    # Verify contents after reopening
+    storage = DirectoryStorage(path)
+    assert element == storage.read()
+    assert storage.table_names() == set(element)
+    storage.close()
+
+
+def test_directory_tables(tmpdir):
+    path = str(tmpdir.join('db'))
+
+    with Flata(path, storage=DirectoryStorage) as db:
+        db.table('users').insert({'name': 'john'})
+        db.table('orders').insert_multiple({'total': i} for i in range(3))
+        db.table('a/b').insert({'x': 1})
+
+        users_mtime = os.stat(os.path.join(path, 'users.json')).st_mtime_ns
+        db.table('orders').update({'total': 10}, ids=[1])
+        db.table('orders').remove(ids=[2])
+
+        # Other tables are never rewritten
+        assert os.stat(os.path.join(path, 'users.json')).st_mtime_ns == \
+            users_mtime
+        assert sorted(os.listdir(path)) == ['a_b.json', 'manifest.json',
+                                            'orders.json', 'users.json']
+
+    with Flata(path, storage=DirectoryStorage) as db:
+        assert db.tables() == set(['users', 'orders', 'a/b'])
+        assert db.table('orders').all() == [{'id': 1, 'total': 10},
+                                            {'id': 3, 'total': 2}]
+
+        # Only the used table was read
+        assert set(db._storage._rows) == set(['orders'])
+
+        db.purge_table('users')
+        assert db.tables() == set(['orders', 'a/b'])
+        assert not os.path.exists(os.path.join(path, 'users.json'))
+
+        db.purge_tables()
+        assert db.tables() == set()
+        assert os.listdir(path) == ['manifest.json']
+
+
+def test_directory_detects_external_change(tmpdir):
+    path = str(tmpdir.join('db'))
+
+    with Flata(path, storage=DirectoryStorage) as db:
+        table = db.table('t')
+        table.insert({'int': 1})
+
+        with Flata(path, storage=DirectoryStorage) as other:
+            other.table('t').insert({'int': 2})
+            other.table('u').insert({'int': 3})
+
+        assert len(table) == 2
+        assert db.tables() == set(['t', 'u'])
+
+        table.update({'int': 4}, ids=[1])
+        assert [e['int'] for e in table.all()] == [4, 2]
+
+
 def test_in_memory():
     # Write contents
     storage = MemoryStorage()
@@ -121,6 +666,60 @@ def test_in_memory():
     assert other.read() != storage.read()
 
 
+def test_in_memory_append():
+    storage = MemoryStorage()
+    storage.append('t', 'insert', [{'id': i} for i in range(1, 6)])
+    storage.append('t', 'update', [{'id': 2, 'x': 1}])
+    storage.append('t', 'remove', [1, 4])
+    storage.append('t', 'update', [{'id': 5, 'x': 2}])
+    storage.append('t', 'insert', [{'id': 6}])
+
+    assert storage.read() == {'t': [{'id': 2, 'x': 1}, {'id': 3},
+                                    {'id': 5, 'x': 2}, {'id': 6}]}
+
+
+def test_primary_index():
+    rows = [{'id': i} for i in range(5)]
+    index = PrimaryIndex(rows)
+
+    def positions():
+        return dict((id, index.position(id)) for id in index.slots)
+
+    index.apply('remove', [3])
+    assert positions() == {0: 0, 1: 1, 2: 2, 4: 3}
+
+    index.apply('remove', [0, 2, 42])
+    assert rows == [{'id': 1}, {'id': 4}]
+    assert positions() == {1: 0, 4: 1}
+    assert index.position(3) is None
+
+    index.apply('insert', [{'id': 5}])
+    index.apply('update', [{'id': 4, 'x': 1}])
+    assert rows == [{'id': 1}, {'id': 4, 'x': 1}, {'id': 5}]
+    assert positions() == {1: 0, 4: 1, 5: 2}
+
+    # Removes leave tombstones instead of renumbering the records behind
+    assert index.slots[5] == 5
+    assert index.removed == [0, 2, 3]
+
+
+def test_primary_index_compact():
+    rows = [{'id': i} for i in range(10)]
+    index = PrimaryIndex(rows)
+    index.COMPACT_MIN_REMOVED = 2
+
+    index.apply('remove', [1])
+    index.apply('remove', [5, 7])
+    assert index.removed == [1, 5, 7]
+
+    # The tombstones outnumber the records afterwards
+    index.apply('remove', [0, 2, 4, 9])
+    assert index.removed == []
+    assert index.slots == {3: 0, 6: 1, 8: 2}
+    index.apply('update', [{'id': 8, 'x': 1}])
+    assert rows == [{'id': 3}, {'id': 6}, {'id': 8, 'x': 1}]
+
+
 def test_in_memory_close():
     with Flata('', storage=MemoryStorage) as db:
         db.table('t').insert({})
@@ -0,0 +1,94 @@
+# coding=utf-8
+import io
+import json
+
+import pytest
+
+from flata import Flata
+from flata.storages import JSONStorage
+from flata.streaming import JSONStreamReader
+
+data = {
+    'skipped': [{'id': 1, 'text': 'a "quoted" } ] { [ \\ string\\'},
+                {'id': 2, 'nested': {'a': [1, [2, {'b': '\\\\"'}]]}}],
+    'scalar': 'not a table',
+    'users': [{'id': 1, 'name': u'Jürgen 東京', 'age': 123456789},
+              {'id': 2, 'name': '}', 'score': -1.5e10, 'ok': True,
+               'none': None},
+              {'id': 3, 'tags': []}],
+    'empty': [],
+}
+
+
+def reader(content, chunk_size):
+    return JSONStreamReader(io.BytesIO(content.encode('utf-8')), chunk_size)
+
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 3, 7, 64, 65536])
+def test_records(chunk_size):
+    content = json.dumps(data, indent=1)
+
+    for table in data:
+        if isinstance(data[table], list):
+            assert list(reader(content, chunk_size).records(table)) == \
+                data[table]
+
+    assert list(reader(content, chunk_size).records('missing')) == []
+    assert list(reader(content, chunk_size).tables()) == list(data)
+
+
+def test_empty():
+    assert list(reader('', 4).tables()) == []
+    assert list(reader(' {} ', 4).tables()) == []
+    assert list(reader('{}', 4).records('t')) == []
+
+
+def test_invalid():
+    with pytest.raises(ValueError):
+        list(reader('{"t": [{"id": 1}', 4).records('t'))
+    with pytest.raises(ValueError):
+        list(reader('{"t": [1 2]}', 4).records('t'))
+    with pytest.raises(ValueError):
+        list(reader('{"t": [1, 2', 4).tables())
+
+
+def test_storage_streaming(tmpdir):
+    path = str(tmpdir.join('db.json'))
+
+    with Flata(path) as db:
+        db.table('a').insert_multiple({'int': i} for i in range(5))
+        db.table('b').insert({'int': 1})
+
+        storage = db._storage
+        assert storage.table_names() == set(['a', 'b'])
+        assert list(storage.iter_table('b')) == [{'int': 1, 'id': 1}]
+
+        # Elements that aren't kept are streamed
+        table = db.table('a')
+        table._storage._data = None
+        assert [e.id for e in table] == [1, 2, 3, 4, 5]
+        assert table._storage._data is None
+
+    storage = JSONStorage(path)
+    assert storage.table_names() == set(['a', 'b'])
+    storage.close()
+
+
+@pytest.mark.parametrize('atomic', [False, True])
+def test_storage_streaming_write_while_iterating(tmpdir, atomic):
+    path = str(tmpdir.join('db.json'))
+
+    with Flata(path, atomic=atomic) as db:
+        db.table('a').insert({'int': 0})
+        db.table('t').insert_multiple({'int': i} for i in range(5000))
+
+    with Flata(path, atomic=atomic) as db:
+        other = db.table('a')
+        count = 0
+        for element in db.table('t'):
+            if count % 500 == 0:
+                other.insert({'int': count})
+            count += 1
+
+        assert count == 5000
+        assert len(other) == 11
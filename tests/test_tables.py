@@ -1,4 +1,10 @@
-from flata import where
+import threading
+
+import pytest
+
+from flata import Flata, where
+from flata.middlewares import CachingMiddleware
+from flata.storages import LogStorage, MemoryStorage
 
 
 def test_tables_list(db):
@@ -67,11 +73,12 @@ def test_lru_cache(db):
     assert query not in table._query_cache
 
     table.remove(where('int') == 1)
-    assert not table._query_cache.lru
+    # Writes keep the cached results, see test_query_cache_maintained
+    assert table._query_cache.lru == [where('int') == 2, where('int') == 3]
 
     table.search(query)
 
-    assert len(table._query_cache) == 1
+    assert table._query_cache.lru == [where('int') == 3, query]
     table.clear_cache()
     assert len(table._query_cache) == 0
 
@@ -82,3 +89,264 @@ def test_table_is_iterable(db):
     table.insert_multiple({'int': i} for i in range(3))
 
     assert [r for r in table] == table.all()
+
+
+@pytest.mark.parametrize('options', [{'storage': MemoryStorage}, {},
+                                     {'storage': LogStorage}])
+def test_table_write_while_iterating(tmpdir, options):
+    with Flata(str(tmpdir.join('db')), **options) as db:
+        table = db.table('t')
+        table.insert_multiple({'int': i} for i in range(4))
+
+        seen = []
+        for element in table:
+            seen.append(element.id)
+            table.insert({'int': 10 + element.id})
+            table.remove(ids=[element.id])
+
+        # The elements as they were when the iteration started
+        assert seen == [1, 2, 3, 4]
+        assert [e['int'] for e in table] == [11, 12, 13, 14]
+
+        # Also when the elements aren't kept yet
+        table._storage._data = None
+        for element in table:
+            table.remove(ids=[element.id])
+        assert len(table) == 0
+
+
+def test_thread_safe_write_while_iterating():
+    db = Flata(storage=MemoryStorage, thread_safe=True)
+    table = db.table('t')
+    table.insert_multiple({'int': i} for i in range(3))
+
+    for element in table:
+        table.update({'int': element['int'] + 10}, ids=[element.id])
+    assert [e['int'] for e in table] == [10, 11, 12]
+
+    # An abandoned iteration doesn't keep writers from other threads out
+    elements = iter(table)
+    next(elements)
+    writer = threading.Thread(target=table.insert, args=({'int': 3},))
+    writer.start()
+    writer.join(5)
+    assert not writer.is_alive()
+    assert len(table) == 4
+
+
+def test_table_read_once():
+    class CountingStorage(MemoryStorage):
+        reads = 0
+
+        def read(self):
+            CountingStorage.reads += 1
+            return super(CountingStorage, self).read()
+
+    db = Flata(storage=CountingStorage)
+    table = db.table('t')
+    table.insert_multiple({'int': i} for i in range(3))
+    reads = CountingStorage.reads
+
+    assert len(table) == 3
+    assert table.get(id=2)['int'] == 1
+    assert len(table.search(where('int') > 0)) == 2
+    assert CountingStorage.reads == reads
+
+    # Writing the storage directly invalidates the decoded elements
+    db.purge_tables()
+    assert len(table) == 0
+
+
+@pytest.mark.parametrize('options', [
+    {'storage': MemoryStorage},
+    {'storage': LogStorage},
+    {'wal': True},
+    {'storage': CachingMiddleware(MemoryStorage)},
+])
+def test_table_kept_while_others_change(tmpdir, options):
+    with Flata(str(tmpdir.join('db')), **options) as db:
+        a, b = db.table('a'), db.table('b')
+        a.insert_multiple({'int': i} for i in range(3))
+        a.create_index('int', kind='sorted')
+        kept = a._storage.read()
+
+        b.insert({'int': 1})
+        b.update({'int': 2}, ids=[1])
+        b.remove(ids=[1])
+
+        assert a._storage.read() is kept
+        assert a.search(where('int') > 0) == [{'id': 2, 'int': 1},
+                                              {'id': 3, 'int': 2}]
+
+        # Replacing the whole database still invalidates every table
+        db.purge_tables()
+        assert len(a) == 0
+
+
+def test_table_detects_external_change(tmpdir):
+    path = str(tmpdir.join('test.db.json'))
+    db1 = Flata(path)
+    db2 = Flata(path)
+
+    db1.table('t').insert({'int': 1})
+    assert len(db2.table('t')) == 1
+
+    db1.table('t').insert({'int': 2})
+    assert db2.table('t').get(id=2) == {'id': 2, 'int': 2}
+
+    db1.close()
+    db2.close()
+
+
+def test_table_returns_copies(db):
+    table = db.table('t')
+    table.get(id=1)['int'] = 100
+    table.all()[1]['int'] = 100
+
+    assert table.count(where('int') == 100) == 0
+
+
+@pytest.mark.parametrize('options', [{'storage': MemoryStorage}, {}])
+def test_table_nested_values_copied(tmpdir, options):
+    with Flata(str(tmpdir.join('db')), **options) as db:
+        table = db.table('t')
+        table.create_index('tags')
+
+        element = {'tags': ['a'], 'address': {'zip': 1}}
+        table.insert(element)
+        element['tags'].append('x')
+        element['address']['zip'] = 2
+
+        table.get(id=1)['tags'].append('y')
+        table.search(where('tags').any(['a']))[0]['address']['zip'] = 3
+        for el in table:
+            el['tags'].append('z')
+
+        fields = {'more': {'n': [1]}}
+        table.update(fields, ids=[1])
+        fields['more']['n'].append(2)
+        table.update(lambda el: el['tags'].append('b'), ids=[1])
+
+        expected = {'id': 1, 'tags': ['a', 'b'], 'address': {'zip': 1},
+                    'more': {'n': [1]}}
+        assert table.get(id=1) == expected
+        assert table.search(where('tags').any(['x', 'y', 'z'])) == []
+        assert table.search(where('tags').any(['b'])) == [expected]
+
+
+def test_table_shares_records():
+    db = Flata(storage=MemoryStorage)
+    table = db.table('t')
+    table.insert_multiple({'int': i} for i in range(3))
+    db._storage.write(db._storage.read())  # Read again from the storage
+    stored = db._storage.memory['t']
+
+    # Reads don't copy the stored records
+    assert table._read()[1] is stored[0]
+    assert table.get(id=1) is not stored[0]
+
+    # Changes don't touch the old records, they are replaced
+    first, second = stored[0], stored[1]
+    table.update({'int': 10}, ids=[1])
+    table.update(lambda element: element.update(int=20), where('int') == 1)
+    assert (first, second) == ({'id': 1, 'int': 0}, {'id': 2, 'int': 1})
+    assert [element['int'] for element in table] == [10, 20, 2]
+    assert table._read()[2] is db._storage.memory['t'][1]
+
+
+def test_query_cache_rows(db):
+    table = db.table('table4', cache_rows=3)
+    table.insert_multiple([{'int': 1}, {'int': 1}, {'int': 2}])
+
+    table.search(where('int') == 1)
+    table.search(where('int') == 2)
+    assert len(table._query_cache) == 2
+
+    table.search(where('int').exists())
+    assert len(table._query_cache) == 1
+    assert table._query_cache.weight == 3
+
+
+def test_query_cache_maintained(db):
+    table = db.table('table5')
+    table.insert_multiple({'int': i, 'char': c} for i, c in [(1, 'a'),
+                                                            (2, 'b'),
+                                                            (1, 'c')])
+    ones = where('int') == 1
+    twos = where('int') == 2
+
+    assert [e.id for e in table.search(ones)] == [1, 3]
+    assert [e.id for e in table.search(twos)] == [2]
+
+    table.insert({'int': 1, 'char': 'd'})
+    table.update({'char': 'x'}, ids=[1])
+    table.remove(ids=[3])
+    assert table._query_cache.lru == [ones, twos]
+    assert table.search(ones) == [{'id': 1, 'int': 1, 'char': 'x'},
+                                  {'id': 4, 'int': 1, 'char': 'd'}]
+
+    # Element 1 would have to be put in front of element 2
+    table.update({'int': 2}, ids=[1])
+    assert twos not in table._query_cache
+    assert [e.id for e in table.search(ones)] == [4]
+    assert [e.id for e in table.search(twos)] == [1, 2]
+
+    table.purge()
+    assert not table._query_cache
+
+
+def test_query_cache_untouched(db):
+    table = db.table('table6', cache_rows=10)
+    table.insert_multiple({'int': i} for i in range(4))
+    low = where('int') < 2
+    high = where('int') >= 2
+
+    table.search(low)
+    table.search(high)
+    cached = table._query_cache.peek(low)
+
+    # Writes that don't concern a result leave it as it is
+    table.update({'int': 3}, ids=[4])
+    table.insert({'int': 5})
+    assert table._query_cache.peek(low) is cached
+    assert [e.id for e in cached] == [1, 2]
+
+    # Others are changed in place, in their LRU order
+    table.remove(ids=[1, 3])
+    assert table._query_cache.peek(low) is cached
+    assert table._query_cache.lru == [low, high]
+    assert [e.id for e in table.search(low)] == [2]
+    assert [e.id for e in table.search(high)] == [4, 5]
+    assert table._query_cache.weight == 3
+
+
+@pytest.mark.parametrize('options', [
+    {'storage': MemoryStorage}, {}, {'wal': True, 'sync': False},
+    {'storage': CachingMiddleware(MemoryStorage)},
+])
+def test_thread_safe(tmpdir, options):
+    db = Flata(str(tmpdir.join('db.json')), thread_safe=True, **options)
+    tables = [db.table('a'), db.table('b')]
+    errors = []
+
+    def work(table, n):
+        try:
+            for i in range(50):
+                table.insert({'n': n, 'i': i})
+                table.search(where('n') == n)
+                table.update({'seen': True}, where('i') == i)
+        except Exception as e:  # pragma: no cover
+            errors.append(e)
+
+    threads = [threading.Thread(target=work, args=(table, n))
+               for n in range(4) for table in tables]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    for table in tables:
+        assert len(table) == 200
+        assert sorted(element.id for element in table) == list(range(1, 201))
+        assert table.count(where('n') == 1) == 50
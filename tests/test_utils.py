@@ -1,7 +1,9 @@
+import threading
 import warnings
 import pytest
 
-from flata.utils import LRUCache, catch_warning, freeze, FrozenDict
+from flata.utils import (LRUCache, ReadWriteLock, catch_warning, freeze,
+                         FrozenDict)
 
 
 def test_lru_cache():
@@ -119,3 +121,91 @@ def test_freeze():
 
     with pytest.raises(TypeError):
         frozen[3]['a'] = 10
+
+
+def test_lru_cache_get_missing():
+    cache = LRUCache(capacity=3)
+    cache["a"] = 1
+
+    assert cache.get("b") is None
+    assert cache.lru == ["a"]
+
+
+def test_lru_cache_weighted():
+    cache = LRUCache(capacity=10, max_weight=5)
+    cache["a"] = [1, 2]
+    cache["b"] = [1, 2]
+    _ = cache["a"]
+    cache["c"] = [1, 2]  # b is evicted to get below the weight
+
+    assert cache.lru == ["a", "c"]
+    assert cache.weight == 4
+
+    cache["a"] = [1]
+    assert cache.weight == 3
+
+    cache["d"] = list(range(6))  # heavier than the whole cache
+    assert "d" not in cache
+    assert cache.lru == ["c", "a"]
+    assert cache.weight == 3
+
+    cache["a"] = list(range(6))  # replaces a, which isn't kept then
+    assert cache.lru == ["c"]
+    assert cache.weight == 2
+
+
+def test_lru_cache_peek_reweigh():
+    cache = LRUCache(capacity=3, max_weight=5)
+    cache["a"] = [1, 2]
+    cache["b"] = [1]
+
+    assert cache.peek("a") == [1, 2]
+    assert cache.peek("c") is None
+    assert cache.lru == ["a", "b"]
+
+    cache.peek("b").extend([2, 3])
+    cache.reweigh("b")
+    assert cache.lru == ["a", "b"]
+    assert cache.weight == 5
+
+    cache.peek("b").append(4)
+    cache.reweigh("b")  # a is evicted to get below the weight
+    assert cache.lru == ["b"]
+    assert cache.weight == 4
+
+
+def test_lru_cache_pop():
+    cache = LRUCache(capacity=3, max_weight=10)
+    cache["a"] = [1, 2]
+
+    assert cache.pop("a") == [1, 2]
+    assert cache.pop("a", None) is None
+    assert cache.lru == []
+    assert cache.weight == 0
+
+
+def test_read_write_lock():
+    lock = ReadWriteLock()
+    events = []
+
+    # Readers share the lock and may nest, the writer may read too
+    with lock.reading():
+        with lock.reading():
+            pass
+        with pytest.raises(RuntimeError):
+            lock.acquire_write()
+
+        writer = threading.Thread(
+            target=lambda: (lock.acquire_write(), events.append('write'),
+                            lock.release_write()))
+        writer.start()
+        writer.join(0.05)
+        assert events == []  # Waits for the reader
+
+    writer.join()
+    assert events == ['write']
+
+    with lock.writing():
+        with lock.writing():
+            with lock.reading():
+                pass